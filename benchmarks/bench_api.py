@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+API load scenarios against a seeded throwaway database
+Seeds households (with a mix of subscription frequencies, vacations, orders
+and cancellations) and delivery persons, materializes the next days'
+manifests the way the nightly rebuild does, then drives the app in-process
+through httpx's ASGI transport with concurrent clients, one scenario at a
+time:
+
+  driver_rush      5 am: every driver pulls their stops, dispatch checks totals
+  evening_burst    residents edit subscriptions, add vacations and orders for tomorrow
+  onboarding       a new society is imported: residents, then their subscriptions
+  dashboards       residents open their dashboard page, half the old way (five
+                   requests) and half with /users/{id}/dashboard, revalidated
+
+Reports throughput, p50/p95/p99 latency and errors (5xx responses and
+exceptions, e.g. SQLite lock timeouts) per endpoint. --json saves the
+results with the git commit they were measured at; --compare prints the
+change against such a file, so a regression shows up between commits.
+
+Usage: python benchmarks/bench_api.py [--users 20000] [--scenario driver_rush] [--json out.json] [--compare before.json]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import subprocess
+import time
+from datetime import date, datetime, timedelta
+
+# Importing common points DATABASE_URL at a throwaway database
+from common import percentile, seed_database
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+import manifest_store  # noqa: E402
+import migrations  # noqa: E402
+from database import engine, SessionLocal  # noqa: E402
+
+TODAY = date.today()
+TOMORROW = TODAY + timedelta(days=1)
+
+
+class Run:
+    """Shared state of one benchmark run: data sizes, id counters and samples"""
+
+    def __init__(self, users, drivers, onboarding_batch):
+        self.users = users
+        self.drivers = drivers
+        self.onboarding_batch = onboarding_batch
+        self.onboarded = itertools.count(1)
+        self.samples = {}  # endpoint -> [seconds, ...]
+        self.errors = {}
+        self.rows = {}
+
+    def resident(self, rng):
+        return rng.randint(1, self.users)
+
+    def driver(self, rng):
+        return self.users + rng.randint(1, self.drivers)
+
+    async def request(self, http, endpoint, method, url, rows=0, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await http.request(method, url, **kwargs)
+            failed = response.status_code >= 500
+        except Exception:
+            response, failed = None, True
+        self.samples.setdefault(endpoint, []).append(time.perf_counter() - started)
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + failed
+        if rows and not failed:
+            self.rows[endpoint] = self.rows.get(endpoint, 0) + rows
+        return response
+
+
+# Operations: async (http, rng, run) -> None, each one or more requests
+
+async def driver_stops(http, rng, run):
+    await run.request(http, "GET /deliveries/{delivery_date}/stream?driver_id", "GET",
+                      f"/deliveries/{TODAY}/stream", params={"driver_id": run.driver(rng)})
+
+
+async def driver_blocks(http, rng, run):
+    await run.request(http, "GET /drivers/{driver_id}/blocks", "GET", f"/drivers/{run.driver(rng)}/blocks")
+
+
+async def day_summary(http, rng, run):
+    await run.request(http, "GET /deliveries/{delivery_date}/summary", "GET", f"/deliveries/{TODAY}/summary")
+
+
+async def day_manifest(http, rng, run):
+    await run.request(http, "GET /deliveries/{delivery_date}", "GET", f"/deliveries/{TODAY}")
+
+
+async def away_today(http, rng, run):
+    await run.request(http, "GET /vacations/{on_date}", "GET", f"/vacations/{TODAY}")
+
+
+async def view_subscription(http, rng, run):
+    await run.request(http, "GET /users/{user_id}/subscription", "GET", f"/users/{run.resident(rng)}/subscription")
+
+
+async def edit_subscription(http, rng, run):
+    items = [{"product_id": product_id, "quantity": rng.randint(1, 3)}
+             for product_id in rng.sample(range(1, 5), rng.choice((1, 1, 2, 3)))]
+    frequency = rng.choice(("daily", "daily", "daily", "alternate", "weekdays"))
+    await run.request(http, "POST /users/{user_id}/subscription", "POST", f"/users/{run.resident(rng)}/subscription",
+                      json={"items": items, "frequency": frequency})
+
+
+async def add_vacation(http, rng, run):
+    start = TOMORROW + timedelta(days=rng.randint(0, 7))
+    await run.request(http, "POST /users/{user_id}/vacations", "POST", f"/users/{run.resident(rng)}/vacations",
+                      json={"start_date": start.isoformat(), "end_date": (start + timedelta(days=rng.randint(0, 10))).isoformat()})
+
+
+async def add_order(http, rng, run):
+    await run.request(http, "POST /users/{user_id}/orders", "POST", f"/users/{run.resident(rng)}/orders", json={
+        "date": TOMORROW.isoformat(), "is_adhoc": True,
+        "items": [{"product_id": rng.randint(1, 4), "quantity": rng.randint(1, 4)}]
+    })
+
+
+async def order_history(http, rng, run):
+    await run.request(http, "GET /users/{user_id}/orders", "GET", f"/users/{run.resident(rng)}/orders",
+                      params={"order": "desc", "limit": 20})
+
+
+async def vacation_history(http, rng, run):
+    await run.request(http, "GET /users/{user_id}/vacations", "GET", f"/users/{run.resident(rng)}/vacations",
+                      params={"order": "desc", "limit": 20})
+
+
+async def product_list(http, rng, run):
+    await run.request(http, "GET /products", "GET", "/products")
+
+
+async def dashboard_requests(http, rng, run):
+    """The resident page's five requests, one after the other as the page used to make them"""
+    user_id = run.resident(rng)
+    await product_list(http, rng, run)
+    await run.request(http, "GET /users/{user_id}/subscription", "GET", f"/users/{user_id}/subscription")
+    for name, limit in (("orders", 50), ("vacations", 20), ("cancellations", 20)):
+        await run.request(http, f"GET /users/{{user_id}}/{name}", "GET", f"/users/{user_id}/{name}",
+                          params={"order": "desc", "limit": limit})
+
+
+async def dashboard(http, rng, run):
+    """The resident page in one request, then reloaded unchanged"""
+    user_id = run.resident(rng)
+    response = await run.request(http, "GET /users/{user_id}/dashboard", "GET", f"/users/{user_id}/dashboard")
+    if response is not None and response.status_code == 200:
+        await run.request(http, "GET /users/{user_id}/dashboard (304)", "GET", f"/users/{user_id}/dashboard",
+                          headers={"If-None-Match": response.headers["etag"]})
+
+
+async def onboard_society(http, rng, run):
+    """One CSV of new residents, then a CSV of their subscriptions"""
+    batch = next(run.onboarded)
+    emails = [f"onboard{batch}-{n}@example.com" for n in range(run.onboarding_batch)]
+    users_csv = "name,email,house_number,address\n" + "".join(
+        f"New resident {batch}-{n},{email},{rng.choice('MNOP')}-{rng.randint(1, 20)}{rng.randint(1, 8):02d},"
+        f"Tower {batch} New Society\n" for n, email in enumerate(emails)
+    )
+    await run.request(http, "POST /import/users", "POST", "/import/users", rows=len(emails),
+                      content=users_csv, headers={"content-type": "text/csv"})
+    subscriptions_csv = "email,frequency,product_id,quantity\n" + "".join(
+        f"{email},{rng.choice(('daily', 'daily', 'alternate'))},{rng.randint(1, 4)},{rng.randint(1, 3)}\n"
+        for email in emails
+    )
+    await run.request(http, "POST /import/subscriptions", "POST", "/import/subscriptions", rows=len(emails),
+                      content=subscriptions_csv, headers={"content-type": "text/csv"})
+
+
+# name -> (description, default clients, operations per client, [(weight, operation)])
+SCENARIOS = {
+    "driver_rush": ("5 am: drivers pull their stops, dispatch checks totals", 24, 10, [
+        (6, driver_stops), (2, day_summary), (1, day_manifest), (1, driver_blocks), (1, away_today),
+    ]),
+    "evening_burst": ("residents edit tomorrow's deliveries", 200, 10, [
+        (4, view_subscription), (3, edit_subscription), (2, add_vacation), (2, add_order),
+        (2, order_history), (1, vacation_history), (1, product_list),
+    ]),
+    "onboarding": ("bulk import of new residents and their subscriptions", 4, 3, [
+        (1, onboard_society),
+    ]),
+    "dashboards": ("residents open their dashboard page", 100, 10, [
+        (1, dashboard_requests), (1, dashboard),
+    ]),
+}
+
+
+async def run_scenario(name, clients, operations, run):
+    _, _, _, mix = SCENARIOS[name]
+    weights = [weight for weight, _ in mix]
+    run.samples, run.errors, run.rows = {}, {}, {}
+
+    async def client(number, http):
+        rng = random.Random(f"{name}-{number}")
+        for _ in range(operations):
+            _, operation = rng.choices(mix, weights)[0]
+            await operation(http, rng, run)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(n, http) for n in range(clients)))
+        elapsed = time.perf_counter() - started
+
+    endpoints = {}
+    for endpoint, samples in sorted(run.samples.items()):
+        endpoints[endpoint] = {
+            "requests": len(samples),
+            "errors": run.errors[endpoint],
+            "rps": len(samples) / elapsed,
+            "p50_ms": percentile(samples, 0.50) * 1000,
+            "p95_ms": percentile(samples, 0.95) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000,
+        }
+        if endpoint in run.rows:
+            endpoints[endpoint]["rows_per_sec"] = run.rows[endpoint] / sum(samples)
+    total = sum(len(samples) for samples in run.samples.values())
+    return {
+        "clients": clients,
+        "requests": total,
+        "errors": sum(run.errors.values()),
+        "seconds": elapsed,
+        "rps": total / elapsed,
+        "endpoints": endpoints,
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def change(before, after):
+    return f"{(after - before) / before * 100:+6.1f}%" if before else "     n/a"
+
+
+def print_scenario(name, result, previous=None):
+    print(f"\n{name}: {result['requests']} requests from {result['clients']} clients in {result['seconds']:.2f}s "
+          f"({result['rps']:.1f} req/s, {result['errors']} errors)")
+    for endpoint, r in result["endpoints"].items():
+        line = (f"  {endpoint:52s} {r['requests']:6d}  {r['rps']:8.1f} req/s  p50 {r['p50_ms']:8.1f}  "
+                f"p95 {r['p95_ms']:8.1f}  p99 {r['p99_ms']:8.1f} ms")
+        if r["errors"]:
+            line += f"  {r['errors']} errors"
+        if "rows_per_sec" in r:
+            line += f"  {r['rows_per_sec']:.0f} rows/s"
+        before = (previous or {}).get("endpoints", {}).get(endpoint)
+        if before:
+            line += f"   vs before: p95 {change(before['p95_ms'], r['p95_ms'])}  req/s {change(before['rps'], r['rps'])}"
+        print(line)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--drivers", type=int, default=12)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="run only this scenario (repeatable); default all, in the order listed")
+    parser.add_argument("--clients", type=int, help="override every scenario's client count")
+    parser.add_argument("--operations", type=int, help="override every scenario's operations per client")
+    parser.add_argument("--onboarding-batch", type=int, default=1000, help="residents per imported CSV")
+    parser.add_argument("--no-materialize", action="store_true", help="skip building the upcoming manifests")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="earlier --json output to compare against")
+    args = parser.parse_args()
+
+    migrations.migrate(engine)
+    started = time.perf_counter()
+    counts = seed_database(engine, args.users, TODAY, frequencies=True, drivers=args.drivers)
+    if not args.no_materialize:
+        with SessionLocal() as db:
+            manifest_store.rebuild(db, TODAY, 2)
+    print(f"Seeded {counts} in {time.perf_counter() - started:.1f}s")
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print(f"Comparing against {args.compare} (commit {previous.get('commit')})")
+
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        _, clients, operations, _ = SCENARIOS[name]
+        state = Run(args.users, args.drivers, args.onboarding_batch)
+        results[name] = asyncio.run(run_scenario(name, args.clients or clients, args.operations or operations, state))
+        print_scenario(name, results[name], previous.get("scenarios", {}).get(name))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "commit": git_commit(),
+                "measured_at": datetime.now().isoformat(timespec="seconds"),
+                "users": args.users,
+                "drivers": args.drivers,
+                "materialized": not args.no_materialize,
+                "scenarios": results,
+            }, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Hot-path reads with years of order history, before and after archival
+Seeds a throwaway SQLite database with households (see common.py) and
+--years of ad-hoc order history (--orders orders per household and month,
+with items), then times, with everything in the hot tables and again after
+`archive.run()` has moved the months before the horizon out:
+
+  deliveries today   today's manifest
+  summary today      today's per-product totals
+  orders page        a resident's latest 100 orders (GET /users/{id}/orders)
+  old deliveries     the manifest of a day before the horizon, which reads
+                     the archive
+
+and reports how long archival took and the hot and archive row counts.
+
+Usage: python benchmarks/bench_archive.py [--users 2000] [--years 3] [--orders 4]
+"""
+
+import argparse
+import json
+import random
+from datetime import date, timedelta
+
+from common import percentile, seed_database, temp_engine, timed
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import sessionmaker
+
+import archive
+import cancellation_index
+import inventory
+import manifest
+import migrations
+import pagination
+from db_models import ArchivedOrder, Order, OrderItem
+
+TODAY = date.today()
+BATCH = 10000
+
+
+def seed_history(engine, users, years, per_month, seed=9):
+    """per_month ad-hoc orders of one or two items per household and month, over the last years"""
+    rng = random.Random(seed)
+    first_day = TODAY - timedelta(days=365 * years)
+    span = (TODAY - first_day).days
+    with engine.begin() as connection:
+        next_id = (connection.execute(select(func.max(Order.id))).scalar() or 0) + 1
+        orders, items = [], []
+        for user_id in range(1, users + 1):
+            for _ in range(per_month * 12 * years):
+                orders.append({"id": next_id, "user_id": user_id, "is_adhoc": True, "status": "delivered",
+                               "date": first_day + timedelta(days=rng.randrange(span))})
+                for product_id in rng.sample(range(1, 5), rng.randint(1, 2)):
+                    items.append({"order_id": next_id, "product_id": product_id, "quantity": rng.randint(1, 3)})
+                next_id += 1
+        for offset in range(0, len(orders), BATCH):
+            connection.execute(insert(Order), orders[offset:offset + BATCH])
+        for offset in range(0, len(items), BATCH):
+            connection.execute(insert(OrderItem), items[offset:offset + BATCH])
+    return len(orders)
+
+
+def measure(db, users, old_day, repetitions):
+    rng = random.Random(4)
+    params = pagination.PageParams(100, None, "desc", None)
+
+    def orders_page():
+        user_id = rng.randint(1, users)
+        return pagination.paginate(
+            archive.orders_of(db, Order, user_id), Order, [Order.date, Order.id], params,
+            archived=archive.orders_of(db, ArchivedOrder, user_id)
+        )
+
+    shapes = {
+        "deliveries today": lambda: manifest.build_manifest(db, TODAY),
+        "summary today": lambda: inventory.summarize(db, TODAY, TODAY),
+        "orders page": orders_page,
+        "old deliveries": lambda: manifest.build_manifest(db, old_day),
+    }
+    results = {}
+    for name, shape in shapes.items():
+        count = repetitions * (20 if name == "orders page" else 1)
+        samples = [timed(shape)[0] * 1000 for _ in range(count)]
+        results[name] = {"p50_ms": percentile(samples, 0.5), "p99_ms": percentile(samples, 0.99)}
+    return results, {day: manifest.build_manifest(db, day) for day in (TODAY, old_day)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--orders", type=int, default=4, help="ad-hoc orders per household and month")
+    parser.add_argument("--repetitions", type=int, default=5)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    engine = temp_engine("archive")
+    migrations.migrate(engine)
+    seed_database(engine, args.users, TODAY)
+    elapsed, count = timed(seed_history, engine, args.users, args.years, args.orders)
+    print(f"Seeded {args.users} users and {count} historic orders in {elapsed:.1f}s")
+    old_day = archive.horizon() - timedelta(days=40)
+
+    db = sessionmaker(bind=engine)()
+    before, manifests = measure(db, args.users, old_day, args.repetitions)
+    archive_seconds, result = timed(archive.run, db)
+    hot = db.query(func.count(Order.id)).scalar()
+    archived = db.query(func.count(ArchivedOrder.id)).scalar()
+    cancellation_index.invalidate()
+    after, manifests_after = measure(db, args.users, old_day, args.repetitions)
+    db.close()
+    assert manifests_after == manifests
+
+    print(f"archived {len(result['archived'])} months before {result['horizon']} in {archive_seconds:.1f}s: "
+          f"{hot} orders hot, {archived} archived")
+    for name in before:
+        print(f"  {name:18s} p50 {before[name]['p50_ms']:8.2f} -> {after[name]['p50_ms']:8.2f} ms   "
+              f"p99 {before[name]['p99_ms']:8.2f} -> {after[name]['p99_ms']:8.2f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": args.users, "years": args.years, "orders": count, "archive_seconds": archive_seconds,
+                       "hot_orders": hot, "archived_orders": archived, "before": before, "after": after}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Load test comparing the sync and async (DATABASE_ASYNC=1) API modes
+Seeds a throwaway SQLite database, then drives the app in-process through
+httpx's ASGI transport with many concurrent clients, once per mode, each
+mode in its own interpreter so the configuration is read fresh. Reports
+successful requests/sec and p50/p95/p99 latency.
+
+Usage: python benchmarks/bench_async.py [--clients 500] [--requests 20] [--users 5000]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import date
+
+from common import percentile, seed_database, temp_database_url
+
+# Weighted request mix: mostly dashboard reads, some ad-hoc orders
+MIX = [
+    (5, "GET", "/users/{user_id}/subscription"),
+    (3, "GET", "/products"),
+    (3, "GET", "/users/{user_id}/orders"),
+    (2, "GET", "/users/{user_id}/vacations"),
+    (1, "POST", "/users/{user_id}/orders"),
+]
+
+
+async def run_clients(clients, requests_per_client, users, request_timeout):
+    import httpx
+    import main
+
+    latencies = []
+    errors = 0
+    today = date.today().isoformat()
+    weights = [weight for weight, _, _ in MIX]
+
+    async def client(number, http):
+        nonlocal errors
+        rng = random.Random(number)
+        for _ in range(requests_per_client):
+            _, method, path = rng.choices(MIX, weights)[0]
+            url = path.format(user_id=rng.randint(1, users))
+            body = {"date": today, "items": [{"product_id": 1, "quantity": 1}], "is_adhoc": True} if method == "POST" else None
+            started = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(http.request(method, url, json=body), request_timeout)
+                if response.status_code >= 500:
+                    errors += 1
+            except (Exception, asyncio.TimeoutError):
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(n, http) for n in range(clients)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "rps": (len(latencies) - errors) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000
+    }
+
+
+def child(args):
+    result = asyncio.run(run_clients(args.clients, args.requests, args.users, args.request_timeout))
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=20, help="requests per client")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--request-timeout", type=float, default=10.0,
+                        help="seconds before a request counts as an error")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args)
+
+    import migrations
+    from sqlalchemy import create_engine
+
+    url = temp_database_url("async")
+    engine = create_engine(url)
+    migrations.migrate(engine)
+    seed_database(engine, args.users)
+    engine.dispose()
+    print(f"Seeded {args.users} users into {url}")
+
+    results = {}
+    for mode, flag in (("sync", "0"), ("async", "1")):
+        env = dict(os.environ, DATABASE_URL=url, DATABASE_ASYNC=flag, PYTHONWARNINGS="ignore")
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", "--clients", str(args.clients),
+             "--requests", str(args.requests), "--users", str(args.users),
+             "--request-timeout", str(args.request_timeout)],
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+        r = results[mode]
+        print(f"{mode:6s} {r['requests']:6d} requests  {r['rps']:8.1f} req/s  "
+              f"p50 {r['p50_ms']:8.1f} ms  p95 {r['p95_ms']:8.1f} ms  p99 {r['p99_ms']:8.1f} ms  errors {r['errors']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"clients": args.clients, "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Monthly billing: billing.run with worker processes vs replaying the manifest
+Seeds a throwaway SQLite database (100k households by default, with a mix of
+subscription frequencies, vacations, ad-hoc orders and cancellations), then
+bills last month:
+
+  replay      manifest.build_manifest for every day of the month, quantities
+              multiplied by price in Python (the old offline approach; nothing
+              is stored)
+  billing     billing.run with 1 worker, then with --workers processes, each
+              storing the invoices (the database is cleared between runs)
+
+Usage: python benchmarks/bench_billing.py [--users 100000] [--workers 4]
+"""
+
+import argparse
+import json
+import os
+from collections import defaultdict
+from datetime import date, timedelta
+
+from common import seed_database, temp_engine, timed
+
+from sqlalchemy.orm import sessionmaker
+
+import billing
+import manifest
+import migrations
+from db_models import Invoice, InvoiceLine
+
+TODAY = date.today()
+LAST_MONTH = (TODAY.replace(day=1) - timedelta(days=1)).replace(day=1)
+
+
+def replay(db, month):
+    """Per-user amounts from one manifest per day"""
+    prices = {product_id: price for product_id, (_, price) in billing.prices(db).items()}
+    first, last = billing.month_bounds(month)
+    amounts = defaultdict(float)
+    day = first
+    while day <= last:
+        for delivery in manifest.build_manifest(db, day):
+            for item in delivery["items"]:
+                amounts[delivery["user_id"]] += item["quantity"] * prices[item["product_id"]]
+        day += timedelta(days=1)
+    return amounts
+
+
+def clear_invoices(engine):
+    with engine.begin() as connection:
+        connection.execute(InvoiceLine.__table__.delete())
+        connection.execute(Invoice.__table__.delete())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--skip-replay", action="store_true", help="do not time the day-by-day replay")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    engine = temp_engine("billing")
+    migrations.migrate(engine)
+    elapsed, _ = timed(seed_database, engine, args.users, TODAY, frequencies=True)
+    print(f"Seeded {args.users} users in {elapsed:.1f}s; billing {LAST_MONTH:%Y-%m}")
+    db = sessionmaker(bind=engine)()
+
+    results = {}
+    if not args.skip_replay:
+        results["replay"], amounts = timed(replay, db, LAST_MONTH)
+        print(f"replay: {len(amounts)} users in {results['replay']:.1f}s (current subscriptions only, nothing stored)")
+
+    for workers in sorted({1, args.workers}):
+        clear_invoices(engine)
+        seconds, written = timed(billing.run, db, LAST_MONTH, workers)
+        results[f"billing.run x{workers}"] = seconds
+        print(f"billing.run with {workers} worker(s): {written} invoices in {seconds:.1f}s ({written / seconds:.0f}/s)")
+
+    seconds, written = timed(billing.run, db, LAST_MONTH, args.workers)
+    print(f"re-run (everything already billed): {written} written in {seconds:.2f}s")
+    db.close()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": args.users, "workers": args.workers, "month": LAST_MONTH.isoformat(), "seconds": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
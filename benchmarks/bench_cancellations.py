@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Cancellation-aware manifests with a million historic cancellations
+Seeds a throwaway SQLite database with households (see common.py), adds
+--cancellations historic cancellation rows (of subscriptions, orders and
+vacations long gone) plus a few hundred that matter today, then times
+building today's manifest:
+
+  ignored        cancellations not applied (what the manifest used to do)
+  per delivery   one cancellations lookup per subscription and order, the
+                 naive way to apply them
+  index          the in-process exclusion index, caught up with one query
+  index (cold)   the same with the index loaded from scratch first
+
+and reports the index's load time and size next to what Python sets of the
+same ids would take.
+
+Usage: python benchmarks/bench_cancellations.py [--users 20000] [--cancellations 1000000]
+"""
+
+import argparse
+import json
+import random
+import sys
+from datetime import date
+from types import SimpleNamespace
+
+from common import seed_database, temp_engine, timed
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import sessionmaker
+
+import cancellation_index
+import manifest
+import migrations
+from db_models import Cancellation, Order, Subscription, Vacation
+
+TODAY = date.today()
+BATCH = 50000
+
+
+def seed_cancellations(engine, users, count, seed=5):
+    """count historic cancellations of ids far above the live ones, and ~1% of today's sources"""
+    rng = random.Random(seed)
+    with engine.begin() as connection:
+        for start in range(0, count, BATCH):
+            connection.execute(insert(Cancellation), [{
+                "user_id": rng.randint(1, users),
+                "cancellation_type": rng.choice(("subscription", "order", "vacation")),
+                "reference_id": 10_000_000 + n,
+                "reason": "Historic"
+            } for n in range(start, min(start + BATCH, count))])
+
+        current = []
+        for cancellation_type, model, condition in (
+            ("subscription", Subscription, Subscription.is_active == True),
+            ("order", Order, (Order.date == TODAY) & (Order.is_adhoc == True)),
+            ("vacation", Vacation, (Vacation.start_date <= TODAY) & (Vacation.end_date >= TODAY)),
+        ):
+            for reference_id, user_id in connection.execute(select(model.id, model.user_id).where(condition)):
+                if rng.random() < 0.01:
+                    current.append({"user_id": user_id, "cancellation_type": cancellation_type,
+                                    "reference_id": reference_id, "reason": "Current"})
+        connection.execute(insert(Cancellation), current)
+    return len(current)
+
+
+class PerDelivery:
+    """Membership that asks the database every time"""
+
+    def __init__(self, db, cancellation_type):
+        self.db = db
+        self.cancellation_type = cancellation_type
+
+    def __contains__(self, reference_id):
+        return self.db.query(Cancellation.id).filter(
+            Cancellation.cancellation_type == self.cancellation_type, Cancellation.reference_id == reference_id
+        ).first() is not None
+
+
+def build_with(db, exclusions):
+    real = cancellation_index.exclusions
+    cancellation_index.exclusions = lambda session: exclusions
+    try:
+        return manifest.build_manifest(db, TODAY)
+    finally:
+        cancellation_index.exclusions = real
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--cancellations", type=int, default=1000000)
+    parser.add_argument("--repetitions", type=int, default=3, help="best of this many runs")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    engine = temp_engine("cancellations")
+    migrations.migrate(engine)
+    elapsed, _ = timed(seed_database, engine, args.users, TODAY)
+    elapsed_cancellations, current = timed(seed_cancellations, engine, args.users, args.cancellations)
+    print(f"Seeded {args.users} users in {elapsed:.1f}s and {args.cancellations} historic "
+          f"+ {current} current cancellations in {elapsed_cancellations:.1f}s")
+    db = sessionmaker(bind=engine)()
+    best = lambda fn: min((timed(fn) for _ in range(args.repetitions)), key=lambda run: run[0])  # noqa: E731
+
+    empty = cancellation_index.Exclusions()
+    naive = SimpleNamespace(
+        subscriptions=PerDelivery(db, "subscription"), orders=PerDelivery(db, "order"),
+        vacations_overlapping=lambda first, last: [
+            vacation_id for (vacation_id,) in db.query(Vacation.id).join(
+                Cancellation, (Cancellation.cancellation_type == "vacation") & (Cancellation.reference_id == Vacation.id)
+            ).filter(Vacation.start_date <= last, Vacation.end_date >= first)
+        ]
+    )
+    results = {}
+    (results["ignored"], ignored) = best(lambda: build_with(db, empty))
+    (results["per delivery"], applied) = best(lambda: build_with(db, naive))
+
+    def cold():
+        cancellation_index.invalidate()
+        return manifest.build_manifest(db, TODAY)
+
+    (results["index (cold)"], cold_manifest) = best(cold)
+    (results["index"], indexed) = best(lambda: manifest.build_manifest(db, TODAY))
+    assert indexed == applied == cold_manifest
+    results["index load"], index = best(lambda: cancellation_index.Exclusions(cancellation_index._rows(db)))
+    db.close()
+
+    sets = [set(index.subscriptions), set(index.orders), set(index.vacations)]
+    set_bytes = sum(sys.getsizeof(ids) + sum(sys.getsizeof(value) for value in ids) for ids in sets)
+    print(f"today: {len(ignored)} deliveries ignoring cancellations, {len(indexed)} applying them")
+    for name in ("ignored", "per delivery", "index", "index (cold)", "index load"):
+        print(f"  {name:15s} {results[name] * 1000:9.1f} ms")
+    print(f"  index size      {index.nbytes / 2 ** 20:9.1f} MiB for {len(index)} ids "
+          f"(as Python sets: {set_bytes / 2 ** 20:.1f} MiB)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": args.users, "cancellations": args.cancellations, "seconds": results,
+                       "index_bytes": index.nbytes, "set_bytes": set_bytes}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
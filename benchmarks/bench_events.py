@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Fan-out of live manifest changes to many dashboards
+Parks --listeners SSE listeners (see manifest_events.py) on one event loop,
+spread over --blocks house-number blocks, then publishes --events stop changes
+one at a time from another thread, as committing request threads do, and
+reports per event the time until every listener that should get it has it,
+and the event loop's CPU time spent fanning it out. Idle listeners cost no
+CPU: the benchmark also reports the loop's CPU time over a quiet second.
+
+Usage: python benchmarks/bench_events.py [--listeners 5000] [--events 200] [--blocks 20]
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import threading
+import time
+import tracemalloc
+from datetime import date
+
+import common  # noqa: F401  (puts server/ on the path)
+
+import manifest_events
+
+TODAY = date.today()
+
+
+def change(n, blocks):
+    return {
+        "type": "changed", "date": TODAY, "user_id": n, "name": f"Resident {n}",
+        "house_number": f"B{n % blocks}-{n}", "address": "Tower 1",
+        "deliveries": [{"user_id": n, "date": TODAY, "items": [{"product_id": 1, "quantity": 2}], "is_subscription": True}]
+    }
+
+
+async def main_async(args):
+    broadcaster = manifest_events.Broadcaster()
+    counts = {"received": 0, "expected": 0, "total": 0}
+    done = asyncio.Event()
+
+    async def listen(n):
+        blocks = None if n % 2 else {f"B{n % args.blocks}"}
+        async for text in broadcaster.listen(TODAY, blocks):
+            counts["received"] += text.count("event: stop")
+            if counts["received"] >= counts["expected"]:
+                done.set()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tasks = [asyncio.create_task(listen(n)) for n in range(args.listeners)]
+    await asyncio.sleep(0.5)
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    idle_cpu = time.process_time()
+    await asyncio.sleep(1)
+    idle_cpu = time.process_time() - idle_cpu
+
+    latencies, cpu = [], []
+    for n in range(args.events):
+        payload = change(n, args.blocks)
+        block = f"B{n % args.blocks}"
+        counts["expected"] = sum(
+            1 for listener in range(args.listeners) if listener % 2 or f"B{listener % args.blocks}" == block
+        )
+        counts["received"] = 0
+        done.clear()
+        started, started_cpu = time.perf_counter(), time.process_time()
+        threading.Thread(target=broadcaster.publish, args=([payload],)).start()
+        await done.wait()
+        latencies.append(time.perf_counter() - started)
+        cpu.append(time.process_time() - started_cpu)
+        counts["total"] += counts["expected"]
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {
+        "listeners": args.listeners, "events": args.events,
+        "memory_per_listener_bytes": memory / args.listeners,
+        "idle_cpu_ms_per_s": idle_cpu * 1000,
+        "fanout_ms_median": statistics.median(latencies) * 1000,
+        "fanout_ms_p95": sorted(latencies)[int(len(latencies) * 0.95)] * 1000,
+        "cpu_us_per_delivery": sum(cpu) / counts["total"] * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--listeners", type=int, default=5000)
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--blocks", type=int, default=20, help="half the listeners follow one block each")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    print(f"{result['listeners']} listeners, {result['memory_per_listener_bytes'] / 1024:.1f} KiB each, "
+          f"idle CPU {result['idle_cpu_ms_per_s']:.1f} ms/s")
+    print(f"one event to all of them: median {result['fanout_ms_median']:.1f} ms, p95 {result['fanout_ms_p95']:.1f} ms, "
+          f"{result['cpu_us_per_delivery']:.1f} us CPU per listener reached")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
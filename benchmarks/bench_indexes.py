@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Index advisor benchmark for the hot query shapes
+Seeds a throwaway SQLite database, then reports EXPLAIN QUERY PLAN and
+p50/p99 latency for each endpoint's query without and with the indexes
+added by the add_hot_path_indexes migration.
+
+Usage: python benchmarks/bench_indexes.py [--users 100000] [--json results.json]
+"""
+
+import argparse
+import json
+import random
+from datetime import date
+
+from common import percentile, seed_database, temp_engine, timed
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+import manifest
+import migrations
+from db_models import Base, Subscription, SubscriptionItem, Order, OrderItem, Vacation, Cancellation
+from inventory import product_totals
+
+TODAY = date.today()
+
+# (name, repetitions, query builder) — builders take (session, random user id).
+# A repetition count of None marks whole-society queries, which are repeated
+# --heavy-repetitions times (they can take minutes each without indexes).
+SHAPES = [
+    ("deliveries: subscriptions", None, lambda db, user_id: manifest.subscription_item_rows(db, TODAY)),
+    ("deliveries: ad-hoc orders", None, lambda db, user_id: manifest.adhoc_order_rows(db, TODAY)),
+    ("get_subscription", 500, lambda db, user_id: db.query(Subscription).filter(
+        Subscription.user_id == user_id, Subscription.is_active == True)),
+    ("get_subscription: items", 500, lambda db, user_id: db.query(SubscriptionItem).filter(
+        SubscriptionItem.subscription_id == user_id)),
+    ("get_vacations", 500, lambda db, user_id: db.query(Vacation).filter(Vacation.user_id == user_id)),
+    ("get_orders", 500, lambda db, user_id: db.query(Order).filter(Order.user_id == user_id)),
+    ("get_orders: items", 500, lambda db, user_id: db.query(OrderItem).filter(OrderItem.order_id == user_id)),
+    ("get_cancellations", 500, lambda db, user_id: db.query(Cancellation).filter(Cancellation.user_id == user_id)),
+]
+
+INDEXED_TABLES = (Subscription, SubscriptionItem, Order, OrderItem, Vacation, Cancellation)
+
+
+def explain(db, query):
+    statement = query.statement.compile(dialect=db.get_bind().dialect, compile_kwargs={"literal_binds": True})
+    rows = db.execute(text(f"EXPLAIN QUERY PLAN {statement}")).fetchall()
+    return [row[-1] for row in rows]
+
+
+def measure(engine, users, label, heavy_repetitions):
+    rng = random.Random(7)
+    results = {}
+    # A fresh session, so the plans see the current schema
+    db = sessionmaker(bind=engine)()
+    for name, repetitions, build in SHAPES:
+        repetitions = repetitions or heavy_repetitions
+        samples = []
+        for _ in range(repetitions):
+            elapsed, _ = timed(lambda: build(db, rng.randint(1, users)).all())
+            samples.append(elapsed * 1000)
+        results[name] = {
+            "plan": explain(db, build(db, 1)),
+            "p50_ms": percentile(samples, 0.50),
+            "p99_ms": percentile(samples, 0.99)
+        }
+
+    samples = []
+    for _ in range(heavy_repetitions):
+        elapsed, _ = timed(product_totals, db, TODAY, TODAY)
+        samples.append(elapsed * 1000)
+    results["deliveries summary"] = {"plan": [], "p50_ms": percentile(samples, 0.5), "p99_ms": percentile(samples, 0.99)}
+    db.close()
+
+    print(f"\n=== {label} ===")
+    for name, result in results.items():
+        print(f"{name:28s} p50 {result['p50_ms']:9.3f} ms   p99 {result['p99_ms']:9.3f} ms")
+        for step in result["plan"]:
+            print(f"{'':28s} {step}")
+    return results
+
+
+def drop_hot_path_indexes(engine):
+    with engine.begin() as connection:
+        for model in INDEXED_TABLES:
+            for index in model.__table__.indexes:
+                if not index.unique:
+                    connection.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+        connection.execute(text("ANALYZE"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--heavy-repetitions", type=int, default=3,
+                        help="repetitions of the whole-society queries with indexes (once without)")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    engine = temp_engine("indexes")
+    Base.metadata.create_all(bind=engine)
+    print(f"Seeding {args.users} users into {engine.url} ...")
+    elapsed, counts = timed(seed_database, engine, args.users, TODAY)
+    print(f"Seeded {counts} in {elapsed:.1f}s")
+
+    drop_hot_path_indexes(engine)
+    before = measure(engine, args.users, "without hot-path indexes", 1)
+
+    with engine.begin() as connection:
+        migrations.add_hot_path_indexes(connection)
+        connection.execute(text("ANALYZE"))
+    after = measure(engine, args.users, "with hot-path indexes", args.heavy_repetitions)
+
+    print("\n=== p50 speed-up ===")
+    for name in before:
+        speedup = before[name]["p50_ms"] / after[name]["p50_ms"] if after[name]["p50_ms"] else float("inf")
+        print(f"{name:28s} x{speedup:8.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": args.users, "counts": counts, "before": before, "after": after}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
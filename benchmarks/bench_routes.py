@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Route planning for a day's stops
+Seeds a throwaway SQLite database, then times route_planner on two layouts:
+
+  towers   the seeded apartment blocks, no coordinates: stops are ordered by
+           block, floor and unit and cut between drivers
+  houses   every resident in a standalone house with coordinates scattered
+           over a few kilometres: one building per stop, so the tour is a
+           Hilbert ordering of thousands of points improved by 2-opt
+
+For each it reports the time to load the stops, to plan them (order and
+split), to serve the cached plan, and for houses the tour length in the
+order stops come out of the manifest, along the Hilbert curve and after
+2-opt.
+
+Usage: python benchmarks/bench_routes.py [--users 6000] [--drivers 6] [--capacity 800]
+"""
+
+import argparse
+import json
+import random
+from datetime import date
+
+from common import seed_database, temp_engine, timed
+
+from sqlalchemy import update
+from sqlalchemy.orm import sessionmaker
+
+import migrations
+import route_planner
+from db_models import User
+
+TODAY = date.today()
+
+
+def scatter_houses(engine, users, seed=7):
+    """Give every resident their own house number and a point within ~4 km"""
+    rng = random.Random(seed)
+    with engine.begin() as connection:
+        for user_id in range(1, users + 1):
+            connection.execute(update(User).where(User.id == user_id).values(
+                house_number=str(user_id),
+                address=f"{user_id} Lane {user_id % 40}, DailyDoodh Nagar",
+                latitude=12.90 + rng.random() * 0.036,
+                longitude=77.60 + rng.random() * 0.036
+            ))
+
+
+def measure(db, drivers, capacity, repetitions):
+    best = lambda fn: min(timed(fn)[0] for _ in range(repetitions))  # noqa: E731
+    stops = route_planner.load_stops(db, TODAY)
+    slots = list(range(1, drivers + 1))
+    results = {
+        "stops": len(stops),
+        "load_stops": best(lambda: route_planner.load_stops(db, TODAY)),
+        "plan": best(lambda: route_planner.plan(stops, slots, capacity)),
+    }
+    route_planner.invalidate()
+    results["plan_day (cold)"] = timed(route_planner.plan_day, db, TODAY, slots, capacity)[0]
+    results["plan_day (cached)"] = best(lambda: route_planner.plan_day(db, TODAY, slots, capacity))
+    routes = route_planner.plan_day(db, TODAY, slots, capacity)
+    results["routes"] = len(routes)
+    results["max_route_units"] = max(route["total_quantity"] for route in routes)
+    return stops, results
+
+
+def tour_lengths(stops):
+    """Metres walked visiting stops in manifest order, Hilbert order and after 2-opt"""
+    points = route_planner.project([stop["coordinates"] for stop in stops])
+    manifest_order = list(range(len(points)))
+    hilbert = route_planner.hilbert_order(points)
+    optimized = route_planner.two_opt(points, hilbert)
+    return {
+        "manifest order": route_planner.tour_length(points, manifest_order),
+        "hilbert": route_planner.tour_length(points, hilbert),
+        "hilbert + 2-opt": route_planner.tour_length(points, optimized),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=6000, help="about 85%% have a delivery on a given day")
+    parser.add_argument("--drivers", type=int, default=6)
+    parser.add_argument("--capacity", type=int, default=800, help="units per trip")
+    parser.add_argument("--repetitions", type=int, default=3, help="best of this many runs")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    engine = temp_engine("routes")
+    migrations.migrate(engine)
+    elapsed, _ = timed(seed_database, engine, args.users, TODAY)
+    print(f"Seeded {args.users} users in {elapsed:.1f}s")
+    db = sessionmaker(bind=engine)()
+
+    results = {}
+    _, results["towers"] = measure(db, args.drivers, args.capacity, args.repetitions)
+    scatter_houses(engine, args.users)
+    db.expire_all()
+    stops, results["houses"] = measure(db, args.drivers, args.capacity, args.repetitions)
+    results["houses"]["tour_metres"] = tour_lengths(stops)
+    db.close()
+
+    for layout, r in results.items():
+        print(f"\n{layout}: {r['stops']} stops -> {r['routes']} routes for {args.drivers} drivers "
+              f"(at most {r['max_route_units']} of {args.capacity} units)")
+        for name in ("load_stops", "plan", "plan_day (cold)", "plan_day (cached)"):
+            print(f"  {name:20s} {r[name] * 1000:9.1f} ms")
+        for name, metres in r.get("tour_metres", {}).items():
+            print(f"  tour, {name:15s} {metres / 1000:9.1f} km")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": args.users, "drivers": args.drivers, "capacity": args.capacity, "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
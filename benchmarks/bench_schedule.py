@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Multi-day schedule: schedule.expand vs building the manifest day by day
+Seeds a throwaway SQLite database (about 50k active subscriptions by default)
+with a mix of delivery frequencies, then times a 30-day forecast with the
+NumPy schedule engine (expansion alone, and with every day's delivery dicts)
+against manifest.build_manifest called once per day, after checking that both
+give the same deliveries on a few days.
+
+The synthetic cancellations are kept, so both sides also go through the
+cancellation exclusion index (see cancellation_index.py), and the report
+says how many subscriptions, orders and vacations they cancel.
+
+Usage: python benchmarks/bench_schedule.py [--users 59000] [--days 30]
+"""
+
+import argparse
+import json
+import random
+from datetime import date, timedelta
+
+from common import seed_database, temp_engine, timed
+
+from sqlalchemy import update
+from sqlalchemy.orm import sessionmaker
+
+import cancellation_index
+import manifest
+import migrations
+import schedule
+from db_models import Subscription
+
+TODAY = date.today()
+FREQUENCIES = ["daily"] * 6 + ["alternate", "weekly", "weekdays", "weekends", "days:mon,thu", "every_3_days"]
+
+
+def assign_frequencies(engine, seed=5):
+    """A random frequency and creation day for every subscription"""
+    rng = random.Random(seed)
+    with engine.begin() as connection:
+        ids = [row.id for row in connection.execute(Subscription.__table__.select())]
+        for subscription_id in ids:
+            connection.execute(
+                update(Subscription).where(Subscription.id == subscription_id).values(
+                    frequency=rng.choice(FREQUENCIES),
+                    created_at=TODAY - timedelta(days=rng.randint(0, 400))
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=59000, help="about 85%% get an active subscription")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--repetitions", type=int, default=3, help="best of this many runs")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    engine = temp_engine("schedule")
+    migrations.migrate(engine)
+    elapsed, counts = timed(seed_database, engine, args.users, TODAY)
+    assign_frequencies(engine)
+    db = sessionmaker(bind=engine)()
+    active = db.query(Subscription).filter(Subscription.is_active == True).count()
+    exclusions = cancellation_index.exclusions(db)
+    cancelled = {"subscriptions": len(exclusions.subscriptions), "orders": len(exclusions.orders),
+                 "vacations": len(exclusions.vacations)}
+    print(f"Seeded {args.users} users, {active} active subscriptions in {elapsed:.1f}s; cancelled: "
+          + ", ".join(f"{count} {kind}" for kind, count in cancelled.items()))
+
+    start, end = TODAY, TODAY + timedelta(days=args.days - 1)
+    forecast = schedule.expand(db, start, end)
+    for day in (start, start + timedelta(days=args.days // 2), end):
+        assert forecast.deliveries(day) == manifest.build_manifest(db, day), f"{day}: schedule differs"
+
+    def best(fn):
+        return min(timed(fn)[0] for _ in range(args.repetitions))
+
+    results = {
+        "schedule.expand": best(lambda: schedule.expand(db, start, end)),
+        "schedule.expand + manifests": best(lambda: schedule.expand(db, start, end).manifest()),
+        "build_manifest x days": best(lambda: [manifest.build_manifest(db, day) for day in forecast.days]),
+    }
+    db.close()
+
+    deliveries = sum(forecast.subscription_counts())
+    print(f"{args.days}-day forecast: {deliveries} subscription deliveries")
+    for name, seconds in results.items():
+        print(f"{name:28s} {seconds * 1000:9.1f} ms")
+    print(f"speedup (with manifests)     x{results['build_manifest x days'] / results['schedule.expand + manifests']:.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": args.users, "active_subscriptions": active, "cancelled": cancelled, "days": args.days,
+                       "deliveries": deliveries, "seconds": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Response serialization: pydantic response models vs the FAST_JSON path
+Seeds a throwaway SQLite database, then fetches every user (page by page)
+and a day's delivery manifest through the app in-process, once with the
+default response path and once with fast_json.FAST_JSON on. Checks that both
+paths return identical bytes and reports rows/sec for each.
+
+Usage: python benchmarks/bench_serialization.py [--users 10000] [--repetitions 5]
+"""
+
+import argparse
+import json
+import time
+from datetime import date
+
+# Importing common points DATABASE_URL at a throwaway database
+from common import seed_database
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import fast_json  # noqa: E402
+import main  # noqa: E402
+import migrations  # noqa: E402
+from database import engine  # noqa: E402
+
+TODAY = date.today()
+
+
+def fetch_users(client, limit):
+    """Every user, following the next-page cursors; returns (rows, raw pages)"""
+    pages, rows, url = [], 0, f"/users?limit={limit}"
+    while url:
+        response = client.get(url)
+        response.raise_for_status()
+        pages.append(response.content)
+        rows += len(response.json())
+        cursor = response.headers.get("x-next-cursor")
+        url = f"/users?limit={limit}&after={cursor}" if cursor else None
+    return rows, pages
+
+
+def fetch_deliveries(client):
+    response = client.get(f"/deliveries/{TODAY.isoformat()}")
+    response.raise_for_status()
+    return len(response.json()), [response.content]
+
+
+def measure(client, fetch, repetitions):
+    best, result = float("inf"), None
+    for _ in range(repetitions):
+        started = time.perf_counter()
+        result = fetch(client)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--repetitions", type=int, default=5, help="best of this many runs")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    migrations.migrate(engine)
+    seed_database(engine, args.users, TODAY)
+
+    client = TestClient(main.app)
+    results = {}
+    for name, fetch in (
+        ("users", lambda c: fetch_users(c, args.page_size)),
+        ("deliveries", fetch_deliveries),
+    ):
+        timings, outputs = {}, {}
+        for mode, enabled in (("pydantic", False), ("fast_json", True)):
+            fast_json.FAST_JSON = enabled
+            seconds, (rows, pages) = measure(client, fetch, args.repetitions)
+            timings[mode] = {"rows": rows, "seconds": seconds, "rows_per_sec": rows / seconds}
+            outputs[mode] = pages
+        assert outputs["pydantic"] == outputs["fast_json"], f"{name}: fast path output differs"
+        results[name] = timings
+        speedup = timings["pydantic"]["seconds"] / timings["fast_json"]["seconds"]
+        print(f"{name:10s} {timings['pydantic']['rows']:6d} rows   "
+              f"pydantic {timings['pydantic']['rows_per_sec']:9.0f} rows/s   "
+              f"fast_json {timings['fast_json']['rows_per_sec']:9.0f} rows/s   x{speedup:.1f}   (identical bytes)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": args.users, "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    run()
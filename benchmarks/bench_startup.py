@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Worker cold start: importing main.py and running its startup hook
+Migrates and seeds a throwaway SQLite database once (as `manage.py migrate`
+would), then starts fresh interpreters the way uvicorn workers start, each
+importing the app and entering its lifespan, in two configurations:
+
+  default          no database work at startup; workers are ready as soon as
+                   the code is imported
+  DATABASE_SETUP   each worker runs create_all, the migrations and the sample
+                   product check on startup, as every import of main.py used
+                   to
+
+For each it reports the time to import main.py (on top of SQLAlchemy and the
+models, which the benchmark itself loads first) and to run the startup hook,
+the SQL statements and connections they made, the whole process's time from
+spawn to ready, and the time until the last of --workers started together is
+ready.
+
+Usage: python benchmarks/bench_startup.py [--users 1000] [--workers 4] [--runs 5]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import seed_database, temp_database_url
+
+MODES = {"default": "0", "DATABASE_SETUP": "1"}
+
+
+def child():
+    """Import the app and run its startup; print the timings as JSON"""
+    started = time.perf_counter()
+    from sqlalchemy import event
+
+    import database
+
+    counts = {"statements": 0, "connections": 0}
+    event.listen(database.engine, "before_cursor_execute", lambda *args: counts.__setitem__("statements", counts["statements"] + 1))
+    event.listen(database.engine, "connect", lambda *args: counts.__setitem__("connections", counts["connections"] + 1))
+
+    import main
+    imported = time.perf_counter()
+    import_counts = dict(counts)
+
+    async def startup():
+        async with main.lifespan(main.app):
+            return time.perf_counter()
+
+    ready = asyncio.run(startup())
+    print(json.dumps({
+        "import_ms": (imported - started) * 1000,
+        "startup_ms": (ready - imported) * 1000,
+        "import_statements": import_counts["statements"],
+        "statements": counts["statements"],
+        "connections": counts["connections"],
+    }))
+    return 0
+
+
+def start_worker(url, flag):
+    """Run one child interpreter; returns its report and its wall time to ready in ms"""
+    env = dict(os.environ, DATABASE_URL=url, DATABASE_SETUP=flag, BACKGROUND_JOBS="0", PYTHONWARNINGS="ignore")
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, __file__, "--child"], env=env, check=True, capture_output=True, text=True
+    ).stdout
+    report = json.loads(output.strip().splitlines()[-1])
+    report["wall_ms"] = (time.perf_counter() - started) * 1000
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4, help="workers started together")
+    parser.add_argument("--runs", type=int, default=5, help="median of this many starts")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child()
+
+    import migrations
+    from sqlalchemy import create_engine
+
+    url = temp_database_url("startup")
+    engine = create_engine(url)
+    migrations.migrate(engine)
+    seed_database(engine, args.users)
+    engine.dispose()
+    print(f"Seeded {args.users} users into {url}")
+
+    results = {}
+    for mode, flag in MODES.items():
+        runs = [start_worker(url, flag) for _ in range(args.runs)]
+        result = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+        with ThreadPoolExecutor(args.workers) as pool:
+            started = time.perf_counter()
+            list(pool.map(lambda _: start_worker(url, flag), range(args.workers)))
+            result[f"{args.workers}_workers_ms"] = (time.perf_counter() - started) * 1000
+        results[mode] = result
+        print(f"{mode:15s} import {result['import_ms']:7.1f} ms ({result['import_statements']:.0f} SQL)  "
+              f"startup {result['startup_ms']:7.1f} ms  {result['statements']:4.0f} SQL statements, "
+              f"{result['connections']:.0f} connections  process {result['wall_ms']:7.1f} ms  "
+              f"{args.workers} workers ready in {result[f'{args.workers}_workers_ms']:7.1f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": args.users, "workers": args.workers, "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Vacation coverage lookups: indexed SQL range queries vs the in-process index
+Generates five years of synthetic vacation history (a few short breaks per
+household per year, some long absences) in a throwaway SQLite database with
+the hot-path indexes, then reports p50/p99 latency of "who is away on day D"
+and "is user U away on D" both ways, plus the time to build the index.
+
+Usage: python benchmarks/bench_vacations.py [--users 20000] [--years 5] [--lookups 2000]
+"""
+
+import argparse
+import json
+import random
+from datetime import date, timedelta
+
+from common import percentile, temp_engine, timed
+
+from sqlalchemy import insert
+from sqlalchemy.orm import sessionmaker
+
+import migrations
+import vacation_index
+from db_models import Vacation
+
+TODAY = date.today()
+
+
+def seed_vacations(engine, users, years, seed=11):
+    """Three to five short breaks per household and year, 2% long absences"""
+    rng = random.Random(seed)
+    first_day = TODAY - timedelta(days=365 * years)
+    span = 365 * years + 60
+    rows = []
+    for user_id in range(1, users + 1):
+        for _ in range(rng.randint(3, 5) * years):
+            start = first_day + timedelta(days=rng.randrange(span))
+            rows.append({"user_id": user_id, "start_date": start, "end_date": start + timedelta(days=rng.randint(0, 14))})
+        if rng.random() < 0.02:
+            start = first_day + timedelta(days=rng.randrange(span))
+            rows.append({"user_id": user_id, "start_date": start, "end_date": start + timedelta(days=rng.randint(30, 180))})
+    with engine.begin() as connection:
+        for offset in range(0, len(rows), 10000):
+            connection.execute(insert(Vacation), rows[offset:offset + 10000])
+    return len(rows), first_day
+
+
+def latency(samples):
+    return {"p50_ms": percentile(samples, 0.50) * 1000, "p99_ms": percentile(samples, 0.99) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--lookups", type=int, default=2000, help="lookups per measurement")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    engine = temp_engine("vacations")
+    migrations.migrate(engine)
+    elapsed, (count, first_day) = timed(seed_vacations, engine, args.users, args.years)
+    print(f"Seeded {count} vacations for {args.users} users over {args.years} years in {elapsed:.1f}s")
+
+    db = sessionmaker(bind=engine)()
+    rng = random.Random(3)
+    days = [first_day + timedelta(days=rng.randrange(365 * args.years)) for _ in range(args.lookups)]
+    users = [rng.randint(1, args.users) for _ in range(args.lookups)]
+
+    build_seconds, index = timed(lambda: vacation_index.VacationIndex(vacation_index._rows(db)))
+
+    def sql_away_on(day):
+        return {user_id for (user_id,) in db.query(Vacation.user_id).filter(
+            Vacation.start_date <= day, Vacation.end_date >= day)}
+
+    def sql_is_away(user_id, day):
+        return db.query(Vacation.id).filter(
+            Vacation.user_id == user_id, Vacation.start_date <= day, Vacation.end_date >= day
+        ).first() is not None
+
+    # Same answers both ways before timing anything
+    for day, user_id in list(zip(days, users))[:50]:
+        assert index.away_on(day) == sql_away_on(day)
+        assert index.is_away(user_id, day) == sql_is_away(user_id, day)
+
+    sql_days = days[:max(1, args.lookups // 10)]  # the SQL day scans are slow; fewer of them
+    results = {
+        "index build": {"seconds": build_seconds, "intervals": len(index)},
+        "away_on: SQL": latency([timed(sql_away_on, day)[0] for day in sql_days]),
+        "away_on: index": latency([timed(index.away_on, day)[0] for day in days]),
+        "is_away: SQL": latency([timed(sql_is_away, user_id, day)[0] for user_id, day in zip(users, days)]),
+        "is_away: index": latency([timed(index.is_away, user_id, day)[0] for user_id, day in zip(users, days)]),
+    }
+    db.close()
+
+    print(f"index build                 {build_seconds:.2f}s ({len(index)} merged intervals)")
+    for name, result in results.items():
+        if "p50_ms" in result:
+            print(f"{name:27s} p50 {result['p50_ms']:9.4f} ms   p99 {result['p99_ms']:9.4f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": args.users, "years": args.years, "vacations": count, "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
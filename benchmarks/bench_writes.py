@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Write throughput for signups, ad-hoc orders and subscriptions across engine configurations
+Each configuration gets a fresh database; concurrent worker threads call the
+signup and ad-hoc order endpoint functions directly, each call on its own
+session, the way the threadpool runs them under uvicorn.
+
+Usage: python benchmarks/bench_writes.py [--workers 16] [--ops 200] [--postgres-url postgresql://...]
+"""
+
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+# Importing common points DATABASE_URL at a throwaway database; main.py
+# touches it on import
+from common import temp_database_url
+
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+import main  # noqa: E402
+import migrations  # noqa: E402
+from database import create_db_engine  # noqa: E402
+from db_models import Product  # noqa: E402
+from models import OrderCreate, SubscriptionCreate, UserCreate  # noqa: E402
+
+ROLLBACK_JOURNAL = {"journal_mode": "DELETE", "synchronous": "FULL", "busy_timeout": 5000}
+WAL_FULL = {"journal_mode": "WAL", "synchronous": "FULL", "busy_timeout": 5000}
+
+# (name, pragmas or None for the environment defaults, engine overrides)
+SQLITE_CONFIGS = [
+    ("sqlite rollback journal, synchronous=FULL, pool 5", ROLLBACK_JOURNAL, {"pool_size": 5, "max_overflow": 10}),
+    ("sqlite WAL, synchronous=FULL", WAL_FULL, {}),
+    ("sqlite WAL, synchronous=NORMAL, mmap + cache (default)", None, {}),
+]
+
+
+def run_phase(session_factory, workers, ops, operation):
+    errors = 0
+
+    def worker(number):
+        nonlocal errors
+        for n in range(ops):
+            db = session_factory()
+            try:
+                operation(db, number, n)
+            except Exception:
+                errors += 1
+                db.rollback()
+            finally:
+                db.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(worker, range(workers)))
+    elapsed = time.perf_counter() - started
+    total = workers * ops
+    return {"ops": total, "errors": errors, "seconds": elapsed, "ops_per_sec": (total - errors) / elapsed}
+
+
+def signup(db, worker, n):
+    main.signup_user(UserCreate(
+        name=f"Bench {worker}-{n}", email=f"bench-{worker}-{n}@example.com", house_number=f"B-{n}"
+    ), db=db)
+
+
+def adhoc_order(db, worker, n):
+    user_id = (worker + n * 7) % 50 + 1  # among the first signups
+    main.create_adhoc_order(user_id, OrderCreate(
+        date=date.today(), items=[{"product_id": 1, "quantity": 1}, {"product_id": 2, "quantity": 2}], is_adhoc=True
+    ), db=db)
+
+
+def subscription(db, worker, n):
+    user_id = (worker + n * 7) % 50 + 1
+    main.create_or_update_subscription(user_id, SubscriptionCreate(
+        items=[{"product_id": 1, "quantity": n % 3 + 1}, {"product_id": 2, "quantity": 1}]
+    ), db=db)
+
+
+def benchmark(name, url, pragmas, overrides, workers, ops):
+    engine = create_db_engine(url, pragmas=pragmas, **overrides)
+    migrations.migrate(engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with session_factory() as db:
+        if db.query(Product).count() == 0:
+            db.add_all([Product(name="Milk", price=25.0), Product(name="Curd", price=15.0)])
+            db.commit()
+
+    results = {
+        "signups": run_phase(session_factory, workers, ops, signup),
+        "adhoc_orders": run_phase(session_factory, workers, ops, adhoc_order),
+        "subscriptions": run_phase(session_factory, workers, ops, subscription)
+    }
+    engine.dispose()
+
+    print(name)
+    for phase, r in results.items():
+        print(f"    {phase:13s} {r['ops_per_sec']:9.1f} ops/s  ({r['ops']} ops in {r['seconds']:.2f}s, {r['errors']} errors)")
+    return results
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--ops", type=int, default=200, help="operations per worker and phase")
+    parser.add_argument("--postgres-url", help="also benchmark this (empty, disposable) PostgreSQL database")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for name, pragmas, overrides in SQLITE_CONFIGS:
+        url = temp_database_url("writes")
+        results[name] = benchmark(name, url, pragmas, overrides, args.workers, args.ops)
+    if args.postgres_url:
+        name = "postgresql QueuePool (environment settings)"
+        results[name] = benchmark(name, args.postgres_url, None, {}, args.workers, args.ops)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,158 @@
+"""
+Shared helpers for the benchmark scripts: import path, throwaway databases,
+synthetic data and latency percentiles
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server")
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
+
+
+def temp_database_url(name="bench"):
+    """A SQLite file in a fresh temporary directory"""
+    directory = tempfile.mkdtemp(prefix=f"dailydoodh-{name}-")
+    return f"sqlite:///{os.path.join(directory, name + '.db')}"
+
+
+# database.py builds its engine from DATABASE_URL when first imported (by
+# db_models below); unless one was given, that is a throwaway database too,
+# never the working directory's delivery_app.db
+os.environ.setdefault("DATABASE_URL", temp_database_url("app"))
+
+from sqlalchemy import create_engine, insert  # noqa: E402
+
+from db_models import (  # noqa: E402
+    User, Product, Subscription, SubscriptionItem, Order, OrderItem, Vacation, Cancellation, DriverBlock
+)
+
+PRODUCTS = [("Milk", 25.0), ("Curd", 15.0), ("Butter", 45.0), ("Cheese", 80.0)]
+BLOCKS = [chr(ord("A") + n) for n in range(12)]
+BATCH = 10000
+
+# (weight, frequency) of active subscriptions; most households take milk daily
+FREQUENCY_MIX = [
+    (80, "daily"), (8, "alternate"), (4, "weekdays"), (3, "weekends"), (3, "weekly"), (2, "days:mon,thu")
+]
+
+
+def temp_engine(name="bench"):
+    return create_engine(temp_database_url(name), connect_args={"check_same_thread": False})
+
+
+def _insert(connection, model, rows):
+    for start in range(0, len(rows), BATCH):
+        connection.execute(insert(model), rows[start:start + BATCH])
+
+
+def seed_database(engine, users=10000, today=None, seed=42, frequencies=False, drivers=0):
+    """Fill an empty schema with `users` households and their history
+
+    Roughly: 85% of households have an active subscription of one to three
+    products (a third also have a replaced, inactive one), half have taken a
+    vacation in the last year, a third placed ad-hoc orders in the last two
+    months and a fifth have cancelled something. With frequencies=True active
+    subscriptions follow FREQUENCY_MIX from a creation day in the last year
+    (otherwise all are daily). `drivers` delivery persons are added after the
+    households, splitting the house-number blocks between them. Returns the
+    row counts.
+    """
+    rng = random.Random(seed)
+    today = today or date.today()
+    counts = {}
+
+    rows = {model: [] for model in (User, Subscription, SubscriptionItem, Order, OrderItem, Vacation, Cancellation, DriverBlock)}
+    products = [{"id": n + 1, "name": name, "price": price} for n, (name, price) in enumerate(PRODUCTS)]
+
+    for user_id in range(1, users + 1):
+        block = BLOCKS[(user_id - 1) % len(BLOCKS)]
+        rows[User].append({
+            "id": user_id,
+            "name": f"Resident {user_id}",
+            "email": f"resident{user_id}@example.com",
+            "house_number": f"{block}-{rng.randint(1, 20)}{rng.randint(1, 8):02d}",
+            "address": f"Tower {block}, DailyDoodh Residency",
+            "role": "resident"
+        })
+
+        if rng.random() < 0.3:
+            subscription_id = len(rows[Subscription]) + 1
+            subscription = {"id": subscription_id, "user_id": user_id, "frequency": "daily", "is_active": False}
+            if frequencies:
+                subscription["created_at"] = datetime.combine(today - timedelta(days=rng.randint(366, 730)), datetime.min.time())
+            rows[Subscription].append(subscription)
+            rows[SubscriptionItem].append({
+                "subscription_id": subscription_id, "product_id": 1, "quantity": rng.randint(1, 3)
+            })
+        if rng.random() < 0.85:
+            subscription_id = len(rows[Subscription]) + 1
+            subscription = {"id": subscription_id, "user_id": user_id, "frequency": "daily", "is_active": True}
+            if frequencies:
+                subscription["frequency"] = rng.choices(
+                    [name for _, name in FREQUENCY_MIX], [weight for weight, _ in FREQUENCY_MIX]
+                )[0]
+                subscription["created_at"] = datetime.combine(today - timedelta(days=rng.randint(0, 365)), datetime.min.time())
+            rows[Subscription].append(subscription)
+            for product_id in rng.sample(range(1, len(PRODUCTS) + 1), rng.choice((1, 1, 2, 3))):
+                rows[SubscriptionItem].append({
+                    "subscription_id": subscription_id, "product_id": product_id, "quantity": rng.randint(1, 3)
+                })
+
+        for _ in range(rng.choice((0, 0, 1, 1, 2))):
+            start = today - timedelta(days=rng.randint(-30, 365))
+            rows[Vacation].append({
+                "user_id": user_id, "start_date": start, "end_date": start + timedelta(days=rng.randint(0, 14))
+            })
+
+        if rng.random() < 0.33:
+            for _ in range(rng.randint(1, 4)):
+                order_id = len(rows[Order]) + 1
+                rows[Order].append({
+                    "id": order_id, "user_id": user_id, "date": today + timedelta(days=rng.randint(-60, 7)),
+                    "is_adhoc": True, "status": "pending"
+                })
+                for product_id in rng.sample(range(1, len(PRODUCTS) + 1), rng.randint(1, 2)):
+                    rows[OrderItem].append({"order_id": order_id, "product_id": product_id, "quantity": rng.randint(1, 4)})
+
+        if rng.random() < 0.2:
+            rows[Cancellation].append({
+                "user_id": user_id, "cancellation_type": rng.choice(("subscription", "order", "vacation")),
+                "reference_id": rng.randint(1, users), "reason": "Synthetic cancellation"
+            })
+
+    for n in range(drivers):
+        driver_id = users + n + 1
+        rows[User].append({
+            "id": driver_id, "name": f"Driver {n + 1}", "email": f"driver{n + 1}@example.com",
+            "house_number": "-", "address": None, "role": "delivery_person"
+        })
+        rows[DriverBlock].extend({"driver_id": driver_id, "block": block} for block in BLOCKS[n::drivers])
+
+    with engine.begin() as connection:
+        _insert(connection, Product, products)
+        for model, model_rows in rows.items():
+            _insert(connection, model, model_rows)
+            counts[model.__tablename__] = len(model_rows)
+    return counts
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def timed(fn, *args, **kwargs):
+    """(seconds, result) of one call"""
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - started, result
@@ -10,6 +10,30 @@ interface DeliveryItem {
 interface Delivery {
     user_id: number;
     items: DeliveryItem[];
+    name: string;
+    house_number: string;
+    address?: string;
+}
+
+interface RouteStop extends Delivery {
+    sequence: number;
+    block: string;
+    floor: number;
+    unit: number;
+}
+
+interface Route {
+    route: number;
+    driver_id: number | null;
+    trip: number;
+    stops: RouteStop[];
+    load: DeliveryItem[];
+    total_quantity: number;
+}
+
+interface RoutePlan {
+    date: string;
+    routes: Route[];
 }
 
 interface Product {
@@ -17,6 +41,19 @@ interface Product {
     name: string;
 }
 
+interface ProductTotal {
+    product_id: number;
+    name: string;
+    quantity: number;
+    revenue: number;
+}
+
+interface DeliverySummary {
+    products: ProductTotal[];
+    total_quantity: number;
+    total_revenue: number;
+}
+
 interface User {
     id: number;
     name: string;
@@ -30,10 +67,35 @@ interface DeliveryPersonDashboardProps {
     user?: User;
 }
 
+// Read an NDJSON response line by line as it arrives
+const fetchNdjson = async <T,>(url: string, onBatch: (rows: T[]) => void) => {
+    const response = await fetch(url);
+    if (!response.ok || !response.body) {
+        throw new Error(`Request failed: ${response.status}`);
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffered = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        buffered += decoder.decode(value, { stream: !done });
+        const lines = buffered.split('\n');
+        buffered = done ? '' : lines.pop() || '';
+        const rows = lines.filter(line => line.trim()).map(line => JSON.parse(line) as T);
+        if (rows.length > 0) {
+            onBatch(rows);
+        }
+        if (done) {
+            break;
+        }
+    }
+};
+
 const DeliveryPersonDashboard: React.FC<DeliveryPersonDashboardProps> = ({ user }) => {
     const [deliveries, setDeliveries] = useState<Delivery[]>([]);
+    const [trips, setTrips] = useState<Route[]>([]);
     const [products, setProducts] = useState<Product[]>([]);
-    const [users, setUsers] = useState<User[]>([]);
+    const [summary, setSummary] = useState<DeliverySummary | null>(null);
     const [loading, setLoading] = useState(true);
 
     useEffect(() => {
@@ -42,16 +104,27 @@ const DeliveryPersonDashboard: React.FC<DeliveryPersonDashboardProps> = ({ user
             try {
                 const today = new Date().toISOString().split('T')[0];
                 
-                // Fetch all data in parallel
-                const [deliveriesRes, productsRes, usersRes] = await Promise.all([
-                    axios.get<Delivery[]>(`/deliveries/${today}`),
+                // A driver gets their planned route, in visiting order and split
+                // into trips; without one, stream every stop as it is read
+                const received: Delivery[] = [];
+                const loadStops = user
+                    ? axios.get<RoutePlan>(`/drivers/${user.id}/route/${today}`).then(res => {
+                        setTrips(res.data.routes);
+                        setDeliveries(res.data.routes.flatMap(route => route.stops));
+                    })
+                    : fetchNdjson<Delivery>(`/deliveries/${today}/stream`, rows => {
+                        received.push(...rows);
+                        setDeliveries([...received]);
+                    });
+
+                const [productsRes, summaryRes] = await Promise.all([
                     axios.get<Product[]>('/products'),
-                    axios.get<User[]>('/users')
+                    axios.get<DeliverySummary>(`/deliveries/${today}/summary`),
+                    loadStops
                 ]);
 
-                setDeliveries(deliveriesRes.data);
                 setProducts(productsRes.data);
-                setUsers(usersRes.data);
+                setSummary(summaryRes.data);
 
             } catch (error) {
                 console.error("Error fetching data for delivery dashboard", error);
@@ -61,18 +134,11 @@ const DeliveryPersonDashboard: React.FC<DeliveryPersonDashboardProps> = ({ user
         };
 
         fetchDashboardData();
-    }, []);
+    }, [user]);
 
     const getProductById = (id: number) => products.find(p => p.id === id);
-    const getUserById = (id: number) => users.find(u => u.id === id);
 
-    const totalInventory = products.map(product => {
-        const total = deliveries.reduce((sum, delivery) => {
-            const item = delivery.items.find(i => i.product_id === product.id);
-            return sum + (item ? item.quantity : 0);
-        }, 0);
-        return { ...product, total };
-    }).filter(item => item.total > 0);
+    const totalInventory = summary ? summary.products.filter(item => item.quantity > 0) : [];
 
 
     if (loading) {
@@ -104,9 +170,9 @@ const DeliveryPersonDashboard: React.FC<DeliveryPersonDashboardProps> = ({ user
                     {totalInventory.length > 0 ? (
                         <ul className="list-group list-group-flush">
                             {totalInventory.map(item => (
-                                <li key={item.id} className="list-group-item d-flex justify-content-between align-items-center">
+                                <li key={item.product_id} className="list-group-item d-flex justify-content-between align-items-center">
                                     {item.name}
-                                    <span className="badge bg-success rounded-pill fs-6">{item.total}</span>
+                                    <span className="badge bg-success rounded-pill fs-6">{item.quantity}</span>
                                 </li>
                             ))}
                         </ul>
@@ -119,17 +185,21 @@ const DeliveryPersonDashboard: React.FC<DeliveryPersonDashboardProps> = ({ user
             <div className="card">
                 <div className="card-header">
                     <h3>🗺️ Today's Delivery Route</h3>
+                    {trips.length > 1 && (
+                        <small className="text-muted">
+                            {trips.length} trips: {trips.map(trip => `${trip.stops.length} stops, ${trip.total_quantity} units`).join(' | ')}
+                        </small>
+                    )}
                 </div>
                 <div className="card-body">
                     {deliveries.length > 0 ? (
                         <div className="accordion" id="deliveryAccordion">
-                            {deliveries.map((delivery) => {
-                                const user = getUserById(delivery.user_id);
+                            {deliveries.map((delivery, index) => {
                                 return (
                                     <div className="accordion-item" key={delivery.user_id}>
                                         <h2 className="accordion-header" id={`heading-${delivery.user_id}`}>
                                             <button className="accordion-button" type="button" data-bs-toggle="collapse" data-bs-target={`#collapse-${delivery.user_id}`} aria-expanded="true" aria-controls={`collapse-${delivery.user_id}`}>
-                                                <strong>{user ? `${user.name} - ${user.address}` : `User ID: ${delivery.user_id}`}</strong>
+                                                <strong>{`${index + 1}. ${delivery.name} - ${delivery.house_number}${delivery.address ? `, ${delivery.address}` : ''}`}</strong>
                                             </button>
                                         </h2>
                                         <div id={`collapse-${delivery.user_id}`} className="accordion-collapse collapse show" aria-labelledby={`heading-${delivery.user_id}`} data-bs-parent="#deliveryAccordion">
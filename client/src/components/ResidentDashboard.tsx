@@ -29,6 +29,15 @@ interface User {
     role: string;
 }
 
+interface Dashboard {
+    user: User;
+    products: Product[];
+    subscription: Subscription | null;
+    orders: any[];
+    vacations: any[];
+    cancellations: any[];
+}
+
 interface ResidentDashboardProps {
     user: User;
 }
@@ -47,51 +56,18 @@ const ResidentDashboard: React.FC<ResidentDashboardProps> = ({ user }) => {
     const fetchDashboardData = async () => {
         setLoading(true);
         try {
-            // Fetch products
-            const productsRes = await axios.get<Product[]>('/products');
-            setProducts(productsRes.data);
-
-            // Fetch subscription
-            try {
-                const subscriptionRes = await axios.get<Subscription>(`/users/${userId}/subscription`);
-                setSubscription(subscriptionRes.data);
-                setEditItems(subscriptionRes.data.items);
-            } catch (subscriptionError) {
-                if (axios.isAxiosError(subscriptionError) && subscriptionError.response?.status === 404) {
-                    setSubscription(null);
-                    setEditItems([]);
-                }
-            }
-
-            // Fetch orders
-            try {
-                const ordersRes = await axios.get(`/users/${userId}/orders`);
-                setOrders(ordersRes.data);
-            } catch (ordersError) {
-                console.error("Error fetching orders", ordersError);
-                setOrders([]);
-            }
-
-            // Fetch vacations
-            try {
-                const vacationsRes = await axios.get(`/users/${userId}/vacations`);
-                setVacations(vacationsRes.data);
-            } catch (vacationsError) {
-                console.error("Error fetching vacations", vacationsError);
-                setVacations([]);
-            }
-
-            // Fetch cancellations
-            try {
-                const cancellationsRes = await axios.get(`/users/${userId}/cancellations`);
-                setCancellations(cancellationsRes.data);
-            } catch (cancellationsError) {
-                console.error("Error fetching cancellations", cancellationsError);
-                setCancellations([]);
-            }
-
+            // Everything on this page in one request; the browser revalidates it
+            // with its ETag, so an unchanged dashboard comes back as a 304
+            const dashboardRes = await axios.get<Dashboard>(`/users/${userId}/dashboard`);
+            const dashboard = dashboardRes.data;
+            setProducts(dashboard.products);
+            setSubscription(dashboard.subscription);
+            setEditItems(dashboard.subscription ? dashboard.subscription.items : []);
+            setOrders(dashboard.orders);
+            setVacations(dashboard.vacations);
+            setCancellations(dashboard.cancellations);
         } catch (error) {
-            console.error("Error fetching data", error);
+            console.error("Error fetching dashboard", error);
         } finally {
             setLoading(false);
         }
@@ -0,0 +1,248 @@
+"""Archival of old orders, vacations and cancellations.
+
+Orders, order items, vacations and cancellations are kept forever, but
+nearly every read is about the last few weeks. Rows older than the archive
+horizon, the first day of the month ARCHIVE_AFTER_MONTHS months back, are
+moved out of the hot tables into archive tables of the same shape
+(orders_archive, order_items_archive, vacations_archive,
+cancellations_archive; see db_models), so the hot tables and their indexes
+only hold the recent past and the future.
+
+A month is the unit of archival: its orders (by date) with their items, the
+vacations that ended in it, and the cancellations of those orders and
+vacations are copied and deleted in one transaction, and the month is
+recorded in archived_months. Ids are kept, and an archived order or
+vacation carries its cancellation as a `cancelled` flag, so reads of the
+archive need no cancellation lookups. Subscription cancellations stay hot:
+a subscription is never archived. The row with the highest id of each hot
+table stays too, because SQLite hands a deleted highest id out again.
+
+Reads stay transparent. A read that reaches before the horizon (see
+`reaches()`) also reads the archive: the manifest, summary and schedule of
+an old day, billing of an old month and the history lists of a resident;
+the vacation index holds archived vacations too. Reads from the horizon on,
+which is all of the daily work, only touch the hot tables.
+
+The `archive_history` job (see jobs.py) runs `run()` monthly. Should
+ARCHIVE_AFTER_MONTHS be raised, the months then after the horizon are moved
+back by the next run. 0 turns archival off.
+"""
+import os
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, exists, func, insert, select
+from sqlalchemy.orm import Session, selectinload
+
+import cancellation_index
+import dashboard
+import vacation_index
+from db_models import Order, OrderItem, Vacation, Cancellation, ArchivedOrder, ArchivedOrderItem, \
+    ArchivedVacation, ArchivedCancellation, ArchivedMonth
+
+# Whole months kept in the hot tables before the current one; 0 keeps everything hot
+ARCHIVE_AFTER_MONTHS = int(os.environ.get("ARCHIVE_AFTER_MONTHS", "13"))
+
+# Ids per IN list when rows are moved
+BATCH_SIZE = 1000
+
+
+def _add_months(month: date, months: int) -> date:
+    ordinal = month.year * 12 + month.month - 1 + months
+    return date(ordinal // 12, ordinal % 12 + 1, 1)
+
+
+def horizon(today: Optional[date] = None) -> date:
+    """The first day whose rows are never archived"""
+    if ARCHIVE_AFTER_MONTHS <= 0:
+        return date.min
+    return _add_months((today or date.today()).replace(day=1), -ARCHIVE_AFTER_MONTHS)
+
+
+def reaches(start: date) -> bool:
+    """Whether a read of rows from start on must look in the archive too"""
+    return start < horizon()
+
+
+def _batches(ids: List[int]):
+    for offset in range(0, len(ids), BATCH_SIZE):
+        yield ids[offset:offset + BATCH_SIZE]
+
+
+def _copy(db: Session, source, target, condition, **computed) -> None:
+    """INSERT INTO target SELECT the columns the two share (plus computed ones) FROM source WHERE condition"""
+    names = [name for name in target.__table__.columns.keys() if name not in computed and name in source.__table__.columns]
+    columns = [source.__table__.c[name] for name in names] + [value.label(name) for name, value in computed.items()]
+    db.execute(insert(target.__table__).from_select(names + list(computed), select(*columns).where(condition)))
+
+
+def _cancelled(cancellation_type: str, reference_id_column):
+    return exists().where(Cancellation.cancellation_type == cancellation_type, Cancellation.reference_id == reference_id_column)
+
+
+def _rows_of(db: Session, order_model, vacation_model, cancellation_model, first: date, after: date,
+             keep: Dict[str, Optional[int]]):
+    """(order ids, vacation ids, cancellation ids, user ids) of a month in one set of tables"""
+    orders = [
+        (order_id, user_id) for order_id, user_id in db.query(order_model.id, order_model.user_id).filter(
+            order_model.date >= first, order_model.date < after
+        ) if order_id not in (keep.get("order"), keep.get("item_order"))
+    ]
+    vacations = [
+        (vacation_id, user_id) for vacation_id, user_id in db.query(vacation_model.id, vacation_model.user_id).filter(
+            vacation_model.end_date >= first, vacation_model.end_date < after
+        ) if vacation_id != keep.get("vacation")
+    ]
+    order_ids = [order_id for order_id, _ in orders]
+    vacation_ids = [vacation_id for vacation_id, _ in vacations]
+    cancellation_ids = []
+    for cancellation_type, ids in (("order", order_ids), ("vacation", vacation_ids)):
+        for batch in _batches(ids):
+            cancellation_ids.extend(
+                cancellation_id for (cancellation_id,) in db.query(cancellation_model.id).filter(
+                    cancellation_model.cancellation_type == cancellation_type, cancellation_model.reference_id.in_(batch)
+                ) if cancellation_id != keep.get("cancellation")
+            )
+    users = {user_id for _, user_id in orders} | {user_id for _, user_id in vacations}
+    return order_ids, vacation_ids, cancellation_ids, users
+
+
+def _record(db: Session, month: date, counts: Dict[str, int]) -> None:
+    row = db.get(ArchivedMonth, month)
+    if row is None:
+        db.add(ArchivedMonth(month=month, archived_at=datetime.now(), **counts))
+    else:
+        for name, count in counts.items():
+            setattr(row, name, getattr(row, name) + count)
+        row.archived_at = datetime.now()
+
+
+def archive_month(db: Session, month: date) -> Dict[str, int]:
+    """Move month's orders, vacations and their cancellations into the archive; commits
+
+    month must end before the horizon. Returns the number of rows moved of each kind.
+    """
+    first, after = month.replace(day=1), _add_months(month.replace(day=1), 1)
+    if after > horizon():
+        raise ValueError(f"{first:%Y-%m} is not before the archive horizon {horizon()}")
+    top = {name: db.query(func.max(model.id)).scalar() for name, model in (
+        ("order", Order), ("item", OrderItem), ("vacation", Vacation), ("cancellation", Cancellation)
+    )}
+    top["item_order"] = db.query(OrderItem.order_id).filter(OrderItem.id == top["item"]).scalar()
+    order_ids, vacation_ids, cancellation_ids, users = _rows_of(db, Order, Vacation, Cancellation, first, after, top)
+
+    for batch in _batches(order_ids):
+        _copy(db, Order, ArchivedOrder, Order.id.in_(batch), cancelled=_cancelled("order", Order.id))
+        _copy(db, OrderItem, ArchivedOrderItem, OrderItem.order_id.in_(batch))
+    for batch in _batches(vacation_ids):
+        _copy(db, Vacation, ArchivedVacation, Vacation.id.in_(batch), cancelled=_cancelled("vacation", Vacation.id))
+    for batch in _batches(cancellation_ids):
+        _copy(db, Cancellation, ArchivedCancellation, Cancellation.id.in_(batch))
+        db.execute(delete(Cancellation).where(Cancellation.id.in_(batch)))
+    for batch in _batches(order_ids):
+        db.execute(delete(OrderItem).where(OrderItem.order_id.in_(batch)))
+        db.execute(delete(Order).where(Order.id.in_(batch)))
+    for batch in _batches(vacation_ids):
+        db.execute(delete(Vacation).where(Vacation.id.in_(batch)))
+
+    counts = {"orders": len(order_ids), "vacations": len(vacation_ids), "cancellations": len(cancellation_ids)}
+    if any(counts.values()):
+        _record(db, first, counts)
+        # The residents' dashboards list their latest orders and vacations
+        dashboard.touch(db, users)
+    db.commit()
+    return counts
+
+
+def restore_month(db: Session, month: date) -> Dict[str, int]:
+    """Move an archived month's rows back into the hot tables; commits"""
+    first, after = month.replace(day=1), _add_months(month.replace(day=1), 1)
+    order_ids, vacation_ids, cancellation_ids, users = _rows_of(
+        db, ArchivedOrder, ArchivedVacation, ArchivedCancellation, first, after, {}
+    )
+    for batch in _batches(order_ids):
+        _copy(db, ArchivedOrder, Order, ArchivedOrder.id.in_(batch))
+        _copy(db, ArchivedOrderItem, OrderItem, ArchivedOrderItem.order_id.in_(batch))
+        db.execute(delete(ArchivedOrderItem).where(ArchivedOrderItem.order_id.in_(batch)))
+        db.execute(delete(ArchivedOrder).where(ArchivedOrder.id.in_(batch)))
+    for batch in _batches(vacation_ids):
+        _copy(db, ArchivedVacation, Vacation, ArchivedVacation.id.in_(batch))
+        db.execute(delete(ArchivedVacation).where(ArchivedVacation.id.in_(batch)))
+    for batch in _batches(cancellation_ids):
+        _copy(db, ArchivedCancellation, Cancellation, ArchivedCancellation.id.in_(batch))
+        db.execute(delete(ArchivedCancellation).where(ArchivedCancellation.id.in_(batch)))
+    db.execute(delete(ArchivedMonth).where(ArchivedMonth.month == first))
+    dashboard.touch(db, users)
+    db.commit()
+    return {"orders": len(order_ids), "vacations": len(vacation_ids), "cancellations": len(cancellation_ids)}
+
+
+def run(db: Session, today: Optional[date] = None) -> dict:
+    """Archive every month before the horizon that has hot rows, and restore archived months from it on
+
+    Each month is moved in its own transaction. Returns the horizon and the
+    rows moved per month ("YYYY-MM").
+    """
+    limit = horizon(today)
+    restored = {}
+    for (month,) in db.query(ArchivedMonth.month).filter(ArchivedMonth.month >= limit).order_by(ArchivedMonth.month).all():
+        restored[f"{month:%Y-%m}"] = restore_month(db, month)
+
+    archived = {}
+    oldest = [value for value in (
+        db.query(func.min(Order.date)).filter(Order.date < limit).scalar(),
+        db.query(func.min(Vacation.end_date)).filter(Vacation.end_date < limit).scalar()
+    ) if value is not None]
+    if oldest:
+        month = min(oldest).replace(day=1)
+        while month < limit:
+            counts = archive_month(db, month)
+            if any(counts.values()):
+                archived[f"{month:%Y-%m}"] = counts
+            month = _add_months(month, 1)
+
+    if archived or restored:
+        # Drop cancellations that moved, and pick up restored ones below the loaded ids
+        cancellation_index.invalidate()
+        vacation_index.invalidate()
+    return {"horizon": limit, "archived": archived, "restored": restored}
+
+
+# Reads
+
+def on_vacation(user_id_column, day):
+    """Correlated EXISTS that is true when an archived, uncancelled vacation covers day"""
+    return exists().where(
+        ArchivedVacation.user_id == user_id_column,
+        ArchivedVacation.start_date <= day,
+        ArchivedVacation.end_date >= day,
+        ArchivedVacation.cancelled == False
+    )
+
+
+def vacation_rows(db: Session, first: date, last: date):
+    """Query of (id, user_id, start_date, end_date) of the archived, uncancelled vacations overlapping [first, last]"""
+    return db.query(
+        ArchivedVacation.id, ArchivedVacation.user_id, ArchivedVacation.start_date, ArchivedVacation.end_date
+    ).filter(
+        ArchivedVacation.start_date <= last, ArchivedVacation.end_date >= first, ArchivedVacation.cancelled == False
+    )
+
+
+# Items and their products of a page of archived orders, in two queries
+ORDER_LOADS = selectinload(ArchivedOrder.items).selectinload(ArchivedOrderItem.product)
+
+
+def orders_of(db: Session, model, user_id: int, start_date: Optional[date] = None, end_date: Optional[date] = None,
+              status: Optional[str] = None, is_adhoc: Optional[bool] = None):
+    """Query of user_id's orders in model (Order or ArchivedOrder), filtered as GET /users/{id}/orders is"""
+    query = db.query(model).filter(model.user_id == user_id)
+    if start_date:
+        query = query.filter(model.date >= start_date)
+    if end_date:
+        query = query.filter(model.date <= end_date)
+    if status:
+        query = query.filter(model.status == status)
+    if is_adhoc is not None:
+        query = query.filter(model.is_adhoc == is_adhoc)
+    return query
@@ -0,0 +1,457 @@
+"""Async versions of the API endpoints.
+
+Enabled with DATABASE_ASYNC=1: `install(app)` swaps every sync route in
+main.py for the async one with the same path and method, so handlers wait on
+the database without holding a threadpool worker. Simple lookups are written
+with native async queries, and light shared helpers run through
+`AsyncSession.run_sync`, which runs them on the event loop. The CPU-bound
+ones (manifest, summary, schedule, route planning, billing, delivery syncs
+and bulk imports) run in the threadpool on a sync session from `get_db`,
+since on the loop they would stall every other request for their whole run.
+Relationships that the response models include are eager-loaded, since lazy
+loads cannot be awaited during serialization.
+"""
+from datetime import date
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from fastapi.routing import APIRoute
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+from starlette.concurrency import run_in_threadpool
+
+import archive
+import billing
+import bulk_import
+import catalog
+import dashboard
+import delivery_status
+import fast_json
+import inventory
+import jobs
+import manifest_store
+import pagination
+import route_planner
+import routing
+import schedule
+import vacation_index
+import writes
+from database import get_async_db, get_db, SessionLocal
+from db_models import User as DBUser, Product as DBProduct, Subscription as DBSubscription, \
+    SubscriptionItem as DBSubscriptionItem, Order as DBOrder, OrderItem as DBOrderItem, \
+    Vacation as DBVacation, Cancellation as DBCancellation, Invoice as DBInvoice, Job as DBJob, \
+    ArchivedOrder, ArchivedVacation, ArchivedCancellation
+from models import (
+    User, UserLogin, UserCreate, Product, Subscription, SubscriptionCreate,
+    Order, OrderCreate, Vacation, VacationCreate, Cancellation, CancellationCreate, DriverBlocks,
+    DeliverySummary, ImportResult, DeliverySyncResult, DeliveryStatus, Dashboard, AwayStatus, AwayUsers, Invoice, Job, JobCreate
+)
+
+router = APIRouter()
+
+SUBSCRIPTION_LOADS = selectinload(DBSubscription.items).selectinload(DBSubscriptionItem.product)
+ORDER_LOADS = selectinload(DBOrder.items).selectinload(DBOrderItem.product)
+INVOICE_LOADS = selectinload(DBInvoice.lines)
+
+
+def install(app: FastAPI) -> None:
+    """Replace the app's sync routes with the async versions in this module"""
+    replaced = {(route.path, method) for route in router.routes for method in route.methods}
+    app.router.routes = [
+        route for route in app.router.routes
+        if not (isinstance(route, APIRoute) and any((route.path, method) in replaced for method in route.methods))
+    ]
+    app.include_router(router)
+
+
+async def _get_user_or_404(db: AsyncSession, user_id: int) -> DBUser:
+    user = await db.get(DBUser, user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+
+@router.get("/")
+async def read_root():
+    return {"message": "Welcome to DailyDoodh API"}
+
+# User login endpoint
+@router.post("/login", response_model=User)
+async def login_user(login_data: UserLogin, db: AsyncSession = Depends(get_async_db)):
+    user = await db.scalar(select(DBUser).where(DBUser.email == login_data.email))
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+async def _signup(db: AsyncSession, user_data: UserCreate, **extra) -> DBUser:
+    existing_user = await db.scalar(select(DBUser.id).where(DBUser.email == user_data.email))
+    if existing_user:
+        raise HTTPException(status_code=400, detail="Email already registered")
+
+    db_user = DBUser(**user_data.dict(), **extra)
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user
+
+# User signup endpoint
+@router.post("/signup", response_model=User)
+async def signup_user(user_data: UserCreate, db: AsyncSession = Depends(get_async_db)):
+    return await _signup(db, user_data)
+
+# Delivery person signup endpoint
+@router.post("/signup-delivery", response_model=User)
+async def signup_delivery_person(user_data: UserCreate, db: AsyncSession = Depends(get_async_db)):
+    return await _signup(db, user_data, role="delivery_person")
+
+# Product endpoints
+@router.get("/products", response_model=List[Product])
+async def get_products(request: Request, response: Response, db: AsyncSession = Depends(get_async_db)):
+    snapshot = catalog.cached() or await db.run_sync(catalog.snapshot)
+    if catalog.etag_matches(request.headers.get("if-none-match"), snapshot.etag):
+        return Response(status_code=304, headers={"ETag": snapshot.etag})
+    response.headers["ETag"] = snapshot.etag
+    return snapshot.products
+
+@router.get("/products/cache")
+async def get_product_cache_stats():
+    return catalog.stats()
+
+@router.post("/products", response_model=Product)
+async def create_product(product: Product, db: AsyncSession = Depends(get_async_db)):
+    db_product = DBProduct(**product.dict(exclude={'id'}))
+    db.add(db_product)
+    await db.commit()
+    catalog.invalidate()
+    await db.refresh(db_product)
+    return db_product
+
+# User endpoints
+@router.get("/users", response_model=List[User])
+async def get_users(
+    request: Request,
+    response: Response,
+    role: Optional[str] = None,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(get_async_db)
+):
+    def users_page(session):
+        query = session.query(DBUser)
+        if role:
+            query = query.filter(DBUser.role == role)
+        return pagination.paginate(query, DBUser, [DBUser.id], page, request, response, schema=User)
+    return await db.run_sync(users_page)
+
+@router.get("/users/{user_id}", response_model=User)
+async def get_user(user_id: int, db: AsyncSession = Depends(get_async_db)):
+    return await _get_user_or_404(db, user_id)
+
+# Resident dashboard
+@router.get("/users/{user_id}/dashboard", response_model=Dashboard)
+async def get_dashboard(user_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_async_db)):
+    if_none_match = request.headers.get("if-none-match")
+    etag = await db.run_sync(lambda session: dashboard.not_modified(session, user_id, if_none_match))
+    if etag is not None:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": dashboard.CACHE_CONTROL})
+    data = await db.run_sync(lambda session: dashboard.load(session, user_id))
+    if data is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    response.headers["ETag"] = data.pop("etag")
+    response.headers["Cache-Control"] = dashboard.CACHE_CONTROL
+    return data
+
+# Subscription endpoints
+@router.get("/users/{user_id}/subscription", response_model=Subscription)
+async def get_subscription(user_id: int, db: AsyncSession = Depends(get_async_db)):
+    subscription = await db.scalar(
+        select(DBSubscription).where(
+            DBSubscription.user_id == user_id,
+            DBSubscription.is_active == True
+        ).options(SUBSCRIPTION_LOADS).limit(1)
+    )
+    if subscription is None:
+        raise HTTPException(status_code=404, detail="Active subscription not found")
+    return subscription
+
+@router.post("/users/{user_id}/subscription", response_model=Subscription)
+async def create_or_update_subscription(user_id: int, subscription_data: SubscriptionCreate, db: AsyncSession = Depends(get_async_db)):
+    await _get_user_or_404(db, user_id)
+    subscription = await db.run_sync(lambda session: writes.create_subscription(session, user_id, subscription_data))
+    await db.commit()
+    return subscription
+
+# Vacation endpoints
+@router.get("/users/{user_id}/vacations", response_model=List[Vacation])
+async def get_vacations(
+    user_id: int,
+    request: Request,
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await db.run_sync(lambda session: pagination.paginate(
+        session.query(DBVacation).filter(DBVacation.user_id == user_id),
+        DBVacation, [DBVacation.start_date, DBVacation.id], page, request, response, schema=Vacation,
+        archived=session.query(ArchivedVacation).filter(ArchivedVacation.user_id == user_id)
+    ))
+
+@router.post("/users/{user_id}/vacations", response_model=Vacation)
+async def add_vacation(user_id: int, vacation_data: VacationCreate, db: AsyncSession = Depends(get_async_db)):
+    await _get_user_or_404(db, user_id)
+
+    db_vacation = DBVacation(
+        user_id=user_id,
+        start_date=vacation_data.start_date,
+        end_date=vacation_data.end_date
+    )
+    db.add(db_vacation)
+    await db.run_sync(lambda session: manifest_store.refresh_users(
+        session, [user_id], vacation_data.start_date, vacation_data.end_date
+    ))
+    await db.run_sync(lambda session: dashboard.touch(session, [user_id]))
+    await db.commit()
+    await db.run_sync(lambda session: vacation_index.refresh_users(session, [user_id]))
+    await db.refresh(db_vacation)
+    return db_vacation
+
+@router.get("/users/{user_id}/vacations/{on_date}", response_model=AwayStatus)
+async def get_away_status(user_id: int, on_date: date, db: AsyncSession = Depends(get_async_db)):
+    away = await db.run_sync(lambda session: vacation_index.is_away(session, user_id, on_date))
+    return {"user_id": user_id, "date": on_date, "away": away}
+
+@router.get("/vacations/{on_date}", response_model=AwayUsers)
+async def get_users_away(on_date: date, db: AsyncSession = Depends(get_async_db)):
+    away = await db.run_sync(lambda session: vacation_index.away_on(session, on_date))
+    return {"date": on_date, "user_ids": sorted(away)}
+
+# Order endpoints
+@router.get("/users/{user_id}/orders", response_model=List[Order])
+async def get_orders(
+    user_id: int,
+    request: Request,
+    response: Response,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    status: Optional[str] = None,
+    is_adhoc: Optional[bool] = None,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(get_async_db)
+):
+    def orders_page(session):
+        query = archive.orders_of(session, DBOrder, user_id, start_date, end_date, status, is_adhoc)
+        archived = None
+        if start_date is None or archive.reaches(start_date):
+            archived = archive.orders_of(session, ArchivedOrder, user_id, start_date, end_date, status, is_adhoc)
+        return pagination.paginate(
+            query, DBOrder, [DBOrder.date, DBOrder.id], page, request, response, options=[ORDER_LOADS],
+            archived=archived, archived_options=[archive.ORDER_LOADS]
+        )
+    return await db.run_sync(orders_page)
+
+@router.post("/users/{user_id}/orders", response_model=Order)
+async def create_adhoc_order(user_id: int, order_data: OrderCreate, db: AsyncSession = Depends(get_async_db)):
+    await _get_user_or_404(db, user_id)
+    order = await db.run_sync(lambda session: writes.create_order(session, user_id, order_data))
+    await db.commit()
+    return order
+
+# Cancellation endpoints
+@router.get("/users/{user_id}/cancellations", response_model=List[Cancellation])
+async def get_cancellations(
+    user_id: int,
+    request: Request,
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await db.run_sync(lambda session: pagination.paginate(
+        session.query(DBCancellation).filter(DBCancellation.user_id == user_id),
+        DBCancellation, [DBCancellation.id], page, request, response, schema=Cancellation,
+        archived=session.query(ArchivedCancellation).filter(ArchivedCancellation.user_id == user_id)
+    ))
+
+@router.post("/users/{user_id}/cancellations", response_model=Cancellation)
+async def create_cancellation(user_id: int, cancellation_data: CancellationCreate, db: AsyncSession = Depends(get_async_db)):
+    await _get_user_or_404(db, user_id)
+
+    db_cancellation = await db.run_sync(lambda session: writes.create_cancellation(session, user_id, cancellation_data))
+    await db.commit()
+    if db_cancellation.cancellation_type == "vacation":
+        await db.run_sync(lambda session: vacation_index.refresh_users(session, [user_id]))
+    await db.refresh(db_cancellation)
+    return db_cancellation
+
+# Invoice endpoints
+@router.get("/users/{user_id}/invoices", response_model=List[Invoice])
+async def get_invoices(
+    user_id: int,
+    request: Request,
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(get_async_db)
+):
+    def invoices_page(session):
+        query = session.query(DBInvoice).filter(DBInvoice.user_id == user_id)
+        return pagination.paginate(
+            query, DBInvoice, [DBInvoice.month, DBInvoice.id], page, request, response, options=[INVOICE_LOADS]
+        )
+    return await db.run_sync(invoices_page)
+
+@router.get("/users/{user_id}/invoices/{month}", response_model=Invoice)
+async def get_invoice(user_id: int, month: str, db: Session = Depends(get_db)):
+    first = billing.parse_month(month)
+
+    def invoice():
+        if db.get(DBUser, user_id) is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return billing.get_invoice(db, user_id, first)
+    return await run_in_threadpool(invoice)
+
+# Delivery endpoints
+@router.get("/deliveries/{delivery_date}")
+async def get_daily_deliveries(delivery_date: date, db: Session = Depends(get_db)):
+    deliveries = await run_in_threadpool(lambda: manifest_store.get_deliveries(db, delivery_date))
+    if fast_json.FAST_JSON:
+        return fast_json.FastJSONResponse(deliveries)
+    return deliveries
+
+@router.get("/deliveries/{delivery_date}/summary", response_model=DeliverySummary)
+async def get_delivery_summary(delivery_date: date, end_date: Optional[date] = None, db: Session = Depends(get_db)):
+    end_date = end_date or delivery_date
+    if end_date < delivery_date:
+        raise HTTPException(status_code=400, detail="end_date must not be before the delivery date")
+    if (end_date - delivery_date).days >= inventory.MAX_SUMMARY_DAYS:
+        raise HTTPException(status_code=400, detail=f"Summaries cover at most {inventory.MAX_SUMMARY_DAYS} days")
+    return await run_in_threadpool(lambda: inventory.summarize(db, delivery_date, end_date))
+
+@router.get("/deliveries/{delivery_date}/schedule")
+async def get_delivery_schedule(delivery_date: date, days: int = Query(7, ge=1), db: Session = Depends(get_db)):
+    if days > schedule.MAX_SCHEDULE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Schedules cover at most {schedule.MAX_SCHEDULE_DAYS} days")
+    end_date = date.fromordinal(delivery_date.toordinal() + days - 1)
+    content = await run_in_threadpool(lambda: schedule.expand(db, delivery_date, end_date).as_dict())
+    return fast_json.FastJSONResponse(content)
+
+@router.get("/deliveries/{delivery_date}/stream")
+async def stream_daily_deliveries(
+    delivery_date: date,
+    driver_id: Optional[int] = None,
+    block: Optional[List[str]] = Query(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    blocks = None
+    if block:
+        blocks = {b.strip().upper() for b in block}
+    elif driver_id is not None:
+        blocks = await db.run_sync(lambda session: routing.driver_blocks(session, driver_id)) or None
+    # The cursor-backed generator is sync; Starlette iterates it in its threadpool
+    return StreamingResponse(
+        manifest_store.ndjson_stream(SessionLocal, delivery_date, blocks), media_type="application/x-ndjson"
+    )
+
+@router.get("/deliveries/{delivery_date}/routes")
+async def get_delivery_routes(
+    delivery_date: date,
+    drivers: Optional[int] = Query(None, ge=1),
+    capacity: Optional[int] = Query(None, ge=1),
+    product_capacity: Optional[List[str]] = Query(None),
+    db: Session = Depends(get_db)
+):
+    limits = route_planner.parse_product_capacity(product_capacity)
+    content = await run_in_threadpool(lambda: route_planner.day_plan(db, delivery_date, drivers, capacity, limits))
+    return fast_json.FastJSONResponse(content)
+
+# Route partitioning endpoints
+@router.get("/drivers/{driver_id}/route/{delivery_date}")
+async def get_driver_route(
+    driver_id: int,
+    delivery_date: date,
+    capacity: Optional[int] = Query(None, ge=1),
+    product_capacity: Optional[List[str]] = Query(None),
+    db: Session = Depends(get_db)
+):
+    limits = route_planner.parse_product_capacity(product_capacity)
+    plan = await run_in_threadpool(
+        lambda: route_planner.driver_route(db, delivery_date, driver_id, capacity, limits)
+    )
+    if plan is None:
+        raise HTTPException(status_code=404, detail="Delivery person not found")
+    return fast_json.FastJSONResponse(plan)
+
+@router.get("/drivers/{driver_id}/blocks", response_model=DriverBlocks)
+async def get_driver_blocks(driver_id: int, db: AsyncSession = Depends(get_async_db)):
+    blocks = await db.run_sync(lambda session: routing.driver_blocks(session, driver_id))
+    return {"blocks": sorted(blocks)}
+
+@router.put("/drivers/{driver_id}/blocks", response_model=DriverBlocks)
+async def set_driver_blocks(driver_id: int, assignment: DriverBlocks, db: AsyncSession = Depends(get_async_db)):
+    driver = await db.get(DBUser, driver_id)
+    if not driver or driver.role != "delivery_person":
+        raise HTTPException(status_code=404, detail="Delivery person not found")
+
+    blocks = await db.run_sync(lambda session: routing.set_driver_blocks(session, driver_id, assignment.blocks))
+    await db.commit()
+    return {"blocks": sorted(blocks)}
+
+# Delivery status endpoints
+@router.post("/drivers/{driver_id}/deliveries", response_model=DeliverySyncResult)
+async def sync_delivery_updates(driver_id: int, request: Request, db: Session = Depends(get_db)):
+    rows, errors = await bulk_import.request_rows(request)
+    return await run_in_threadpool(lambda: delivery_status.apply_updates(db, driver_id, rows, errors))
+
+@router.get("/deliveries/{delivery_date}/status", response_model=List[DeliveryStatus])
+async def get_delivery_status(delivery_date: date, driver_id: Optional[int] = None, db: AsyncSession = Depends(get_async_db)):
+    return await db.run_sync(lambda session: delivery_status.day_status(session, delivery_date, driver_id))
+
+# Background job endpoints
+@router.get("/jobs", response_model=List[Job])
+async def get_jobs(
+    request: Request,
+    response: Response,
+    status: Optional[str] = None,
+    name: Optional[str] = None,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(get_async_db)
+):
+    def jobs_page(session):
+        query = session.query(DBJob)
+        if status:
+            query = query.filter(DBJob.status == status)
+        if name:
+            query = query.filter(DBJob.name == name)
+        return pagination.paginate(query, DBJob, [DBJob.id], page, request, response, schema=Job)
+    return await db.run_sync(jobs_page)
+
+@router.get("/jobs/{job_id}", response_model=Job)
+async def get_job(job_id: int, db: AsyncSession = Depends(get_async_db)):
+    job = await db.get(DBJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.post("/jobs", response_model=Job)
+async def enqueue_job(job_data: JobCreate, db: AsyncSession = Depends(get_async_db)):
+    try:
+        return await db.run_sync(lambda session: jobs.enqueue(session, **job_data.dict()))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Bulk import endpoints
+@router.post("/import/users", response_model=ImportResult)
+async def import_users(request: Request, role: str = "resident", db: Session = Depends(get_db)):
+    if role not in ("resident", "delivery_person"):
+        raise HTTPException(status_code=400, detail="role must be resident or delivery_person")
+    rows, errors = await bulk_import.request_rows(request)
+    return await run_in_threadpool(lambda: bulk_import.import_users(db, rows, role, errors))
+
+@router.post("/import/subscriptions", response_model=ImportResult)
+async def import_subscriptions(request: Request, db: Session = Depends(get_db)):
+    rows, errors = await bulk_import.request_rows(request)
+    return await run_in_threadpool(lambda: bulk_import.import_subscriptions(db, rows, errors))
+
+@router.post("/import/vacations", response_model=ImportResult)
+async def import_vacations(request: Request, db: Session = Depends(get_db)):
+    rows, errors = await bulk_import.request_rows(request)
+    return await run_in_threadpool(lambda: bulk_import.import_vacations(db, rows, errors))
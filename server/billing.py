@@ -0,0 +1,173 @@
+"""Monthly invoices.
+
+A month is billed in one set-based pass per range of user ids: the
+schedule engine's history mode (see schedule.py) expands every subscription
+in force during the month over its days, minus vacations and cancellations,
+and adds the month's ad-hoc orders; the per-user, per-product quantities are
+then priced from the catalog. Each invoice is stored with its lines, and
+every line keeps the product's name and unit price as billed, so a
+finished month is read back rather than recomputed, and later price or
+subscription changes do not alter old bills.
+
+`run()` bills a month with worker processes, each taking user id ranges
+(BILLING_PARTITIONS per worker, of about equal size) and writing its
+invoices in one transaction per range. Users who already have an invoice
+for the month are skipped unless replace=True; users with nothing delivered
+get no invoice.
+"""
+import calendar
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session, sessionmaker
+
+import schedule
+from database import create_db_engine
+from db_models import User, Product, Invoice as DBInvoice, InvoiceLine as DBInvoiceLine
+from models import Invoice, InvoiceLine
+
+# User id ranges per worker process, so a slow range does not hold up the rest
+BILLING_PARTITIONS = int(os.environ.get("BILLING_PARTITIONS", "4"))
+
+_MONTH = re.compile(r"^(\d{4})-(\d{2})$")
+
+Prices = Dict[int, Tuple[str, float]]  # product_id -> (name, unit price)
+UserRange = Tuple[int, int]  # [low, high) user ids
+
+
+def parse_month(value: str) -> date:
+    """The first day of a "YYYY-MM" month; 400 when malformed"""
+    match = _MONTH.match(value)
+    if not match or not 1 <= int(match.group(2)) <= 12:
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def month_bounds(month: date) -> Tuple[date, date]:
+    """First and last day of the month containing month"""
+    return month.replace(day=1), month.replace(day=calendar.monthrange(month.year, month.month)[1])
+
+
+def prices(db: Session) -> Prices:
+    """Current product names and prices, read from the table rather than the catalog cache"""
+    return {row.id: (row.name, row.price) for row in db.query(Product.id, Product.name, Product.price)}
+
+
+def _invoice(stored: DBInvoice) -> Invoice:
+    return Invoice(
+        id=stored.id, user_id=stored.user_id, month=stored.month, total_quantity=stored.total_quantity,
+        total_amount=stored.total_amount, created_at=stored.created_at,
+        lines=[
+            InvoiceLine(product_id=line.product_id, product_name=line.product_name, unit_price=line.unit_price,
+                        quantity=line.quantity, amount=line.amount)
+            for line in stored.lines
+        ]
+    )
+
+
+def compute(db: Session, month: date, prices: Prices, user_ids: Optional[List[int]] = None,
+            user_range: Optional[UserRange] = None) -> Dict[int, Invoice]:
+    """Unsaved invoices for month, by user id, for the given users"""
+    first, last = month_bounds(month)
+    totals = schedule.expand(db, first, last, user_ids, user_range, history=True).user_product_totals()
+
+    lines: Dict[int, List[InvoiceLine]] = {}
+    for (user_id, product_id), quantity in sorted(totals.items()):
+        name, unit_price = prices.get(product_id, (f"Product {product_id}", 0.0))
+        lines.setdefault(user_id, []).append(InvoiceLine(
+            product_id=product_id, product_name=name, unit_price=unit_price,
+            quantity=quantity, amount=round(quantity * unit_price, 2)
+        ))
+    return {
+        user_id: Invoice(
+            user_id=user_id, month=first, lines=user_lines,
+            total_quantity=sum(line.quantity for line in user_lines),
+            total_amount=round(sum(line.amount for line in user_lines), 2)
+        )
+        for user_id, user_lines in lines.items()
+    }
+
+
+def save(db: Session, invoices: List[Invoice]) -> None:
+    """Insert invoices and their lines in two statements; the caller commits"""
+    if not invoices:
+        return
+    ids = db.scalars(
+        insert(DBInvoice).returning(DBInvoice.id, sort_by_parameter_order=True),
+        [invoice.dict(include={"user_id", "month", "total_quantity", "total_amount"}) for invoice in invoices]
+    ).all()
+    db.execute(insert(DBInvoiceLine), [
+        {"invoice_id": invoice_id, **line.dict()}
+        for invoice_id, invoice in zip(ids, invoices) for line in invoice.lines
+    ])
+
+
+def bill_range(db: Session, month: date, prices: Prices, user_range: UserRange, replace: bool = False) -> int:
+    """Bill month for users in user_range and commit; returns the invoices written"""
+    first = month.replace(day=1)
+    invoices = compute(db, first, prices, user_range=user_range)
+    in_range = (DBInvoice.month == first, DBInvoice.user_id >= user_range[0], DBInvoice.user_id < user_range[1])
+    if replace:
+        billed = select(DBInvoice.id).where(*in_range)
+        db.execute(delete(DBInvoiceLine).where(DBInvoiceLine.invoice_id.in_(billed)))
+        db.execute(delete(DBInvoice).where(*in_range))
+    else:
+        for user_id in db.scalars(select(DBInvoice.user_id).where(*in_range)):
+            invoices.pop(user_id, None)
+    save(db, list(invoices.values()))
+    db.commit()
+    return len(invoices)
+
+
+def user_ranges(db: Session, partitions: int) -> List[UserRange]:
+    """Split the user ids into at most `partitions` ranges of about equal size"""
+    ids = db.scalars(select(User.id).order_by(User.id)).all()
+    if not ids:
+        return []
+    size = -(-len(ids) // max(partitions, 1))
+    bounds = ids[::size] + [ids[-1] + 1]
+    return list(zip(bounds, bounds[1:]))
+
+
+def _bill_partition(database_url: str, month: date, prices: Prices, user_range: UserRange, replace: bool) -> int:
+    """bill_range in a worker process, on its own engine"""
+    engine = create_db_engine(database_url)
+    try:
+        with sessionmaker(bind=engine)() as db:
+            return bill_range(db, month, prices, user_range, replace)
+    finally:
+        engine.dispose()
+
+
+def run(db: Session, month: date, workers: int = 1, replace: bool = False) -> int:
+    """Bill month for every user, in `workers` processes; returns the invoices written
+
+    With one worker everything runs in this process on db.
+    """
+    month_prices = prices(db)
+    ranges = user_ranges(db, max(workers, 1) * BILLING_PARTITIONS)
+    if workers <= 1:
+        return sum(bill_range(db, month, month_prices, user_range, replace) for user_range in ranges)
+
+    database_url = db.get_bind().url.render_as_string(hide_password=False)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_bill_partition, database_url, month, month_prices, user_range, replace)
+            for user_range in ranges
+        ]
+        return sum(future.result() for future in futures)
+
+
+def get_invoice(db: Session, user_id: int, month: date) -> Invoice:
+    """The stored invoice for month, or, for a month not billed yet, a preview computed now"""
+    first = month.replace(day=1)
+    stored = db.query(DBInvoice).filter(DBInvoice.user_id == user_id, DBInvoice.month == first).first()
+    if stored is not None:
+        return _invoice(stored)
+    preview = compute(db, first, prices(db), user_ids=[user_id]).get(user_id)
+    return preview or Invoice(user_id=user_id, month=first, total_quantity=0, total_amount=0.0, lines=[])
@@ -0,0 +1,320 @@
+"""Bulk import of residents, subscriptions and vacations.
+
+Onboarding a complex through /signup and /users/{id}/subscription costs a
+round trip, an existence check and one or two commits per resident. The
+importers here take a whole file at once (a JSON array, NDJSON or CSV),
+validate every row with the same pydantic models as the single-row
+endpoints, and write in batches of BATCH_SIZE rows: one IN query per batch
+for the existence checks, executemany inserts and one commit. A row that
+fails validation or a check is reported back by number and left out; the
+rest of the file is still imported.
+
+Rows name their resident by `user_id` or `email`. Subscription rows carry
+either an `items` list or a single `product_id` / `quantity` pair; flat rows
+for the same resident (one CSV line per product) are merged into one
+subscription, which replaces the resident's active one.
+"""
+import csv
+import io
+import json
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+import catalog
+import dashboard
+import frequency
+import manifest_store
+import vacation_index
+from db_models import User, Subscription, SubscriptionItem, Vacation
+from models import UserCreate, SubscriptionCreate, VacationCreate
+
+# Rows written per transaction
+BATCH_SIZE = 1000
+
+Row = Tuple[int, dict]  # (1-based row number, fields)
+
+
+class ImportFormatError(ValueError):
+    """The request body cannot be read as the declared format"""
+
+
+def parse_rows(body: bytes, content_type: Optional[str]) -> Tuple[List[Row], List[dict]]:
+    """Split a request body into numbered rows, by content type
+
+    text/csv is read with a header line; application/x-ndjson (or jsonl) is
+    one JSON object per line; anything else must be a JSON array of objects.
+    NDJSON lines that are not objects become row errors; a malformed CSV or
+    JSON document raises ImportFormatError.
+    """
+    media_type = (content_type or "application/json").split(";")[0].strip().lower()
+    try:
+        text = body.decode("utf-8-sig")
+    except UnicodeDecodeError as e:
+        raise ImportFormatError(f"Body is not UTF-8: {e}")
+
+    rows, errors = [], []
+    if media_type == "text/csv":
+        try:
+            for number, record in enumerate(csv.DictReader(io.StringIO(text)), 1):
+                # Empty cells are missing values, so optional fields fall back to their defaults
+                rows.append((number, {k: v for k, v in record.items() if k and v not in ("", None)}))
+        except csv.Error as e:
+            raise ImportFormatError(f"Invalid CSV: {e}")
+    elif media_type in ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/x-jsonlines"):
+        for number, line in enumerate((line for line in text.splitlines() if line.strip()), 1):
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                errors.append(row_error(number, f"Invalid JSON: {e}"))
+                continue
+            if isinstance(record, dict):
+                rows.append((number, record))
+            else:
+                errors.append(row_error(number, "Expected a JSON object"))
+    else:
+        try:
+            records = json.loads(text)
+        except ValueError as e:
+            raise ImportFormatError(f"Invalid JSON: {e}")
+        if not isinstance(records, list):
+            raise ImportFormatError("Expected a JSON array of objects")
+        for number, record in enumerate(records, 1):
+            if isinstance(record, dict):
+                rows.append((number, record))
+            else:
+                errors.append(row_error(number, "Expected a JSON object"))
+    return rows, errors
+
+
+async def request_rows(request: Request) -> Tuple[List[Row], List[dict]]:
+    """parse_rows for a request body, with format errors as 400 responses"""
+    try:
+        return parse_rows(await request.body(), request.headers.get("content-type"))
+    except ImportFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def row_error(number: int, message: str) -> dict:
+    return {"row": number, "error": message}
+
+
+def validation_message(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in e['loc'])}: {e['msg']}" if e["loc"] else e["msg"]
+        for e in error.errors()
+    )
+
+
+def batches(items: List, size: int = BATCH_SIZE) -> Iterator[List]:
+    for offset in range(0, len(items), size):
+        yield items[offset:offset + size]
+
+
+def _result(imported: int, errors: List[dict]) -> dict:
+    return {"imported": imported, "errors": sorted(errors, key=lambda e: e["row"])}
+
+
+def _commit_batch(db: Session, numbers: Iterable[int], errors: List[dict], write: Callable[[], None]) -> bool:
+    """Run the batch's writes and commit them; on a database error roll it back and report each of its rows"""
+    try:
+        write()
+        db.commit()
+        return True
+    except SQLAlchemyError as e:
+        db.rollback()
+        message = f"Batch not imported: {e.__class__.__name__}"
+        errors.extend(row_error(number, message) for number in numbers)
+        return False
+
+
+def _user_key(fields: dict):
+    """The resident a row refers to: ("id", int) or ("email", str)"""
+    if fields.get("user_id") not in (None, ""):
+        try:
+            return "id", int(fields["user_id"])
+        except (TypeError, ValueError):
+            return None
+    if fields.get("email"):
+        return "email", str(fields["email"]).strip()
+    return None
+
+
+def _resolve_users(db: Session, keys: Iterable[tuple]) -> Dict[tuple, int]:
+    """Map row user keys to existing user ids, one IN query per key kind"""
+    keys = set(keys)
+    ids = [value for kind, value in keys if kind == "id"]
+    emails = [value for kind, value in keys if kind == "email"]
+    resolved = {}
+    if ids:
+        resolved.update((("id", user_id), user_id) for user_id in db.scalars(select(User.id).where(User.id.in_(ids))))
+    if emails:
+        resolved.update(
+            (("email", email), user_id)
+            for user_id, email in db.execute(select(User.id, User.email).where(User.email.in_(emails)))
+        )
+    return resolved
+
+
+def import_users(db: Session, rows: List[Row], role: str = "resident", errors: Iterable[dict] = ()) -> dict:
+    """Create residents (or delivery people) from rows of UserCreate fields"""
+    errors, valid = list(errors), []
+    for number, fields in rows:
+        try:
+            valid.append((number, UserCreate(**fields)))
+        except ValidationError as e:
+            errors.append(row_error(number, validation_message(e)))
+
+    imported = 0
+    seen = set()
+    for batch in batches(valid):
+        existing = set(db.scalars(select(User.email).where(User.email.in_({user.email for _, user in batch}))))
+        numbers, mappings = [], []
+        for number, user in batch:
+            if user.email in existing:
+                errors.append(row_error(number, "Email already registered"))
+            elif user.email in seen:
+                errors.append(row_error(number, "Duplicate email in import"))
+            else:
+                seen.add(user.email)
+                numbers.append(number)
+                mappings.append({**user.dict(), "role": role})
+        if not mappings:
+            continue
+        if _commit_batch(db, numbers, errors, lambda: db.execute(insert(User), mappings)):
+            imported += len(mappings)
+    return _result(imported, errors)
+
+
+def _subscription_groups(rows: List[Row], errors: List[dict]) -> List[Tuple[int, tuple, dict]]:
+    """Merge rows into one subscription per resident, numbered by its first row"""
+    groups = {}
+    for number, fields in rows:
+        key = _user_key(fields)
+        if key is None:
+            errors.append(row_error(number, "Row needs a user_id or an email"))
+            continue
+        if "items" in fields:
+            items = fields["items"]
+        elif "product_id" in fields:
+            items = [{"product_id": fields["product_id"], "quantity": fields.get("quantity")}]
+        else:
+            items = []
+        if not isinstance(items, list):
+            errors.append(row_error(number, "items: Input should be a valid list"))
+            continue
+        if key in groups:
+            groups[key][2]["items"].extend(items)
+        else:
+            data = {"items": list(items)}
+            if "frequency" in fields:
+                data["frequency"] = fields["frequency"]
+            groups[key] = (number, key, data)
+    return list(groups.values())
+
+
+def import_subscriptions(db: Session, rows: List[Row], errors: Iterable[dict] = ()) -> dict:
+    """Replace each resident's active subscription with the imported one"""
+    errors, valid = list(errors), []
+    for number, key, data in _subscription_groups(rows, errors):
+        try:
+            subscription = SubscriptionCreate(**data)
+        except ValidationError as e:
+            errors.append(row_error(number, validation_message(e)))
+            continue
+        if not frequency.is_valid(subscription.frequency):
+            errors.append(row_error(number, "Unknown subscription frequency"))
+        else:
+            valid.append((number, key, subscription))
+
+    product_ids = catalog.product_map(db).keys()
+    imported = 0
+    for batch in batches(valid):
+        users = _resolve_users(db, (key for _, key, _ in batch))
+        accepted = []
+        for number, key, subscription in batch:
+            unknown = sorted({item.product_id for item in subscription.items} - product_ids)
+            if key not in users:
+                errors.append(row_error(number, "User not found"))
+            elif unknown:
+                errors.append(row_error(number, f"Unknown product ids: {unknown}"))
+            else:
+                accepted.append((number, users[key], subscription))
+        if not accepted:
+            continue
+
+        def write(accepted=accepted):
+            user_ids = [user_id for _, user_id, _ in accepted]
+            db.execute(
+                update(Subscription)
+                .where(Subscription.user_id.in_(user_ids), Subscription.is_active == True)
+                .values(is_active=False)
+            )
+            subscription_ids = db.scalars(
+                insert(Subscription).returning(Subscription.id, sort_by_parameter_order=True),
+                [{"user_id": user_id, "frequency": subscription.frequency} for _, user_id, subscription in accepted]
+            ).all()
+            db.execute(insert(SubscriptionItem), [
+                {"subscription_id": subscription_id, "product_id": item.product_id, "quantity": item.quantity}
+                for subscription_id, (_, _, subscription) in zip(subscription_ids, accepted)
+                for item in subscription.items
+            ])
+            manifest_store.refresh_users(db, user_ids)
+            dashboard.touch(db, user_ids)
+
+        if _commit_batch(db, (number for number, _, _ in accepted), errors, write):
+            imported += len(accepted)
+    return _result(imported, errors)
+
+
+def import_vacations(db: Session, rows: List[Row], errors: Iterable[dict] = ()) -> dict:
+    """Add vacations from rows of user_id or email, start_date and end_date"""
+    errors, valid = list(errors), []
+    for number, fields in rows:
+        key = _user_key(fields)
+        if key is None:
+            errors.append(row_error(number, "Row needs a user_id or an email"))
+            continue
+        try:
+            vacation = VacationCreate(**fields)
+        except ValidationError as e:
+            errors.append(row_error(number, validation_message(e)))
+            continue
+        if vacation.end_date < vacation.start_date:
+            errors.append(row_error(number, "end_date is before start_date"))
+            continue
+        valid.append((number, key, vacation))
+
+    imported = 0
+    for batch in batches(valid):
+        users = _resolve_users(db, (key for _, key, _ in batch))
+        accepted = []
+        for number, key, vacation in batch:
+            if key in users:
+                accepted.append((number, users[key], vacation))
+            else:
+                errors.append(row_error(number, "User not found"))
+        if not accepted:
+            continue
+
+        def write(accepted=accepted):
+            db.execute(insert(Vacation), [
+                {"user_id": user_id, "start_date": vacation.start_date, "end_date": vacation.end_date}
+                for _, user_id, vacation in accepted
+            ])
+            manifest_store.refresh_users(
+                db,
+                {user_id for _, user_id, _ in accepted},
+                min(vacation.start_date for _, _, vacation in accepted),
+                max(vacation.end_date for _, _, vacation in accepted)
+            )
+            dashboard.touch(db, (user_id for _, user_id, _ in accepted))
+
+        if _commit_batch(db, (number for number, _, _ in accepted), errors, write):
+            imported += len(accepted)
+            vacation_index.refresh_users(db, {user_id for _, user_id, _ in accepted})
+    return _result(imported, errors)
@@ -0,0 +1,307 @@
+"""In-process exclusion index of cancellations.
+
+A cancellation ("subscription", "order" or "vacation" plus the cancelled
+row's id) takes that subscription or ad-hoc order out of every delivery, and
+puts back the deliveries a cancelled vacation would have skipped. Rather
+than look each delivery up in the cancellations table, the delivery
+computations ask this index: the cancelled ids of each type are loaded with
+one query into sorted arrays of 64-bit ints (8 bytes an id, where a set of
+Python ints costs about ten times that), so a million historic cancellations
+fit in a few megabytes and a membership test is one bisect. Cancelled
+vacations also keep their dates, sorted by end date, so the ones covering a
+day (almost always none, since most are long past) are found without a scan.
+
+Cancellations are only ever added, so each use first catches up with rows
+above the highest id loaded: one indexed query per manifest build, which
+also brings in other workers' cancellations. Only committed rows go into the
+shared index. The session's own uncommitted cancellations (noted when they
+are flushed) are laid over it for that session alone, so a materialized
+manifest refreshed in the cancelling transaction already leaves them out,
+and a rollback leaves nothing behind. Ids a catch-up skipped over (not yet
+committed by another transaction, or rolled back) are asked for again for
+GAP_SECONDS, since they may still commit below the highest id loaded.
+
+The database is queried outside the lock, which only guards swapping in a
+loaded index and merging rows into it: with DATABASE_ASYNC the index is
+used from the event loop, where a thread waiting on a query would hold up
+every other request. The index is rebuilt from scratch after
+CANCELLATION_INDEX_TTL seconds, or after `invalidate()`, which also drops
+rows that were archived. One request loads it (about two seconds for a
+million cancellations) while the others keep catching up the old one. The
+cancelled vacations' date arrays are copied on write, so readers, which
+take no lock, never see them half updated.
+"""
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from datetime import date
+from typing import Collection, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, event, or_
+from sqlalchemy.orm import Session
+
+from database import database_key
+from db_models import Cancellation, Vacation
+
+# Seconds a loaded index is caught up incrementally before it is rebuilt
+CANCELLATION_INDEX_TTL = float(os.environ.get("CANCELLATION_INDEX_TTL", "3600"))
+
+# Seconds, and how many, skipped-over ids are asked for again by each catch-up
+GAP_SECONDS = 60
+MAX_GAPS = 1000
+
+Row = Tuple[int, str, int, Optional[date], Optional[date]]  # id, type, reference_id, vacation dates
+
+
+class SortedIds:
+    """A set of ints kept as a sorted array"""
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self._ids = array("q", sorted(set(ids)))
+
+    def __contains__(self, value: int) -> bool:
+        position = bisect_left(self._ids, value)
+        return position < len(self._ids) and self._ids[position] == value
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def add(self, value: int) -> None:
+        if value not in self:
+            insort(self._ids, value)
+
+    @property
+    def nbytes(self) -> int:
+        return self._ids.itemsize * len(self._ids)
+
+
+class Exclusions:
+    """Cancelled subscription, order and vacation ids, from (id, type, reference_id, start, end) rows"""
+
+    def __init__(self, rows: Iterable[Row] = (), database: Optional[str] = None):
+        ids = {"subscription": [], "order": [], "vacation": []}
+        dated = []
+        self.last_id = 0
+        for cancellation_id, cancellation_type, reference_id, start, end in rows:
+            self.last_id = max(self.last_id, cancellation_id)
+            if cancellation_type in ids:
+                ids[cancellation_type].append(reference_id)
+            if cancellation_type == "vacation" and start is not None:
+                dated.append((end.toordinal(), start.toordinal(), reference_id))
+        self.subscriptions = SortedIds(ids["subscription"])
+        self.orders = SortedIds(ids["order"])
+        self.vacations = SortedIds(ids["vacation"])
+        # Cancelled vacations' (end, start, id) as parallel arrays sorted by end,
+        # replaced as one tuple so that readers never see them out of step
+        dated.sort()
+        self._dated = (
+            array("q", [end for end, _, _ in dated]),
+            array("q", [start for _, start, _ in dated]),
+            array("q", [vacation_id for _, _, vacation_id in dated])
+        )
+        self.database = database
+        self.loaded_at = time.monotonic()
+        # Ids below last_id that were not committed when caught up with, and since when
+        self.gaps: Dict[int, float] = {}
+        self.stale = False  # set by invalidate()
+
+    def __len__(self) -> int:
+        return len(self.subscriptions) + len(self.orders) + len(self.vacations)
+
+    @property
+    def nbytes(self) -> int:
+        return (self.subscriptions.nbytes + self.orders.nbytes + self.vacations.nbytes
+                + 3 * self._dated[0].itemsize * len(self._dated[0]))
+
+    def add(self, rows: Iterable[Row]) -> None:
+        dated = []
+        for cancellation_id, cancellation_type, reference_id, start, end in rows:
+            self.last_id = max(self.last_id, cancellation_id)
+            if cancellation_type == "subscription":
+                self.subscriptions.add(reference_id)
+            elif cancellation_type == "order":
+                self.orders.add(reference_id)
+            elif cancellation_type == "vacation" and reference_id not in self.vacations:
+                self.vacations.add(reference_id)
+                if start is not None:
+                    dated.append((end.toordinal(), start.toordinal(), reference_id))
+        if dated:
+            # Copy on write: readers keep the tuple they started with
+            ends, starts, vacation_ids = (array("q", values) for values in self._dated)
+            for end, start, vacation_id in sorted(dated):
+                position = bisect_left(ends, end)
+                ends.insert(position, end)
+                starts.insert(position, start)
+                vacation_ids.insert(position, vacation_id)
+            self._dated = (ends, starts, vacation_ids)
+
+    def vacations_overlapping(self, first: date, last: date) -> List[int]:
+        """Ids of the cancelled vacations that cover any day in [first, last]"""
+        ends, starts, vacation_ids = self._dated
+        position = bisect_left(ends, first.toordinal())
+        last = last.toordinal()
+        return [vacation_ids[n] for n in range(position, len(ends)) if starts[n] <= last]
+
+    def merge(self, rows: List[Row], skipped: Collection[int] = ()) -> None:
+        """Add caught-up committed rows, noting the ids they jumped over and the skipped ones as gaps"""
+        previous = self.last_id
+        self.add(rows)
+        self.note_gaps(previous, {row[0] for row in rows}, skipped)
+
+    def note_gaps(self, previous: int, seen: Collection[int], skipped: Collection[int] = ()) -> None:
+        """Ask again for the ids between previous and last_id not in seen, and for skipped ones"""
+        now = time.monotonic()
+        for cancellation_id in seen:
+            self.gaps.pop(cancellation_id, None)
+        for cancellation_id in range(max(previous + 1, self.last_id - MAX_GAPS), self.last_id):
+            if cancellation_id not in seen:
+                self.gaps.setdefault(cancellation_id, now)
+        for cancellation_id in skipped:
+            self.gaps.setdefault(cancellation_id, now)
+        for cancellation_id, since in list(self.gaps.items()):
+            if now - since > GAP_SECONDS:
+                del self.gaps[cancellation_id]
+        while len(self.gaps) > MAX_GAPS:
+            del self.gaps[min(self.gaps)]
+
+
+class _Either:
+    """Membership in either of two id sets"""
+
+    def __init__(self, first: SortedIds, second: SortedIds):
+        self.first = first
+        self.second = second
+
+    def __contains__(self, value: int) -> bool:
+        return value in self.first or value in self.second
+
+    def __len__(self) -> int:
+        return len(self.first) + len(self.second)
+
+
+class Overlay:
+    """The shared index with a session's own uncommitted cancellations laid over it"""
+
+    def __init__(self, shared: Exclusions, own: Exclusions):
+        self.shared = shared
+        self.own = own
+        self.subscriptions = _Either(shared.subscriptions, own.subscriptions)
+        self.orders = _Either(shared.orders, own.orders)
+        self.vacations = _Either(shared.vacations, own.vacations)
+
+    def __len__(self) -> int:
+        return len(self.shared) + len(self.own)
+
+    def vacations_overlapping(self, first: date, last: date) -> List[int]:
+        return self.shared.vacations_overlapping(first, last) + self.own.vacations_overlapping(first, last)
+
+
+_index: Optional[Exclusions] = None
+_lock = threading.Lock()
+_loading = threading.Lock()  # held by the one request loading the index
+_stats = {"loads": 0, "catch_ups": 0, "added": 0}
+
+
+def _rows(db: Session, after_id: int = 0, also: Collection[int] = ()):
+    """Cancellations above after_id, and those in also"""
+    condition = Cancellation.id > after_id
+    if also:
+        condition = or_(condition, Cancellation.id.in_(sorted(also)))
+    return db.query(
+        Cancellation.id, Cancellation.cancellation_type, Cancellation.reference_id,
+        Vacation.start_date, Vacation.end_date
+    ).outerjoin(
+        Vacation, and_(Cancellation.cancellation_type == "vacation", Vacation.id == Cancellation.reference_id)
+    ).filter(condition)
+
+
+def _current(index: Optional[Exclusions], db: Session) -> bool:
+    return (index is not None and not index.stale and index.database == database_key(db)
+            and time.monotonic() - index.loaded_at < CANCELLATION_INDEX_TTL)
+
+
+def _load(db: Session, pending: Set[int]) -> Tuple[Exclusions, List[Row]]:
+    """A new index of the committed cancellations, and every row read"""
+    rows = _rows(db).all()
+    committed = [row for row in rows if row[0] not in pending]
+    loaded = Exclusions(committed, database_key(db))
+    loaded.note_gaps(0, {row[0] for row in committed}, [row[0] for row in rows if row[0] in pending])
+    return loaded, rows
+
+
+def exclusions(db: Session):
+    """The exclusion index, loaded on first use (or for another database, or after the TTL)
+    and otherwise caught up with the cancellations committed since
+
+    With uncommitted cancellations of db's own, an Overlay of them over the index.
+    """
+    global _index
+    pending = db.info.get("pending_cancellations", set())
+    current = _index
+    if not _current(current, db):
+        # One load at a time. The others catch the old index up meanwhile; with
+        # none to use they wait for the load, except on the event loop
+        # (DATABASE_ASYNC), where waiting could block the loader itself
+        usable = current is not None and current.database == database_key(db)
+        if _loading.acquire(blocking=not usable and not db.get_bind().dialect.is_async):
+            try:
+                current = _index
+                if not _current(current, db):
+                    current, rows = _load(db, pending)
+                    with _lock:
+                        _stats["loads"] += 1
+                        _index = current
+                    return _with_own(current, rows, pending)
+            finally:
+                _loading.release()
+        elif not usable:
+            current, rows = _load(db, pending)
+            _stats["loads"] += 1
+            return _with_own(current, rows, pending)
+
+    with _lock:
+        gaps = list(current.gaps)
+        last_id = current.last_id
+    rows = _rows(db, last_id, set(gaps) | pending).all()
+    committed = [row for row in rows if row[0] not in pending]
+    with _lock:
+        current.merge(committed, [row[0] for row in rows if row[0] in pending])
+        _stats["added"] += len(committed)
+        _stats["catch_ups"] += 1
+    return _with_own(current, rows, pending)
+
+
+def _with_own(index: Exclusions, rows: List[Row], pending: Set[int]):
+    own = [row for row in rows if row[0] in pending]
+    return Overlay(index, Exclusions(own)) if own else index
+
+
+@event.listens_for(Session, "after_flush")
+def _note_pending(session: Session, flush_context) -> None:
+    # Still the pre-flush view: the cancellations just inserted are in session.new, with their ids
+    added = [instance.id for instance in session.new if isinstance(instance, Cancellation)]
+    if added:
+        session.info.setdefault("pending_cancellations", set()).update(added)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_pending(session: Session, transaction) -> None:
+    if transaction.parent is None:
+        session.info.pop("pending_cancellations", None)
+
+
+def invalidate() -> None:
+    """Reload the index on next use; until that load is done, concurrent users keep the old one"""
+    with _lock:
+        if _index is not None:
+            _index.stale = True
+
+
+def stats() -> dict:
+    current = _index
+    return {**_stats, "cancelled": len(current) if current else 0, "bytes": current.nbytes if current else 0}
@@ -0,0 +1,121 @@
+"""In-process cache of the product catalog.
+
+Every dashboard load asks for /products, and the delivery summary needs
+product names and prices, while the catalog itself changes maybe once a
+month. The catalog is loaded once into an immutable snapshot (the product
+list, a product_id -> Product map and an ETag over both) and served from
+memory until `invalidate()` is called after a product write, or until
+CATALOG_TTL seconds have passed. The TTL bounds how stale a worker can be
+when another process changed the catalog, since invalidation only reaches
+the process that made the write. The lock only guards swapping snapshots;
+loads run outside it, so two requests may both load a stale catalog.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlalchemy.orm import Session
+
+from db_models import Product as DBProduct
+from models import Product
+
+# Seconds a loaded catalog is served before it is re-read
+CATALOG_TTL = float(os.environ.get("CATALOG_TTL", "300"))
+
+
+class Snapshot(NamedTuple):
+    products: List[Product]
+    by_id: Dict[int, Product]
+    etag: str
+    loaded_at: float
+
+
+_snapshot: Optional[Snapshot] = None
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def _load(db: Session) -> Snapshot:
+    products = [Product(id=p.id, name=p.name, price=p.price) for p in db.query(DBProduct).order_by(DBProduct.id)]
+    digest = hashlib.sha1(
+        json.dumps([[p.id, p.name, p.price] for p in products]).encode()
+    ).hexdigest()[:20]
+    return Snapshot(products, {p.id: p for p in products}, f'"{digest}"', time.monotonic())
+
+
+def cached() -> Optional[Snapshot]:
+    """The current snapshot if it is still fresh, without touching the database"""
+    snapshot = _snapshot
+    if snapshot is not None and time.monotonic() - snapshot.loaded_at < CATALOG_TTL:
+        _stats["hits"] += 1
+        return snapshot
+    return None
+
+
+def snapshot(db: Session) -> Snapshot:
+    """The catalog, read through the cache"""
+    global _snapshot
+    current = cached()
+    if current is not None:
+        return current
+    with _lock:
+        invalidations = _stats["invalidations"]
+        _stats["misses"] += 1
+    # Read without the lock: with DATABASE_ASYNC this runs on the event loop,
+    # which a thread waiting for the lock across a query would block
+    loaded = _load(db)
+    with _lock:
+        # Unless a write invalidated the catalog meanwhile
+        if _stats["invalidations"] == invalidations:
+            _snapshot = loaded
+    return loaded
+
+
+def products(db: Session) -> List[Product]:
+    return snapshot(db).products
+
+
+def product_map(db: Session) -> Dict[int, Product]:
+    """product_id -> Product for the whole catalog"""
+    return snapshot(db).by_id
+
+
+def invalidate() -> None:
+    """Drop the snapshot; call after committing a catalog change"""
+    global _snapshot
+    with _lock:
+        _snapshot = None
+        _stats["invalidations"] += 1
+
+
+def stats() -> dict:
+    current = _snapshot
+    return {
+        **_stats,
+        "size": len(current.products) if current else 0,
+        "etag": current.etag if current else None
+    }
+
+
+SAMPLE_PRODUCTS = [("Milk", 25.0), ("Curd", 15.0), ("Butter", 45.0), ("Cheese", 80.0)]
+
+
+def add_sample_products(db: Session) -> int:
+    """Insert the sample products into an empty catalog and commit; returns the number added"""
+    if db.query(DBProduct.id).first() is not None:
+        return 0
+    db.add_all(DBProduct(name=name, price=price) for name, price in SAMPLE_PRODUCTS)
+    db.commit()
+    invalidate()
+    return len(SAMPLE_PRODUCTS)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header names etag (weak comparison)"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
@@ -0,0 +1,111 @@
+"""The resident dashboard in one request.
+
+The dashboard shows a resident's active subscription, latest orders,
+vacations and cancellations next to the product catalog. Instead of one
+request (and one database session) per section, GET /users/{id}/dashboard
+reads them all in one session with a fixed number of queries: the user, the
+subscription and its items, the latest DASHBOARD_ORDERS orders and their
+items (each pair with selectinload), and the latest DASHBOARD_ROWS vacations
+and cancellations. Products come from the catalog cache. The lists are
+bounded rather than eager-loaded whole, since a resident's order history
+grows every day.
+
+Every write the dashboard shows bumps the user's version stamp (`touch()`,
+in the write's transaction), and the response's ETag is that version plus the
+catalog's. A client revalidating with If-None-Match is answered 304 after a
+single one-row query when nothing changed.
+"""
+from typing import Iterable, Optional
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session, selectinload
+
+import catalog
+from db_models import User as DBUser, Subscription as DBSubscription, Order as DBOrder, \
+    Vacation as DBVacation, Cancellation as DBCancellation
+from models import Subscription, SubscriptionItem, Order, OrderItem
+
+# Latest orders, and latest vacations and cancellations, on the dashboard
+DASHBOARD_ORDERS = 50
+DASHBOARD_ROWS = 20
+
+# Per-user data that browsers may keep but must revalidate before use
+CACHE_CONTROL = "private, no-cache"
+
+# Users bumped per UPDATE statement
+TOUCH_BATCH = 1000
+
+
+def touch(db: Session, user_ids: Iterable[int]) -> None:
+    """Bump the users' dashboard version; the caller commits"""
+    user_ids = sorted(set(user_ids))
+    for start in range(0, len(user_ids), TOUCH_BATCH):
+        db.execute(
+            update(DBUser).where(DBUser.id.in_(user_ids[start:start + TOUCH_BATCH])).values(version=DBUser.version + 1)
+        )
+
+
+def etag(user_id: int, user_version: int, snapshot: catalog.Snapshot) -> str:
+    return '"{}.{}.{}"'.format(user_id, user_version, snapshot.etag.strip('"'))
+
+
+def not_modified(db: Session, user_id: int, if_none_match: Optional[str]) -> Optional[str]:
+    """The dashboard's ETag if if_none_match names it, else None; one query at most"""
+    if not if_none_match:
+        return None
+    row = db.query(DBUser.version).filter(DBUser.id == user_id).first()
+    if row is None:
+        return None
+    current = etag(user_id, row.version or 0, catalog.snapshot(db))
+    return current if catalog.etag_matches(if_none_match, current) else None
+
+
+def _items(schema, items, products: dict):
+    return [
+        schema(id=item.id, product_id=item.product_id, quantity=item.quantity, product=products.get(item.product_id))
+        for item in items
+    ]
+
+
+def load(db: Session, user_id: int) -> Optional[dict]:
+    """The dashboard of user_id, with its ETag under "etag"; None when there is no such user"""
+    # The user, and so the version, is read first: a write committed while
+    # the rest is read can only make the version older than the data
+    user = db.query(DBUser).filter(DBUser.id == user_id).first()
+    if user is None:
+        return None
+    snapshot = catalog.snapshot(db)
+    products = snapshot.by_id
+
+    subscription = db.query(DBSubscription).filter(
+        DBSubscription.user_id == user_id,
+        DBSubscription.is_active == True
+    ).options(selectinload(DBSubscription.items)).first()
+    orders = db.query(DBOrder).filter(DBOrder.user_id == user_id).options(
+        selectinload(DBOrder.items)
+    ).order_by(DBOrder.date.desc(), DBOrder.id.desc()).limit(DASHBOARD_ORDERS).all()
+    vacations = db.query(DBVacation).filter(DBVacation.user_id == user_id).order_by(
+        DBVacation.start_date.desc(), DBVacation.id.desc()
+    ).limit(DASHBOARD_ROWS).all()
+    cancellations = db.query(DBCancellation).filter(DBCancellation.user_id == user_id).order_by(
+        DBCancellation.id.desc()
+    ).limit(DASHBOARD_ROWS).all()
+
+    return {
+        "etag": etag(user_id, user.version or 0, snapshot),
+        "user": user,
+        "products": snapshot.products,
+        "subscription": None if subscription is None else Subscription(
+            id=subscription.id, user_id=user_id, frequency=subscription.frequency, is_active=True,
+            items=_items(SubscriptionItem, subscription.items, products), created_at=subscription.created_at
+        ),
+        "orders": [
+            Order(
+                id=order.id, user_id=user_id, date=order.date, is_adhoc=order.is_adhoc, status=order.status,
+                items=_items(OrderItem, order.items, products), created_at=order.created_at
+            )
+            for order in orders
+        ],
+        "vacations": vacations,
+        "cancellations": cancellations
+    }
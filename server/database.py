@@ -1,13 +1,102 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-# SQLite database URL
-SQLALCHEMY_DATABASE_URL = "sqlite:///./delivery_app.db"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+def _env_bool(name: str, default: str) -> bool:
+    return os.environ.get(name, default).lower() in ("1", "true", "yes")
+
+
+# Database URL, SQLite in the working directory by default
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./delivery_app.db")
+
+# Serve the API from async endpoints on an asyncio engine (aiosqlite / asyncpg)
+DATABASE_ASYNC = _env_bool("DATABASE_ASYNC", "")
+
+# Create tables, apply migrations and add the sample products when the app
+# starts. Only for a single development process: deployments run
+# `python manage.py migrate --sample-data` once, so workers start without
+# touching the database.
+DATABASE_SETUP = _env_bool("DATABASE_SETUP", "")
+
+# Connection pool
+DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", "20"))
+DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", "30"))
+DATABASE_POOL_TIMEOUT = float(os.environ.get("DATABASE_POOL_TIMEOUT", "30"))
+DATABASE_POOL_RECYCLE = int(os.environ.get("DATABASE_POOL_RECYCLE", "1800"))
+DATABASE_POOL_PRE_PING = _env_bool("DATABASE_POOL_PRE_PING", "true")
+
+# Requests the sync API serves at once. A sync request keeps its pooled
+# connection until its response is serialized, which itself needs a
+# threadpool worker, so admitting more requests than there are connections
+# can leave every worker waiting on the pool with no one to release it.
+DATABASE_MAX_REQUESTS = int(os.environ.get("DATABASE_MAX_REQUESTS", str(DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW)))
+
+# SQLite pragmas applied to every new connection. WAL lets readers run
+# alongside a writer and, with synchronous=NORMAL, fsyncs at checkpoints
+# instead of on every commit.
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", "-65536")),  # negative means KiB
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", "5000")),  # milliseconds
+}
+
+
+def is_sqlite(url: str) -> bool:
+    return url.startswith("sqlite")
+
+
+def is_sqlite_memory(url: str) -> bool:
+    return is_sqlite(url) and (url.rstrip("/").endswith(":memory:") or url.split("://", 1)[1] in ("", "/"))
+
+
+def engine_options(url: str, pool_size: int = DATABASE_POOL_SIZE, max_overflow: int = DATABASE_MAX_OVERFLOW) -> dict:
+    """create_engine keyword arguments for a database URL"""
+    options = {}
+    if is_sqlite(url):
+        options["connect_args"] = {"check_same_thread": False}
+        if is_sqlite_memory(url):
+            # In-memory databases live in a single connection; keep SQLAlchemy's pool
+            return options
+    else:
+        options["pool_recycle"] = DATABASE_POOL_RECYCLE
+    options.update(
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=DATABASE_POOL_TIMEOUT,
+        pool_pre_ping=DATABASE_POOL_PRE_PING
+    )
+    return options
+
+
+def install_sqlite_pragmas(engine, pragmas=None) -> None:
+    """Apply SQLite pragmas to each new DBAPI connection of engine (sync or async)"""
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+
+def create_db_engine(url: str = SQLALCHEMY_DATABASE_URL, pragmas=None, **overrides):
+    """A sync engine configured from the environment; keyword overrides win"""
+    engine = create_engine(url, **{**engine_options(url), **overrides})
+    if is_sqlite(url):
+        install_sqlite_pragmas(engine, pragmas)
+    return engine
+
+
+engine = create_db_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -19,3 +108,44 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def database_key(db) -> str:
+    """A session's database, the same for the sync and the async engine; keys per-process caches"""
+    url = db.get_bind().url
+    return url.set(drivername=url.get_backend_name()).render_as_string(hide_password=True)
+
+
+def async_database_url(url: str) -> str:
+    """The asyncio driver URL for a sync database URL"""
+    for prefix, async_prefix in (
+        ("sqlite://", "sqlite+aiosqlite://"),
+        ("sqlite+pysqlite://", "sqlite+aiosqlite://"),
+        ("postgresql://", "postgresql+asyncpg://"),
+        ("postgresql+psycopg2://", "postgresql+asyncpg://"),
+        ("postgres://", "postgresql+asyncpg://"),
+    ):
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    return url
+
+
+async_engine = None
+AsyncSessionLocal = None
+
+if DATABASE_ASYNC:
+    # Imported here so the async drivers are only needed when enabled
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    async_url = async_database_url(SQLALCHEMY_DATABASE_URL)
+    async_engine = create_async_engine(async_url, **engine_options(async_url))
+    if is_sqlite(async_url):
+        install_sqlite_pragmas(async_engine)
+    # Objects stay usable after commit; awaiting lazy loads is not possible
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+# Dependency to get an async DB session
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
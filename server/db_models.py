@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, Date, ForeignKey, DateTime, Text
+from sqlalchemy import Column, Integer, String, Float, Boolean, Date, ForeignKey, DateTime, Text, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -13,6 +13,9 @@ class User(Base):
     house_number = Column(String, nullable=False)
     address = Column(String)
     role = Column(String, default="resident")  # resident or delivery_person
+    latitude = Column(Float)  # optional, used by the route planner
+    longitude = Column(Float)
+    version = Column(Integer, nullable=False, default=0, server_default="0")  # bumped by dashboard.touch
     created_at = Column(DateTime, server_default=func.now())
     
     # Relationships
@@ -35,6 +38,9 @@ class Product(Base):
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
+    __table_args__ = (
+        Index("ix_subscriptions_user_active", "user_id", "is_active"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -51,7 +57,7 @@ class SubscriptionItem(Base):
     __tablename__ = "subscription_items"
     
     id = Column(Integer, primary_key=True, index=True)
-    subscription_id = Column(Integer, ForeignKey("subscriptions.id"), nullable=False)
+    subscription_id = Column(Integer, ForeignKey("subscriptions.id"), nullable=False, index=True)
     product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
     quantity = Column(Integer, nullable=False)
     
@@ -62,9 +68,13 @@ class SubscriptionItem(Base):
 
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        Index("ix_orders_date_adhoc", "date", "is_adhoc"),
+        Index("ix_orders_user_date", "user_id", "date"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     date = Column(Date, nullable=False)
     is_adhoc = Column(Boolean, default=False)
     status = Column(String, default="pending")  # pending, delivered, cancelled
@@ -79,7 +89,7 @@ class OrderItem(Base):
     __tablename__ = "order_items"
     
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False, index=True)
     product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
     quantity = Column(Integer, nullable=False)
     
@@ -90,6 +100,9 @@ class OrderItem(Base):
 
 class Vacation(Base):
     __tablename__ = "vacations"
+    __table_args__ = (
+        Index("ix_vacations_user_dates", "user_id", "start_date", "end_date"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -103,9 +116,12 @@ class Vacation(Base):
 
 class Cancellation(Base):
     __tablename__ = "cancellations"
+    __table_args__ = (
+        Index("ix_cancellations_type_reference", "cancellation_type", "reference_id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     cancellation_type = Column(String, nullable=False)  # "subscription", "order", "vacation"
     reference_id = Column(Integer, nullable=False)  # ID of the cancelled item
     reason = Column(Text)
@@ -117,3 +133,187 @@ class Cancellation(Base):
 
 # Add missing relationship to User
 User.vacations = relationship("Vacation", back_populates="user")
+
+
+# Archive tables (see archive.py): rows moved out of the tables above, ids
+# kept; a cancelled order or vacation carries its cancellation as a flag
+class ArchivedOrder(Base):
+    __tablename__ = "orders_archive"
+    __table_args__ = (
+        Index("ix_orders_archive_date_adhoc", "date", "is_adhoc"),
+        Index("ix_orders_archive_user_date", "user_id", "date"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    date = Column(Date, nullable=False)
+    is_adhoc = Column(Boolean, default=False)
+    status = Column(String, default="pending")
+    created_at = Column(DateTime)
+    cancelled = Column(Boolean, nullable=False, default=False)
+
+    # Relationships
+    items = relationship("ArchivedOrderItem", back_populates="order")
+
+
+class ArchivedOrderItem(Base):
+    __tablename__ = "order_items_archive"
+
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey("orders_archive.id"), nullable=False, index=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    quantity = Column(Integer, nullable=False)
+
+    # Relationships
+    order = relationship("ArchivedOrder", back_populates="items")
+    product = relationship("Product")
+
+
+class ArchivedVacation(Base):
+    __tablename__ = "vacations_archive"
+    __table_args__ = (
+        Index("ix_vacations_archive_user_dates", "user_id", "start_date", "end_date"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=False)
+    created_at = Column(DateTime)
+    cancelled = Column(Boolean, nullable=False, default=False)
+
+
+class ArchivedCancellation(Base):
+    __tablename__ = "cancellations_archive"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    cancellation_type = Column(String, nullable=False)  # "order" or "vacation"; subscriptions' stay
+    reference_id = Column(Integer, nullable=False)
+    reason = Column(Text)
+    cancelled_at = Column(DateTime)
+
+
+class ArchivedMonth(Base):
+    __tablename__ = "archived_months"
+
+    month = Column(Date, primary_key=True)  # first day of the month
+    orders = Column(Integer, nullable=False)
+    vacations = Column(Integer, nullable=False)
+    cancellations = Column(Integer, nullable=False)
+    archived_at = Column(DateTime, server_default=func.now())
+
+
+class ManifestDay(Base):
+    __tablename__ = "manifest_days"
+    
+    delivery_date = Column(Date, primary_key=True)
+    built_at = Column(DateTime, server_default=func.now())
+    
+    # Relationships
+    entries = relationship("ManifestEntry", back_populates="day")
+
+
+class ManifestEntry(Base):
+    __tablename__ = "manifest_entries"
+    __table_args__ = (
+        Index("ix_manifest_entries_date_user", "delivery_date", "user_id"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    delivery_date = Column(Date, ForeignKey("manifest_days.delivery_date"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    is_subscription = Column(Boolean, nullable=False)
+    source_id = Column(Integer, nullable=False)  # subscription id or ad-hoc order id
+    items = Column(Text, nullable=False)  # JSON list of {"product_id", "quantity"}
+    
+    # Relationships
+    day = relationship("ManifestDay", back_populates="entries")
+
+
+class DriverBlock(Base):
+    __tablename__ = "driver_blocks"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    driver_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    block = Column(String, nullable=False)  # house-number block, see routing.block_of
+
+
+class Invoice(Base):
+    __tablename__ = "invoices"
+    __table_args__ = (
+        Index("ix_invoices_user_month", "user_id", "month", unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    month = Column(Date, nullable=False)  # first day of the billed month
+    total_quantity = Column(Integer, nullable=False)
+    total_amount = Column(Float, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+    
+    # Relationships
+    lines = relationship("InvoiceLine", back_populates="invoice")
+
+
+class InvoiceLine(Base):
+    __tablename__ = "invoice_lines"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    invoice_id = Column(Integer, ForeignKey("invoices.id"), nullable=False, index=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    product_name = Column(String, nullable=False)  # name and price as billed
+    unit_price = Column(Float, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    amount = Column(Float, nullable=False)
+    
+    # Relationships
+    invoice = relationship("Invoice", back_populates="lines")
+
+
+# A driver's report on one household's delivery for a day; the latest by recorded_at stands
+class DeliveryUpdate(Base):
+    __tablename__ = "delivery_updates"
+    __table_args__ = (
+        Index("ix_delivery_updates_date_user", "delivery_date", "user_id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    client_id = Column(String, nullable=False, unique=True)  # generated by the driver's phone
+    driver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    delivery_date = Column(Date, nullable=False)
+    status = Column(String, nullable=False)  # delivered, missed, pending
+    note = Column(Text)
+    recorded_at = Column(DateTime, nullable=False)  # on the phone
+    received_at = Column(DateTime, server_default=func.now())
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index("ix_jobs_status_run_after", "status", "run_after"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False)  # a handler registered in jobs.py
+    key = Column(String, unique=True)  # idempotency key: one job per key
+    payload = Column(Text)  # JSON arguments
+    status = Column(String, nullable=False, default="queued")  # queued, running, succeeded, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    run_after = Column(DateTime, nullable=False)
+    worker = Column(String)  # worker that ran the last attempt
+    result = Column(Text)  # JSON returned by the handler
+    error = Column(Text)  # last failure
+    created_at = Column(DateTime, server_default=func.now())
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+    
+    version = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    applied_at = Column(DateTime, server_default=func.now())
@@ -0,0 +1,151 @@
+"""Delivery confirmations from drivers.
+
+A driver marks each stop (one household on one day) delivered or missed on
+their phone, which queues the updates while offline and syncs them in
+batches. A batch arrives in one request, in the import formats (see
+bulk_import.py), and is applied in one transaction: one IN query per
+BATCH_SIZE updates for the already-synced client ids and the residents, one
+executemany insert, and for the touched stops one read of their latest
+updates, at most two UPDATEs of their orders and one bump of the residents'
+dashboard versions (see dashboard.py).
+
+Every update carries a client_id generated on the phone. An update whose
+client_id was synced before is reported as a duplicate and not applied
+again, so a phone that lost the response to a sync simply sends the same
+batch again. Updates are kept as a log; a stop's status is its latest
+update by recorded_at (the time on the phone), so batches may arrive late
+or out of order. The orders of a stop follow it: "delivered" when it was
+delivered, back to "pending" when a delivery is corrected to missed or
+pending. Cancelled orders are left alone.
+"""
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+from sqlalchemy import insert, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import dashboard
+from bulk_import import Row, batches, row_error, validation_message
+from db_models import DeliveryUpdate, Order, User
+from models import DeliveryUpdateCreate
+
+STATUSES = ("delivered", "missed", "pending")
+
+Stop = Tuple[date, int]  # (delivery_date, user_id)
+
+
+def _local(moment: Optional[datetime], received: datetime) -> datetime:
+    """Naive local time, like the rest of the database"""
+    if moment is None:
+        return received
+    return moment.astimezone().replace(tzinfo=None) if moment.tzinfo else moment
+
+
+def _validate(rows: List[Row], errors: List[dict]) -> List[Tuple[int, DeliveryUpdateCreate]]:
+    valid = []
+    for number, fields in rows:
+        try:
+            update_data = DeliveryUpdateCreate(**fields)
+        except ValidationError as e:
+            errors.append(row_error(number, validation_message(e)))
+            continue
+        if update_data.status not in STATUSES:
+            errors.append(row_error(number, f"status must be one of {', '.join(STATUSES)}"))
+            continue
+        valid.append((number, update_data))
+    return valid
+
+
+def latest(db: Session, stops: Iterable[Stop]) -> Dict[Stop, DeliveryUpdate]:
+    """The standing update of each stop that has one"""
+    standing = {}
+    for batch in batches(sorted(set(stops))):
+        query = db.query(DeliveryUpdate).filter(
+            tuple_(DeliveryUpdate.delivery_date, DeliveryUpdate.user_id).in_(batch)
+        ).order_by(DeliveryUpdate.recorded_at, DeliveryUpdate.id)
+        for row in query:
+            standing[(row.delivery_date, row.user_id)] = row
+    return standing
+
+
+def _sync_orders(db: Session, standing: Dict[Stop, DeliveryUpdate]) -> None:
+    delivered = [(user_id, day) for (day, user_id), row in standing.items() if row.status == "delivered"]
+    undone = [(user_id, day) for (day, user_id), row in standing.items() if row.status != "delivered"]
+    stop = tuple_(Order.user_id, Order.date)
+    for batch in batches(delivered):
+        db.execute(update(Order).where(stop.in_(batch), Order.status != "cancelled").values(status="delivered"))
+    for batch in batches(undone):
+        db.execute(update(Order).where(stop.in_(batch), Order.status == "delivered").values(status="pending"))
+    dashboard.touch(db, (user_id for _, user_id in standing))
+
+
+def _apply(db: Session, driver_id: int, valid: List[Tuple[int, DeliveryUpdateCreate]], errors: List[dict]) -> dict:
+    received = datetime.now()
+    duplicates, accepted, seen = [], [], set()
+    for batch in batches(valid):
+        synced = set(db.scalars(select(DeliveryUpdate.client_id).where(
+            DeliveryUpdate.client_id.in_([update_data.client_id for _, update_data in batch])
+        )))
+        users = set(db.scalars(select(User.id).where(User.id.in_({update_data.user_id for _, update_data in batch}))))
+        for number, update_data in batch:
+            if update_data.client_id in synced or update_data.client_id in seen:
+                duplicates.append(update_data.client_id)
+            elif update_data.user_id not in users:
+                errors.append(row_error(number, "User not found"))
+            else:
+                seen.add(update_data.client_id)
+                accepted.append(update_data)
+
+    for batch in batches(accepted):
+        db.execute(insert(DeliveryUpdate), [{
+            "client_id": update_data.client_id,
+            "driver_id": driver_id,
+            "user_id": update_data.user_id,
+            "delivery_date": update_data.delivery_date,
+            "status": update_data.status,
+            "note": update_data.note,
+            "recorded_at": _local(update_data.recorded_at, received),
+        } for update_data in batch])
+    if accepted:
+        _sync_orders(db, latest(db, ((update_data.delivery_date, update_data.user_id) for update_data in accepted)))
+    db.commit()
+    return {"applied": len(accepted), "duplicates": duplicates, "errors": sorted(errors, key=lambda e: e["row"])}
+
+
+def apply_updates(db: Session, driver_id: int, rows: List[Row], errors: Iterable[dict] = ()) -> dict:
+    """Record a driver's batch of status updates in one transaction
+
+    Returns the number applied, the client_ids already synced and the rows
+    that were rejected; 404 when driver_id is not a delivery person. If
+    another request syncs some of the same client_ids concurrently, the batch
+    is retried once so those count as duplicates.
+    """
+    driver = db.get(User, driver_id)
+    if driver is None or driver.role != "delivery_person":
+        raise HTTPException(status_code=404, detail="Delivery person not found")
+    errors = list(errors)
+    valid = _validate(rows, errors)
+    try:
+        return _apply(db, driver_id, valid, list(errors))
+    except IntegrityError:
+        db.rollback()
+        return _apply(db, driver_id, valid, list(errors))
+
+
+def day_status(db: Session, delivery_date: date, driver_id: Optional[int] = None) -> List[dict]:
+    """The standing status of every stop of delivery_date that has been reported, by user id"""
+    query = db.query(DeliveryUpdate).filter(DeliveryUpdate.delivery_date == delivery_date)
+    standing = {}
+    for row in query.order_by(DeliveryUpdate.recorded_at, DeliveryUpdate.id):
+        standing[row.user_id] = row
+    return [
+        {
+            "user_id": user_id, "delivery_date": row.delivery_date, "status": row.status,
+            "driver_id": row.driver_id, "recorded_at": row.recorded_at, "note": row.note
+        }
+        for user_id, row in sorted(standing.items())
+        if driver_id is None or row.driver_id == driver_id
+    ]
@@ -0,0 +1,56 @@
+"""Fast JSON responses for the read-heavy endpoints.
+
+With FAST_JSON=1, list endpoints select their rows as plain column tuples
+(the fields of the response model, in order) and encode them with orjson,
+instead of having FastAPI validate a pydantic model per ORM object and
+walk the result with jsonable_encoder. The delivery manifest, which is
+already plain dicts, skips jsonable_encoder the same way. The bytes sent are
+the same as on the default path: compact separators, UTF-8, ISO dates.
+
+orjson is optional; without it the same output comes from the standard
+json module, which still skips per-row validation.
+"""
+import json
+import os
+from datetime import date, datetime
+from typing import Any, List
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+# Serve list endpoints through the fast path
+FAST_JSON = os.environ.get("FAST_JSON", "").lower() in ("1", "true", "yes")
+
+
+def _default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """content as compact UTF-8 JSON, matching FastAPI's JSONResponse output"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """A JSONResponse for content that is already JSON-ready apart from dates"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def schema_fields(schema) -> List[str]:
+    """Field names of a pydantic model, in declaration (and output) order"""
+    fields = getattr(schema, "model_fields", None)
+    if fields is None:
+        fields = schema.__fields__
+    return list(fields)
@@ -0,0 +1,94 @@
+"""Subscription delivery frequencies.
+
+`Subscription.frequency` is one of:
+
+- "daily" (also the meaning of an empty or missing value)
+- "alternate": every other day
+- "every_N_days", e.g. "every_3_days"
+- "weekly": once a week
+- "weekdays" (Monday to Friday) and "weekends"
+- "days:mon,thu": on the listed weekdays
+
+Interval rules count from the subscription's anchor day, the date it was
+created, so a weekly subscription started on a Tuesday is delivered on
+Tuesdays. Unknown values are treated as daily, which is how every
+subscription was delivered before frequencies were honoured; new ones are
+rejected by `is_valid` at the API.
+"""
+import re
+from datetime import date, datetime
+from functools import lru_cache
+from typing import NamedTuple, Optional, Union
+
+WEEKDAY_NAMES = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+# Day ordinal used as the anchor when a subscription has no created_at (a Monday)
+DEFAULT_ANCHOR = date(2024, 1, 1).toordinal()
+
+_EVERY_N_DAYS = re.compile(r"^every_(\d+)_days?$")
+
+
+class Rule(NamedTuple):
+    """Delivered every `period` days from the anchor, or, when weekdays is
+    non-zero, on the weekdays whose bits are set (bit 0 = Monday)"""
+    period: int
+    weekdays: int
+
+
+DAILY = Rule(1, 0)
+
+
+def _weekday_bits(names) -> int:
+    return sum(1 << WEEKDAY_NAMES.index(name) for name in names)
+
+
+@lru_cache(maxsize=256)
+def _parse(frequency: str) -> Optional[Rule]:
+    if frequency in ("", "daily"):
+        return DAILY
+    if frequency == "alternate":
+        return Rule(2, 0)
+    if frequency == "weekly":
+        return Rule(7, 0)
+    if frequency == "weekdays":
+        return Rule(1, _weekday_bits(WEEKDAY_NAMES[:5]))
+    if frequency == "weekends":
+        return Rule(1, _weekday_bits(WEEKDAY_NAMES[5:]))
+    match = _EVERY_N_DAYS.match(frequency)
+    if match and int(match.group(1)) >= 1:
+        return Rule(int(match.group(1)), 0)
+    if frequency.startswith("days:"):
+        names = [name.strip() for name in frequency[len("days:"):].split(",") if name.strip()]
+        if names and all(name in WEEKDAY_NAMES for name in names):
+            return Rule(1, _weekday_bits(names))
+    return None
+
+
+def parse(frequency: Optional[str]) -> Rule:
+    """The rule for a frequency value; unknown values deliver daily"""
+    return _parse((frequency or "").strip().lower()) or DAILY
+
+
+def is_valid(frequency: Optional[str]) -> bool:
+    return _parse((frequency or "").strip().lower()) is not None
+
+
+def is_daily(frequency: Optional[str]) -> bool:
+    return parse(frequency) == DAILY
+
+
+def anchor(created_at: Optional[Union[date, datetime]]) -> int:
+    """The day ordinal interval rules count from"""
+    if created_at is None:
+        return DEFAULT_ANCHOR
+    if isinstance(created_at, datetime):
+        created_at = created_at.date()
+    return created_at.toordinal()
+
+
+def delivers_on(frequency: Optional[str], created_at, day: date) -> bool:
+    """Whether a subscription with this frequency is delivered on day"""
+    rule = parse(frequency)
+    if rule.weekdays:
+        return bool(rule.weekdays >> day.weekday() & 1)
+    return (day.toordinal() - anchor(created_at)) % rule.period == 0
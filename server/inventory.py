@@ -0,0 +1,139 @@
+"""Per-product delivery totals.
+
+Aggregates what the delivery manifest would contain, per day and product,
+with one GROUP BY over subscription items and one over ad-hoc order items,
+instead of building the manifest and summing it. Cancelled subscriptions,
+orders and vacations are left out by anti-joins on the cancellations
+(type, reference_id) index rather than the in-process exclusion index, since
+the groups no longer carry the ids to look up. A range that starts before
+the archive horizon also adds up the archived orders and leaves out the
+archived vacations (see archive.py).
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, List, Tuple
+
+from sqlalchemy import Date, case, func, literal, or_, select, true, union_all
+from sqlalchemy.orm import Session
+
+import archive
+import catalog
+import frequency
+from db_models import Subscription, SubscriptionItem, Order, OrderItem, Vacation, ArchivedOrder, ArchivedOrderItem
+from manifest import is_cancelled, on_vacation
+from models import Product
+
+# Longest range a single summary may cover
+MAX_SUMMARY_DAYS = 31
+
+# Frequency values aggregated without a per-subscription check
+DAILY_VALUES = ("", "daily")
+
+
+def _date_range(start: date, end: date) -> List[date]:
+    return [start + timedelta(days=n) for n in range((end - start).days + 1)]
+
+
+def _order_totals(db: Session, order, item, start: date, end: date):
+    return db.query(
+        order.date,
+        item.product_id,
+        func.sum(item.quantity)
+    ).join(
+        item, item.order_id == order.id
+    ).filter(
+        order.date >= start,
+        order.date <= end,
+        order.is_adhoc == True
+    ).group_by(order.date, item.product_id)
+
+
+def product_totals(db: Session, start: date, end: date) -> Dict[Tuple[date, int], int]:
+    """Quantity per (date, product_id) for every day in [start, end], honouring frequencies"""
+    # One-column derived table of the requested days (portable, unlike VALUES lists)
+    days = union_all(*[
+        select(literal(day, Date).label("day")) for day in _date_range(start, end)
+    ]).subquery("days")
+
+    # Daily subscriptions aggregate into one row per day and product; the
+    # others keep their frequency and anchor so each group can be checked
+    daily = or_(Subscription.frequency.is_(None), Subscription.frequency.in_(DAILY_VALUES))
+    rule = case((daily, None), else_=Subscription.frequency)
+    anchor = case((daily, None), else_=Subscription.created_at)
+    subscription_totals = db.query(
+        days.c.day,
+        SubscriptionItem.product_id,
+        rule,
+        anchor,
+        func.sum(SubscriptionItem.quantity)
+    ).select_from(days).join(
+        Subscription, true()
+    ).join(
+        SubscriptionItem, SubscriptionItem.subscription_id == Subscription.id
+    ).filter(
+        Subscription.is_active == True,
+        ~is_cancelled("subscription", Subscription.id),
+        ~on_vacation(Subscription.user_id, days.c.day).where(~is_cancelled("vacation", Vacation.id))
+    ).group_by(days.c.day, SubscriptionItem.product_id, rule, anchor)
+    if archive.reaches(start):
+        subscription_totals = subscription_totals.filter(~archive.on_vacation(Subscription.user_id, days.c.day))
+
+    adhoc_totals = _order_totals(db, Order, OrderItem, start, end).filter(~is_cancelled("order", Order.id))
+    if archive.reaches(start):
+        adhoc_totals = adhoc_totals.union_all(_order_totals(db, ArchivedOrder, ArchivedOrderItem, start, end).filter(
+            ArchivedOrder.cancelled == False
+        ))
+
+    totals = defaultdict(int)
+    for day, product_id, rule, anchor, quantity in subscription_totals:
+        if rule is None or frequency.delivers_on(rule, anchor, day):
+            totals[(day, product_id)] += quantity
+    for day, product_id, quantity in adhoc_totals:
+        totals[(day, product_id)] += quantity
+    return totals
+
+
+def _product_lines(quantities: Dict[int, int], products: Dict[int, Product]) -> List[dict]:
+    lines = []
+    for product_id in sorted(quantities):
+        product = products.get(product_id)
+        price = product.price if product else 0.0
+        lines.append({
+            "product_id": product_id,
+            "name": product.name if product else f"Product {product_id}",
+            "quantity": quantities[product_id],
+            "revenue": quantities[product_id] * price
+        })
+    return lines
+
+
+def summarize(db: Session, start: date, end: date) -> dict:
+    """Per-day and whole-range product totals with revenue from the cached catalog prices"""
+    totals = product_totals(db, start, end)
+    products = catalog.product_map(db)
+
+    per_day = defaultdict(dict)
+    overall = defaultdict(int)
+    for (day, product_id), quantity in totals.items():
+        per_day[day][product_id] = quantity
+        overall[product_id] += quantity
+
+    days = []
+    for day in _date_range(start, end):
+        lines = _product_lines(per_day.get(day, {}), products)
+        days.append({
+            "date": day,
+            "products": lines,
+            "total_quantity": sum(line["quantity"] for line in lines),
+            "total_revenue": sum(line["revenue"] for line in lines)
+        })
+
+    lines = _product_lines(overall, products)
+    return {
+        "start_date": start,
+        "end_date": end,
+        "days": days,
+        "products": lines,
+        "total_quantity": sum(line["quantity"] for line in lines),
+        "total_revenue": sum(line["revenue"] for line in lines)
+    }
@@ -0,0 +1,319 @@
+"""Background jobs.
+
+Heavy maintenance work runs off the request path as jobs in the `jobs`
+table, which is the queue: any process with database access can enqueue,
+and workers claim due jobs one at a time with a conditional UPDATE
+(queued -> running), so several workers, in one process or many, never run
+the same job twice.
+
+- Idempotency: a job may carry a key; enqueueing a key that already exists
+  returns the existing job instead of adding another. Periodic jobs are
+  keyed by name and period ("rebuild_manifests:2024-03-15"), so however many
+  workers notice that one is due, it is queued once per period, and a worker
+  started late still catches up on the current period.
+- Retries: a job that raises is queued again after JOB_RETRY_SECONDS,
+  doubling per attempt, until max_attempts; then it is marked failed with
+  the error. A job left running longer than JOB_TIMEOUT_SECONDS (its worker
+  died) is put back the same way.
+- Introspection: every job keeps its status, attempts, worker, timestamps,
+  result and last error; see GET /jobs and `python manage.py jobs`.
+
+Run a worker with `python manage.py worker`, or inside the API process with
+BACKGROUND_JOBS=1 (simpler, but the jobs then share the API's CPU).
+Handlers are registered with @handler(name) and called as fn(db, payload);
+they commit their own work, and whatever JSON-able value they return is
+stored as the result.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+from datetime import date, datetime, time as clock, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from sqlalchemy import text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import archive
+import billing
+import manifest_store
+from db_models import Job, ManifestDay, ManifestEntry
+
+# Run a worker thread inside the API process
+BACKGROUND_JOBS = os.environ.get("BACKGROUND_JOBS", "").lower() in ("1", "true", "yes")
+
+# Seconds an idle worker waits before looking for due jobs again
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "30"))
+
+# Delay before the first retry of a failed job; doubles with each attempt
+JOB_RETRY_SECONDS = float(os.environ.get("JOB_RETRY_SECONDS", "60"))
+
+# A job running longer than this is presumed abandoned and retried
+JOB_TIMEOUT_SECONDS = float(os.environ.get("JOB_TIMEOUT_SECONDS", "3600"))
+
+# Days of materialized manifests and of finished job records kept
+MANIFEST_RETENTION_DAYS = int(os.environ.get("MANIFEST_RETENTION_DAYS", "35"))
+JOB_RETENTION_DAYS = int(os.environ.get("JOB_RETENTION_DAYS", "30"))
+
+logger = logging.getLogger("dailydoodh.jobs")
+
+HANDLERS: Dict[str, Callable[[Session, dict], object]] = {}
+
+
+def handler(name: str):
+    """Register fn(db, payload) as the handler of jobs called name"""
+    def register(fn):
+        HANDLERS[name] = fn
+        return fn
+    return register
+
+
+# Queue
+
+def enqueue(db: Session, name: str, payload: Optional[dict] = None, key: Optional[str] = None,
+            run_after: Optional[datetime] = None, max_attempts: int = 3) -> Job:
+    """Queue a job and commit; with a key already used, the existing job"""
+    if name not in HANDLERS:
+        raise ValueError(f"Unknown job {name!r}")
+    if key is not None:
+        existing = db.query(Job).filter(Job.key == key).first()
+        if existing is not None:
+            return existing
+    job = Job(
+        name=name, key=key, payload=json.dumps(payload or {}), status="queued",
+        attempts=0, max_attempts=max_attempts, run_after=run_after or datetime.now()
+    )
+    db.add(job)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another process queued the same key first
+        db.rollback()
+        return db.query(Job).filter(Job.key == key).one()
+    return job
+
+
+def claim(db: Session, worker: str) -> Optional[Job]:
+    """Mark the next due queued job as running by worker and return it; None when nothing is due"""
+    while True:
+        now = datetime.now()
+        job_id = db.query(Job.id).filter(
+            Job.status == "queued", Job.run_after <= now
+        ).order_by(Job.run_after, Job.id).limit(1).scalar()
+        if job_id is None:
+            db.rollback()
+            return None
+        claimed = db.execute(
+            update(Job).where(Job.id == job_id, Job.status == "queued").values(
+                status="running", attempts=Job.attempts + 1, worker=worker, started_at=now, finished_at=None
+            )
+        ).rowcount
+        db.commit()
+        if claimed:
+            return db.get(Job, job_id)
+        # Another worker claimed it between the two statements; try the next one
+
+
+def _retry_or_fail(job: Job, error: str, now: datetime) -> None:
+    job.error = error
+    if job.attempts < job.max_attempts:
+        job.status = "queued"
+        job.run_after = now + timedelta(seconds=JOB_RETRY_SECONDS * 2 ** (job.attempts - 1))
+    else:
+        job.status = "failed"
+        job.finished_at = now
+
+
+def run_job(session_factory, job_id: int) -> str:
+    """Run a claimed job in its own session and record the outcome; returns the new status"""
+    with session_factory() as db:
+        job = db.get(Job, job_id)
+        payload = json.loads(job.payload or "{}")
+        name = job.name
+    with session_factory() as session:
+        try:
+            result = HANDLERS[name](session, payload)
+            error = None
+        except Exception as e:
+            session.rollback()
+            logger.exception("Job %s (%s) failed", job_id, name)
+            error = f"{type(e).__name__}: {e}"
+    with session_factory() as db:
+        job = db.get(Job, job_id)
+        now = datetime.now()
+        if error is None:
+            job.status, job.result, job.error, job.finished_at = "succeeded", json.dumps(result, default=str), None, now
+        else:
+            _retry_or_fail(job, error, now)
+        db.commit()
+        return job.status
+
+
+def requeue_stale(db: Session, timeout: float = JOB_TIMEOUT_SECONDS) -> int:
+    """Retry (or fail) jobs that have been running longer than timeout seconds; commits"""
+    now = datetime.now()
+    stale = db.query(Job).filter(Job.status == "running", Job.started_at < now - timedelta(seconds=timeout)).all()
+    for job in stale:
+        _retry_or_fail(job, f"Timed out after {timeout:.0f}s on {job.worker}", now)
+    db.commit()
+    return len(stale)
+
+
+# Periodic jobs
+
+class Periodic(NamedTuple):
+    name: str
+    at: clock  # local time of day from which the job is due
+    period: str  # "daily", "weekly" (from Monday) or "monthly" (from the 1st)
+
+
+SCHEDULE: List[Periodic] = [
+    Periodic("rebuild_manifests", clock(1, 0), "daily"),
+    Periodic("prune_manifests", clock(2, 0), "daily"),
+    Periodic("prune_jobs", clock(2, 30), "daily"),
+    Periodic("bill_month", clock(3, 0), "monthly"),
+    Periodic("archive_history", clock(3, 30), "monthly"),
+    Periodic("optimize_database", clock(4, 0), "weekly"),
+]
+
+
+def period_start(period: str, today: date) -> date:
+    if period == "weekly":
+        return today - timedelta(days=today.weekday())
+    if period == "monthly":
+        return today.replace(day=1)
+    return today
+
+
+def enqueue_due(db: Session, now: Optional[datetime] = None) -> List[Job]:
+    """Queue every periodic job whose time has come in its current period, once per period
+
+    Returns the jobs of the due periods, whether just queued or queued before.
+    """
+    now = now or datetime.now()
+    queued = []
+    for periodic in SCHEDULE:
+        start = period_start(periodic.period, now.date())
+        if now < datetime.combine(start, periodic.at):
+            continue
+        # The period's start is passed on, so a late run works on the right day or month
+        queued.append(enqueue(db, periodic.name, {"period_start": start.isoformat()}, key=f"{periodic.name}:{start}"))
+    return queued
+
+
+# Worker
+
+def work(session_factory, worker: str, limit: Optional[int] = None) -> int:
+    """Queue due periodic jobs, then run due jobs until none is left (or limit); returns the number run"""
+    with session_factory() as db:
+        requeue_stale(db)
+        enqueue_due(db)
+    ran = 0
+    while limit is None or ran < limit:
+        with session_factory() as db:
+            job = claim(db, worker)
+            job_id = job.id if job else None
+        if job_id is None:
+            break
+        run_job(session_factory, job_id)
+        ran += 1
+    return ran
+
+
+class Worker:
+    """Polls for due jobs in a daemon thread until stopped"""
+
+    def __init__(self, session_factory, name: Optional[str] = None, poll_seconds: float = JOB_POLL_SECONDS):
+        self.session_factory = session_factory
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_seconds = poll_seconds
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                work(self.session_factory, self.name)
+            except Exception:
+                logger.exception("Job worker %s: polling failed", self.name)
+            self._stop.wait(self.poll_seconds)
+
+    def start(self) -> "Worker":
+        self._thread = threading.Thread(target=self.run, name=f"jobs-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop polling; waits for a running job to finish (up to timeout)"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+# Handlers
+
+def _start(payload: dict) -> date:
+    return date.fromisoformat(payload["period_start"]) if "period_start" in payload else date.today()
+
+
+@handler("rebuild_manifests")
+def rebuild_manifests(db: Session, payload: dict) -> dict:
+    """Materialize the next MANIFEST_DAYS days"""
+    built = manifest_store.rebuild(db, _start(payload), int(payload.get("days", manifest_store.MANIFEST_DAYS)))
+    return {"days": len(built), "deliveries": sum(built.values())}
+
+
+@handler("prune_manifests")
+def prune_manifests(db: Session, payload: dict) -> dict:
+    """Drop materialized manifests older than MANIFEST_RETENTION_DAYS"""
+    cutoff = _start(payload) - timedelta(days=int(payload.get("keep_days", MANIFEST_RETENTION_DAYS)))
+    entries = db.query(ManifestEntry).filter(ManifestEntry.delivery_date < cutoff).delete(synchronize_session=False)
+    days = db.query(ManifestDay).filter(ManifestDay.delivery_date < cutoff).delete(synchronize_session=False)
+    db.commit()
+    return {"days": days, "entries": entries}
+
+
+@handler("prune_jobs")
+def prune_jobs(db: Session, payload: dict) -> dict:
+    """Delete finished jobs older than JOB_RETENTION_DAYS"""
+    cutoff = datetime.combine(_start(payload), clock()) - timedelta(days=int(payload.get("keep_days", JOB_RETENTION_DAYS)))
+    deleted = db.query(Job).filter(
+        Job.status.in_(("succeeded", "failed")), Job.finished_at < cutoff
+    ).delete(synchronize_session=False)
+    db.commit()
+    return {"deleted": deleted}
+
+
+@handler("bill_month")
+def bill_month(db: Session, payload: dict) -> dict:
+    """Bill the month before period_start (or payload["month"], YYYY-MM)"""
+    if "month" in payload:
+        month = billing.parse_month(payload["month"])
+    else:
+        month = (_start(payload).replace(day=1) - timedelta(days=1)).replace(day=1)
+    return {"month": f"{month:%Y-%m}", "invoices": billing.run(db, month, int(payload.get("workers", 1)))}
+
+
+@handler("archive_history")
+def archive_history(db: Session, payload: dict) -> dict:
+    """Move orders, vacations and cancellations from before the archive horizon into the archive tables"""
+    result = archive.run(db, _start(payload))
+    return {**result, "horizon": result["horizon"].isoformat()}
+
+
+@handler("optimize_database")
+def optimize_database(db: Session, payload: dict) -> dict:
+    """Refresh planner statistics, and reclaim free space with VACUUM unless payload["vacuum"] is false"""
+    engine = db.get_bind()
+    db.close()
+    statements = ["ANALYZE"]
+    if payload.get("vacuum", True):
+        statements.insert(0, "VACUUM")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for statement in statements:
+            connection.execute(text(statement))
+        if engine.dialect.name == "sqlite":
+            connection.execute(text("PRAGMA optimize"))
+    return {"ran": statements}
@@ -1,44 +1,77 @@
-from fastapi import FastAPI, HTTPException, Depends
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, selectinload
+from typing import List, Optional
 from datetime import date
+from contextlib import asynccontextmanager
+import asyncio
 
-from database import engine, get_db
-from db_models import Base, User as DBUser, Product as DBProduct, Subscription as DBSubscription,     SubscriptionItem as DBSubscriptionItem, Order as DBOrder, OrderItem as DBOrderItem,     Vacation as DBVacation, Cancellation as DBCancellation
+import archive
+import billing
+import bulk_import
+import catalog
+import dashboard
+import delivery_status
+import fast_json
+import inventory
+import jobs
+import manifest_events
+import manifest_store
+import metrics
+import migrations
+import pagination
+import route_planner
+import routing
+import schedule
+import vacation_index
+import writes
+from database import engine, async_engine, get_db, SessionLocal, DATABASE_ASYNC, DATABASE_MAX_REQUESTS, DATABASE_SETUP
+from db_models import User as DBUser, Product as DBProduct, Subscription as DBSubscription,     SubscriptionItem as DBSubscriptionItem, Order as DBOrder, OrderItem as DBOrderItem,     Vacation as DBVacation, Cancellation as DBCancellation, Invoice as DBInvoice, Job as DBJob, \
+    ArchivedOrder, ArchivedVacation, ArchivedCancellation
 from models import (
     User, UserLogin, UserCreate, Product, Subscription, SubscriptionCreate, 
-    Order, OrderCreate, Vacation, VacationCreate, Cancellation, CancellationCreate
+    Order, OrderCreate, Vacation, VacationCreate, Cancellation, CancellationCreate, DriverBlocks,
+    DeliverySummary, ImportResult, DeliverySyncResult, DeliveryStatus, Dashboard, AwayStatus, AwayUsers, Invoice, Job, JobCreate
 )
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# Create database tables, apply pending schema migrations and add the sample
+# products; run once by `manage.py migrate --sample-data`, not on import
+def setup_database():
+    migrations.migrate(engine)
+    with SessionLocal() as db:
+        catalog.add_sample_products(db)
 
-app = FastAPI()
+# Startup and shutdown. Importing this module and starting a worker run no
+# SQL, so every worker comes up at once; DATABASE_SETUP=1 sets the database
+# up here instead, for a single development process.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if DATABASE_SETUP:
+        await run_in_threadpool(setup_database)
+    # Run background jobs in this process when configured (see jobs.py)
+    job_worker = jobs.Worker(SessionLocal).start() if jobs.BACKGROUND_JOBS else None
+    try:
+        yield
+    finally:
+        if job_worker is not None:
+            job_worker.stop(timeout=5)
 
-# Initialize database with sample data
-def init_db():
-    db = next(get_db())
-    
-    # Check if data already exists
-    if db.query(DBProduct).count() > 0:
-        return
-    
-    # Add sample products
-    products = [
-        DBProduct(name="Milk", price=25.0),
-        DBProduct(name="Curd", price=15.0),
-        DBProduct(name="Butter", price=45.0),
-        DBProduct(name="Cheese", price=80.0)
-    ]
-    
-    for product in products:
-        db.add(product)
-    
-    db.commit()
-    db.close()
+app = FastAPI(lifespan=lifespan)
 
-# Initialize database on startup
-init_db()
+# Admission control for the sync endpoints, see database.DATABASE_MAX_REQUESTS
+if not DATABASE_ASYNC:
+    request_slots = asyncio.Semaphore(DATABASE_MAX_REQUESTS)
+
+    @app.middleware("http")
+    async def limit_concurrent_requests(request: Request, call_next):
+        async with request_slots:
+            return await call_next(request)
+
+# Per-route latency and SQL statement metrics on /metrics; installed last so
+# it wraps the admission control above
+metrics.instrument_engine(engine)
+metrics.install(app)
 
 @app.get("/")
 def read_root():
@@ -85,21 +118,39 @@ def signup_delivery_person(user_data: UserCreate, db: Session = Depends(get_db))
 
 # Product endpoints
 @app.get("/products", response_model=List[Product])
-def get_products(db: Session = Depends(get_db)):
-    return db.query(DBProduct).all()
+def get_products(request: Request, response: Response, db: Session = Depends(get_db)):
+    snapshot = catalog.snapshot(db)
+    if catalog.etag_matches(request.headers.get("if-none-match"), snapshot.etag):
+        return Response(status_code=304, headers={"ETag": snapshot.etag})
+    response.headers["ETag"] = snapshot.etag
+    return snapshot.products
+
+@app.get("/products/cache")
+def get_product_cache_stats():
+    return catalog.stats()
 
 @app.post("/products", response_model=Product)
 def create_product(product: Product, db: Session = Depends(get_db)):
     db_product = DBProduct(**product.dict(exclude={'id'}))
     db.add(db_product)
     db.commit()
+    catalog.invalidate()
     db.refresh(db_product)
     return db_product
 
 # User endpoints
 @app.get("/users", response_model=List[User])
-def get_users(db: Session = Depends(get_db)):
-    return db.query(DBUser).all()
+def get_users(
+    request: Request,
+    response: Response,
+    role: Optional[str] = None,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: Session = Depends(get_db)
+):
+    query = db.query(DBUser)
+    if role:
+        query = query.filter(DBUser.role == role)
+    return pagination.paginate(query, DBUser, [DBUser.id], page, request, response, schema=User)
 
 @app.get("/users/{user_id}", response_model=User)
 def get_user(user_id: int, db: Session = Depends(get_db)):
@@ -108,6 +159,20 @@ def get_user(user_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
+# Resident dashboard: everything the resident's page shows in one request,
+# revalidated with If-None-Match (see dashboard.py)
+@app.get("/users/{user_id}/dashboard", response_model=Dashboard)
+def get_dashboard(user_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
+    etag = dashboard.not_modified(db, user_id, request.headers.get("if-none-match"))
+    if etag is not None:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": dashboard.CACHE_CONTROL})
+    data = dashboard.load(db, user_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    response.headers["ETag"] = data.pop("etag")
+    response.headers["Cache-Control"] = dashboard.CACHE_CONTROL
+    return data
+
 # Subscription endpoints
 @app.get("/users/{user_id}/subscription", response_model=Subscription)
 def get_subscription(user_id: int, db: Session = Depends(get_db)):
@@ -132,45 +197,25 @@ def create_or_update_subscription(user_id: int, subscription_data: SubscriptionC
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Deactivate existing subscription
-    existing_subscription = db.query(DBSubscription).filter(
-        DBSubscription.user_id == user_id, 
-        DBSubscription.is_active == True
-    ).first()
-    if existing_subscription:
-        existing_subscription.is_active = False
-    
-    # Create new subscription
-    db_subscription = DBSubscription(
-        user_id=user_id,
-        frequency=subscription_data.frequency
-    )
-    db.add(db_subscription)
+    subscription = writes.create_subscription(db, user_id, subscription_data)
     db.commit()
-    db.refresh(db_subscription)
-    
-    # Add subscription items
-    for item_data in subscription_data.items:
-        db_item = DBSubscriptionItem(
-            subscription_id=db_subscription.id,
-            product_id=item_data.product_id,
-            quantity=item_data.quantity
-        )
-        db.add(db_item)
-    
-    db.commit()
-    
-    # Load subscription items for response
-    db_subscription.items = db.query(DBSubscriptionItem).filter(
-        DBSubscriptionItem.subscription_id == db_subscription.id
-    ).all()
-    
-    return db_subscription
+    return subscription
 
 # Vacation endpoints
 @app.get("/users/{user_id}/vacations", response_model=List[Vacation])
-def get_vacations(user_id: int, db: Session = Depends(get_db)):
-    return db.query(DBVacation).filter(DBVacation.user_id == user_id).all()
+def get_vacations(
+    user_id: int,
+    request: Request,
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: Session = Depends(get_db)
+):
+    query = db.query(DBVacation).filter(DBVacation.user_id == user_id)
+    archived = db.query(ArchivedVacation).filter(ArchivedVacation.user_id == user_id)
+    return pagination.paginate(
+        query, DBVacation, [DBVacation.start_date, DBVacation.id], page, request, response, schema=Vacation,
+        archived=archived
+    )
 
 @app.post("/users/{user_id}/vacations", response_model=Vacation)
 def add_vacation(user_id: int, vacation_data: VacationCreate, db: Session = Depends(get_db)):
@@ -185,14 +230,45 @@ def add_vacation(user_id: int, vacation_data: VacationCreate, db: Session = Depe
         end_date=vacation_data.end_date
     )
     db.add(db_vacation)
+    manifest_store.refresh_users(db, [user_id], vacation_data.start_date, vacation_data.end_date)
+    dashboard.touch(db, [user_id])
     db.commit()
+    vacation_index.refresh_users(db, [user_id])
     db.refresh(db_vacation)
     return db_vacation
 
+@app.get("/users/{user_id}/vacations/{on_date}", response_model=AwayStatus)
+def get_away_status(user_id: int, on_date: date, db: Session = Depends(get_db)):
+    return {"user_id": user_id, "date": on_date, "away": vacation_index.is_away(db, user_id, on_date)}
+
+@app.get("/vacations/{on_date}", response_model=AwayUsers)
+def get_users_away(on_date: date, db: Session = Depends(get_db)):
+    return {"date": on_date, "user_ids": sorted(vacation_index.away_on(db, on_date))}
+
 # Order endpoints
 @app.get("/users/{user_id}/orders", response_model=List[Order])
-def get_orders(user_id: int, db: Session = Depends(get_db)):
-    return db.query(DBOrder).filter(DBOrder.user_id == user_id).all()
+def get_orders(
+    user_id: int,
+    request: Request,
+    response: Response,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    status: Optional[str] = None,
+    is_adhoc: Optional[bool] = None,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: Session = Depends(get_db)
+):
+    query = archive.orders_of(db, DBOrder, user_id, start_date, end_date, status, is_adhoc)
+    # Orders from before the archive horizon may have been archived
+    archived = None
+    if start_date is None or archive.reaches(start_date):
+        archived = archive.orders_of(db, ArchivedOrder, user_id, start_date, end_date, status, is_adhoc)
+    # Items and their products for the whole page in two queries
+    items = selectinload(DBOrder.items).selectinload(DBOrderItem.product)
+    return pagination.paginate(
+        query, DBOrder, [DBOrder.date, DBOrder.id], page, request, response, options=[items],
+        archived=archived, archived_options=[archive.ORDER_LOADS]
+    )
 
 @app.post("/users/{user_id}/orders", response_model=Order)
 def create_adhoc_order(user_id: int, order_data: OrderCreate, db: Session = Depends(get_db)):
@@ -201,31 +277,24 @@ def create_adhoc_order(user_id: int, order_data: OrderCreate, db: Session = Depe
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    db_order = DBOrder(
-        user_id=user_id,
-        date=order_data.date,
-        is_adhoc=order_data.is_adhoc
-    )
-    db.add(db_order)
-    db.commit()
-    db.refresh(db_order)
-    
-    # Add order items
-    for item_data in order_data.items:
-        db_item = DBOrderItem(
-            order_id=db_order.id,
-            product_id=item_data.product_id,
-            quantity=item_data.quantity
-        )
-        db.add(db_item)
-    
+    order = writes.create_order(db, user_id, order_data)
     db.commit()
-    return db_order
+    return order
 
 # Cancellation endpoints
 @app.get("/users/{user_id}/cancellations", response_model=List[Cancellation])
-def get_cancellations(user_id: int, db: Session = Depends(get_db)):
-    return db.query(DBCancellation).filter(DBCancellation.user_id == user_id).all()
+def get_cancellations(
+    user_id: int,
+    request: Request,
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: Session = Depends(get_db)
+):
+    query = db.query(DBCancellation).filter(DBCancellation.user_id == user_id)
+    archived = db.query(ArchivedCancellation).filter(ArchivedCancellation.user_id == user_id)
+    return pagination.paginate(
+        query, DBCancellation, [DBCancellation.id], page, request, response, schema=Cancellation, archived=archived
+    )
 
 @app.post("/users/{user_id}/cancellations", response_model=Cancellation)
 def create_cancellation(user_id: int, cancellation_data: CancellationCreate, db: Session = Depends(get_db)):
@@ -234,69 +303,224 @@ def create_cancellation(user_id: int, cancellation_data: CancellationCreate, db:
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    db_cancellation = DBCancellation(
-        user_id=user_id,
-        cancellation_type=cancellation_data.cancellation_type,
-        reference_id=cancellation_data.reference_id,
-        reason=cancellation_data.reason
-    )
-    db.add(db_cancellation)
+    db_cancellation = writes.create_cancellation(db, user_id, cancellation_data)
     db.commit()
+    if db_cancellation.cancellation_type == "vacation":
+        vacation_index.refresh_users(db, [user_id])
     db.refresh(db_cancellation)
     return db_cancellation
 
+# Invoice endpoints
+@app.get("/users/{user_id}/invoices", response_model=List[Invoice])
+def get_invoices(
+    user_id: int,
+    request: Request,
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: Session = Depends(get_db)
+):
+    """Stored monthly invoices, oldest first (order=desc for the latest)"""
+    query = db.query(DBInvoice).filter(DBInvoice.user_id == user_id)
+    lines = selectinload(DBInvoice.lines)
+    return pagination.paginate(query, DBInvoice, [DBInvoice.month, DBInvoice.id], page, request, response, options=[lines])
+
+@app.get("/users/{user_id}/invoices/{month}", response_model=Invoice)
+def get_invoice(user_id: int, month: str, db: Session = Depends(get_db)):
+    """The invoice for month (YYYY-MM); a month not billed yet is computed as a preview, without an id"""
+    first = billing.parse_month(month)
+    if db.query(DBUser.id).filter(DBUser.id == user_id).first() is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return billing.get_invoice(db, user_id, first)
+
 # Delivery endpoints
 @app.get("/deliveries/{delivery_date}")
 def get_daily_deliveries(delivery_date: date, db: Session = Depends(get_db)):
-    deliveries = []
-    
-    # Get all active subscriptions
-    subscriptions = db.query(DBSubscription).filter(DBSubscription.is_active == True).all()
-    
-    for subscription in subscriptions:
-        # Check if user is on vacation
-        vacation = db.query(DBVacation).filter(
-            DBVacation.user_id == subscription.user_id,
-            DBVacation.start_date <= delivery_date,
-            DBVacation.end_date >= delivery_date
-        ).first()
-        
-        if not vacation:  # User is not on vacation
-            # Get subscription items
-            subscription_items = db.query(DBSubscriptionItem).filter(
-                DBSubscriptionItem.subscription_id == subscription.id
-            ).all()
-            
-            if subscription_items:
-                delivery_order = {
-                    "user_id": subscription.user_id,
-                    "date": delivery_date,
-                    "items": [{
-                        "product_id": item.product_id,
-                        "quantity": item.quantity
-                    } for item in subscription_items],
-                    "is_subscription": True
-                }
-                deliveries.append(delivery_order)
-    
-    # Add ad-hoc orders for the day
-    adhoc_orders = db.query(DBOrder).filter(
-        DBOrder.date == delivery_date,
-        DBOrder.is_adhoc == True
-    ).all()
-    
-    for order in adhoc_orders:
-        order_items = db.query(DBOrderItem).filter(DBOrderItem.order_id == order.id).all()
-        delivery_order = {
-            "user_id": order.user_id,
-            "date": delivery_date,
-            "items": [{
-                "product_id": item.product_id,
-                "quantity": item.quantity
-            } for item in order_items],
-            "is_subscription": False,
-            "is_adhoc": True
-        }
-        deliveries.append(delivery_order)
-    
+    deliveries = manifest_store.get_deliveries(db, delivery_date)
+    if fast_json.FAST_JSON:
+        return fast_json.FastJSONResponse(deliveries)
     return deliveries
+
+@app.get("/deliveries/{delivery_date}/summary", response_model=DeliverySummary)
+def get_delivery_summary(delivery_date: date, end_date: Optional[date] = None, db: Session = Depends(get_db)):
+    """Per-product totals and revenue for delivery_date, or for delivery_date..end_date"""
+    end_date = end_date or delivery_date
+    if end_date < delivery_date:
+        raise HTTPException(status_code=400, detail="end_date must not be before the delivery date")
+    if (end_date - delivery_date).days >= inventory.MAX_SUMMARY_DAYS:
+        raise HTTPException(status_code=400, detail=f"Summaries cover at most {inventory.MAX_SUMMARY_DAYS} days")
+    return inventory.summarize(db, delivery_date, end_date)
+
+@app.get("/deliveries/{delivery_date}/schedule")
+def get_delivery_schedule(delivery_date: date, days: int = Query(7, ge=1), db: Session = Depends(get_db)):
+    """Deliveries for each of `days` days starting at delivery_date, in one pass"""
+    if days > schedule.MAX_SCHEDULE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Schedules cover at most {schedule.MAX_SCHEDULE_DAYS} days")
+    end_date = date.fromordinal(delivery_date.toordinal() + days - 1)
+    return fast_json.FastJSONResponse(schedule.expand(db, delivery_date, end_date).as_dict())
+
+@app.get("/deliveries/{delivery_date}/stream")
+def stream_daily_deliveries(
+    delivery_date: date,
+    driver_id: Optional[int] = None,
+    block: Optional[List[str]] = Query(None),
+    db: Session = Depends(get_db)
+):
+    """Deliveries as NDJSON, one stop per line with the resident's name and address inline.
+
+    Filter to a delivery person's assigned blocks with driver_id (unassigned
+    delivery persons get every stop) or to explicit house-number blocks with
+    one or more block parameters.
+    """
+    blocks = None
+    if block:
+        blocks = {b.strip().upper() for b in block}
+    elif driver_id is not None:
+        blocks = routing.driver_blocks(db, driver_id) or None
+    return StreamingResponse(
+        manifest_store.ndjson_stream(SessionLocal, delivery_date, blocks), media_type="application/x-ndjson"
+    )
+
+# Live manifest changes as Server-Sent Events, see manifest_events.py
+def driver_blocks(driver_id: int):
+    with SessionLocal() as db:
+        return routing.driver_blocks(db, driver_id)
+
+@app.get("/deliveries/{delivery_date}/events")
+async def follow_deliveries(
+    delivery_date: date,
+    request: Request,
+    driver_id: Optional[int] = None,
+    block: Optional[List[str]] = Query(None)
+):
+    """Stops added, removed or changed on delivery_date, as `stop` events once committed.
+
+    A `reset` event means the day changed as a whole or events were missed:
+    fetch the day again. driver_id and block filter as for /stream. The
+    stream holds no database session or request slot while it waits.
+    """
+    blocks = None
+    if block:
+        blocks = {b.strip().upper() for b in block}
+    elif driver_id is not None:
+        blocks = await run_in_threadpool(driver_blocks, driver_id) or None
+    events = manifest_events.broadcaster.listen(delivery_date, blocks, request.headers.get("last-event-id"))
+    return StreamingResponse(
+        events, media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/deliveries/{delivery_date}/routes")
+def get_delivery_routes(
+    delivery_date: date,
+    drivers: Optional[int] = Query(None, ge=1),
+    capacity: Optional[int] = Query(None, ge=1),
+    product_capacity: Optional[List[str]] = Query(None),
+    db: Session = Depends(get_db)
+):
+    """The day's stops in visiting order, split into routes.
+
+    drivers defaults to the number of delivery persons; capacity caps the
+    units per trip and product_capacity ("product_id:units", repeatable)
+    the units of one product.
+    """
+    limits = route_planner.parse_product_capacity(product_capacity)
+    return fast_json.FastJSONResponse(route_planner.day_plan(db, delivery_date, drivers, capacity, limits))
+
+# Route partitioning endpoints
+@app.get("/drivers/{driver_id}/route/{delivery_date}")
+def get_driver_route(
+    driver_id: int,
+    delivery_date: date,
+    capacity: Optional[int] = Query(None, ge=1),
+    product_capacity: Optional[List[str]] = Query(None),
+    db: Session = Depends(get_db)
+):
+    """A delivery person's ordered stops for delivery_date, as one or more trips"""
+    limits = route_planner.parse_product_capacity(product_capacity)
+    plan = route_planner.driver_route(db, delivery_date, driver_id, capacity, limits)
+    if plan is None:
+        raise HTTPException(status_code=404, detail="Delivery person not found")
+    return fast_json.FastJSONResponse(plan)
+
+@app.get("/drivers/{driver_id}/blocks", response_model=DriverBlocks)
+def get_driver_blocks(driver_id: int, db: Session = Depends(get_db)):
+    return {"blocks": sorted(routing.driver_blocks(db, driver_id))}
+
+@app.put("/drivers/{driver_id}/blocks", response_model=DriverBlocks)
+def set_driver_blocks(driver_id: int, assignment: DriverBlocks, db: Session = Depends(get_db)):
+    driver = db.query(DBUser).filter(DBUser.id == driver_id).first()
+    if not driver or driver.role != "delivery_person":
+        raise HTTPException(status_code=404, detail="Delivery person not found")
+    
+    blocks = routing.set_driver_blocks(db, driver_id, assignment.blocks)
+    db.commit()
+    return {"blocks": sorted(blocks)}
+
+# Delivery status endpoints: a driver's phone syncs queued stop updates in
+# batches (JSON array, NDJSON or CSV), see delivery_status.py
+@app.post("/drivers/{driver_id}/deliveries", response_model=DeliverySyncResult)
+async def sync_delivery_updates(driver_id: int, request: Request, db: Session = Depends(get_db)):
+    rows, errors = await bulk_import.request_rows(request)
+    return await run_in_threadpool(delivery_status.apply_updates, db, driver_id, rows, errors)
+
+@app.get("/deliveries/{delivery_date}/status", response_model=List[DeliveryStatus])
+def get_delivery_status(delivery_date: date, driver_id: Optional[int] = None, db: Session = Depends(get_db)):
+    """The latest reported status of each stop of delivery_date"""
+    return delivery_status.day_status(db, delivery_date, driver_id)
+
+# Background job endpoints
+@app.get("/jobs", response_model=List[Job])
+def get_jobs(
+    request: Request,
+    response: Response,
+    status: Optional[str] = None,
+    name: Optional[str] = None,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: Session = Depends(get_db)
+):
+    """Queued and finished jobs with their attempts, results and errors (order=desc for the latest)"""
+    query = db.query(DBJob)
+    if status:
+        query = query.filter(DBJob.status == status)
+    if name:
+        query = query.filter(DBJob.name == name)
+    return pagination.paginate(query, DBJob, [DBJob.id], page, request, response, schema=Job)
+
+@app.get("/jobs/{job_id}", response_model=Job)
+def get_job(job_id: int, db: Session = Depends(get_db)):
+    job = db.get(DBJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.post("/jobs", response_model=Job)
+def enqueue_job(job_data: JobCreate, db: Session = Depends(get_db)):
+    """Queue a job for the workers; a key that was used before returns that job"""
+    try:
+        return jobs.enqueue(db, **job_data.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Bulk import endpoints: a JSON array, NDJSON or CSV body, by Content-Type.
+# The body is read on the event loop and the import runs in the threadpool.
+@app.post("/import/users", response_model=ImportResult)
+async def import_users(request: Request, role: str = "resident", db: Session = Depends(get_db)):
+    if role not in ("resident", "delivery_person"):
+        raise HTTPException(status_code=400, detail="role must be resident or delivery_person")
+    rows, errors = await bulk_import.request_rows(request)
+    return await run_in_threadpool(bulk_import.import_users, db, rows, role, errors)
+
+@app.post("/import/subscriptions", response_model=ImportResult)
+async def import_subscriptions(request: Request, db: Session = Depends(get_db)):
+    rows, errors = await bulk_import.request_rows(request)
+    return await run_in_threadpool(bulk_import.import_subscriptions, db, rows, errors)
+
+@app.post("/import/vacations", response_model=ImportResult)
+async def import_vacations(request: Request, db: Session = Depends(get_db)):
+    rows, errors = await bulk_import.request_rows(request)
+    return await run_in_threadpool(bulk_import.import_vacations, db, rows, errors)
+
+# Serve the async versions of the endpoints when configured
+if DATABASE_ASYNC:
+    import async_api
+    async_api.install(app)
+    metrics.instrument_engine(async_engine)
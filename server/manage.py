@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for the DailyDoodh server
+Run from the server directory, e.g. `python manage.py rebuild-manifests --days 7`
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import date, datetime, timedelta
+
+import archive
+import billing
+import catalog
+import jobs
+import manifest_store
+import migrations
+from database import SessionLocal, engine
+
+
+def migrate(args):
+    """Create missing tables and apply pending schema migrations (run once per deployment, before the workers start)"""
+    applied = migrations.migrate(engine)
+    for name in applied:
+        print(f"applied {name}")
+    if not applied:
+        print("schema is up to date")
+    if args.sample_data:
+        with SessionLocal() as db:
+            print(f"added {catalog.add_sample_products(db)} sample products")
+    return 0
+
+
+def rebuild_manifests(args):
+    """Rebuild the materialized delivery manifests from scratch"""
+    db = SessionLocal()
+    try:
+        built = manifest_store.rebuild(db, args.start, args.days)
+    finally:
+        db.close()
+    for delivery_date, count in built.items():
+        print(f"{delivery_date}: {count} deliveries")
+    return 0
+
+
+def check_manifests(args):
+    """Diff the materialized manifests against the live computation"""
+    start = args.start or date.today()
+    db = SessionLocal()
+    failures = 0
+    try:
+        for offset in range(args.days):
+            delivery_date = start + timedelta(days=offset)
+            diff = manifest_store.diff_day(db, delivery_date)
+            if diff["missing"] or diff["unexpected"]:
+                failures += 1
+                print(f"❌ {delivery_date}: {len(diff['missing'])} missing, {len(diff['unexpected'])} unexpected")
+                for delivery in diff["missing"]:
+                    print(f"   - missing {delivery}")
+                for delivery in diff["unexpected"]:
+                    print(f"   - unexpected {delivery}")
+            else:
+                print(f"✅ {delivery_date}: consistent")
+    finally:
+        db.close()
+    return 1 if failures else 0
+
+
+def bill(args):
+    """Compute and store every user's invoice for a month"""
+    db = SessionLocal()
+    try:
+        written = billing.run(db, args.month, args.workers, args.replace)
+    finally:
+        db.close()
+    print(f"{args.month:%Y-%m}: {written} invoices written")
+    return 0
+
+
+def archive_history(args):
+    """Move orders, vacations and cancellations older than ARCHIVE_AFTER_MONTHS months into the archive tables"""
+    db = SessionLocal()
+    try:
+        result = archive.run(db)
+    finally:
+        db.close()
+    for month, counts in result["restored"].items():
+        print(f"{month}: restored {counts['orders']} orders, {counts['vacations']} vacations, "
+              f"{counts['cancellations']} cancellations")
+    for month, counts in result["archived"].items():
+        print(f"{month}: archived {counts['orders']} orders, {counts['vacations']} vacations, "
+              f"{counts['cancellations']} cancellations")
+    print(f"rows before {result['horizon']} are archived")
+    return 0
+
+
+def worker(args):
+    """Run background jobs (nightly manifests, billing, cleanup) until interrupted"""
+    job_worker = jobs.Worker(SessionLocal, poll_seconds=args.poll)
+    if args.once:
+        print(f"ran {jobs.work(SessionLocal, job_worker.name)} job(s)")
+        return 0
+    print(f"worker {job_worker.name} polling every {args.poll:.0f}s")
+    try:
+        job_worker.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def list_jobs(args):
+    """Show the most recent jobs and their status"""
+    db = SessionLocal()
+    try:
+        query = db.query(jobs.Job)
+        if args.status:
+            query = query.filter(jobs.Job.status == args.status)
+        for job in query.order_by(jobs.Job.id.desc()).limit(args.limit):
+            print(f"{job.id:6d}  {job.name:20s} {job.status:10s} attempt {job.attempts}/{job.max_attempts}  "
+                  f"{job.key or '-':32s} {job.error or job.result or ''}")
+    finally:
+        db.close()
+    return 0
+
+
+def enqueue(args):
+    """Queue a job now, e.g. `enqueue bill_month --payload '{"month": "2024-03"}'`"""
+    db = SessionLocal()
+    try:
+        job = jobs.enqueue(db, args.name, json.loads(args.payload), key=args.key)
+        print(f"job {job.id}: {job.name} {job.status}")
+    finally:
+        db.close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("migrate", help=migrate.__doc__)
+    command.add_argument("--sample-data", action="store_true", help="add the sample products to an empty catalog")
+    command.set_defaults(handler=migrate)
+
+    for name, handler in (("rebuild-manifests", rebuild_manifests), ("check-manifests", check_manifests)):
+        command = commands.add_parser(name, help=handler.__doc__)
+        command.add_argument("--start", type=date.fromisoformat, default=None, help="first date (default: today)")
+        command.add_argument("--days", type=int, default=manifest_store.MANIFEST_DAYS, help="number of days")
+        command.set_defaults(handler=handler)
+
+    command = commands.add_parser("bill", help=bill.__doc__)
+    command.add_argument("--month", required=True, type=lambda value: datetime.strptime(value, "%Y-%m").date(),
+                         help="YYYY-MM")
+    command.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    command.add_argument("--replace", action="store_true", help="recompute invoices already stored for the month")
+    command.set_defaults(handler=bill)
+
+    command = commands.add_parser("archive", help=archive_history.__doc__)
+    command.set_defaults(handler=archive_history)
+
+    command = commands.add_parser("worker", help=worker.__doc__)
+    command.add_argument("--poll", type=float, default=jobs.JOB_POLL_SECONDS, help="seconds between polls")
+    command.add_argument("--once", action="store_true", help="run the jobs due now, then exit")
+    command.set_defaults(handler=worker)
+
+    command = commands.add_parser("jobs", help=list_jobs.__doc__)
+    command.add_argument("--status", choices=("queued", "running", "succeeded", "failed"))
+    command.add_argument("--limit", type=int, default=20)
+    command.set_defaults(handler=list_jobs)
+
+    command = commands.add_parser("enqueue", help=enqueue.__doc__)
+    command.add_argument("name", choices=sorted(jobs.HANDLERS))
+    command.add_argument("--payload", default="{}", help="JSON object passed to the handler")
+    command.add_argument("--key", help="idempotency key")
+    command.set_defaults(handler=enqueue)
+
+    args = parser.parse_args(argv)
+    # Only `migrate` writes the schema; the other commands refuse to run against an outdated one
+    if args.handler is not migrate:
+        behind = migrations.pending(engine)
+        if behind:
+            print(f"database schema is behind ({', '.join(behind)}); run `python manage.py migrate` first",
+                  file=sys.stderr)
+            return 1
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""Delivery manifest engine.
+
+Builds the list of deliveries for a day with a fixed number of queries, no
+matter how many households are subscribed: one for active subscriptions
+joined to their items (with an anti-join against covering vacations) and one
+for the day's ad-hoc orders joined to their items. Subscriptions that are
+not due that day by their frequency, and cancelled subscriptions and orders
+(see cancellation_index.py), are skipped as the rows stream past; cancelled
+vacations are left out of the anti-join. A day before the archive horizon
+also reads the archived orders and vacations (see archive.py).
+"""
+from datetime import date
+from itertools import groupby
+from operator import attrgetter
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import exists
+from sqlalchemy.orm import Session
+
+import archive
+import cancellation_index
+import frequency
+from db_models import User, Subscription, SubscriptionItem, Order, OrderItem, Vacation, Cancellation, \
+    ArchivedOrder, ArchivedOrderItem
+
+# Rows are pulled from the cursor in batches of this size
+YIELD_PER = 1000
+
+# Resident columns added to each delivery when residents=True
+RESIDENT_COLUMNS = (User.name, User.house_number, User.address)
+
+
+def on_vacation(user_id_column, delivery_date: date, cancelled_vacations: Sequence[int] = ()):
+    """Correlated EXISTS that is true when a vacation, other than the cancelled ones, covers delivery_date"""
+    clause = exists().where(
+        Vacation.user_id == user_id_column,
+        Vacation.start_date <= delivery_date,
+        Vacation.end_date >= delivery_date
+    )
+    if cancelled_vacations:
+        clause = clause.where(Vacation.id.notin_(cancelled_vacations))
+    return clause
+
+
+def is_cancelled(cancellation_type: str, reference_id_column):
+    """Correlated EXISTS that is true when the referenced row has been cancelled
+
+    For set-based queries that aggregate rows before the exclusion index
+    could see their ids.
+    """
+    return exists().where(
+        Cancellation.cancellation_type == cancellation_type,
+        Cancellation.reference_id == reference_id_column
+    )
+
+
+def subscription_item_rows(db: Session, delivery_date: date, user_ids: Optional[Iterable[int]] = None,
+                           residents: bool = False, cancelled_vacations: Sequence[int] = ()):
+    """Active subscription items for users who are not away on delivery_date
+
+    Rows carry the subscription's frequency and created_at; whether it is due
+    on delivery_date, and whether it was cancelled, is decided by the caller
+    (see iter_sources).
+    """
+    query = db.query(
+        Subscription.id.label("source_id"),
+        Subscription.user_id,
+        Subscription.frequency,
+        Subscription.created_at,
+        SubscriptionItem.product_id,
+        SubscriptionItem.quantity
+    )
+    if residents:
+        query = query.add_columns(*RESIDENT_COLUMNS).join(User, User.id == Subscription.user_id)
+    query = query.join(
+        SubscriptionItem, SubscriptionItem.subscription_id == Subscription.id
+    ).filter(
+        Subscription.is_active == True,
+        ~on_vacation(Subscription.user_id, delivery_date, cancelled_vacations)
+    )
+    if archive.reaches(delivery_date):
+        query = query.filter(~archive.on_vacation(Subscription.user_id, delivery_date))
+    if user_ids is not None:
+        query = query.filter(Subscription.user_id.in_(user_ids))
+    return query.order_by(Subscription.id, SubscriptionItem.id).yield_per(YIELD_PER)
+
+
+def _order_rows(db: Session, order, item, delivery_date: date, user_ids: Optional[Iterable[int]], residents: bool):
+    query = db.query(
+        order.id.label("source_id"),
+        order.user_id,
+        item.product_id,
+        item.quantity,
+        item.id.label("item_id")
+    )
+    if residents:
+        query = query.add_columns(*RESIDENT_COLUMNS).join(User, User.id == order.user_id)
+    query = query.outerjoin(
+        item, item.order_id == order.id
+    ).filter(
+        order.date == delivery_date,
+        order.is_adhoc == True
+    )
+    if user_ids is not None:
+        query = query.filter(order.user_id.in_(user_ids))
+    return query
+
+
+def adhoc_order_rows(db: Session, delivery_date: date, user_ids: Optional[Iterable[int]] = None, residents: bool = False):
+    """Ad-hoc orders for delivery_date with their items (orders without items yield one row)"""
+    query = _order_rows(db, Order, OrderItem, delivery_date, user_ids, residents)
+    if archive.reaches(delivery_date):
+        # Archived orders in the same statement; they carry their cancellation
+        query = query.union_all(_order_rows(db, ArchivedOrder, ArchivedOrderItem, delivery_date, user_ids, residents).filter(
+            ArchivedOrder.cancelled == False
+        ))
+    return query.order_by(Order.id, OrderItem.id).yield_per(YIELD_PER)
+
+
+def _items(rows) -> List[dict]:
+    return [{
+        "product_id": row.product_id,
+        "quantity": row.quantity
+    } for row in rows if row.product_id is not None]
+
+
+def add_resident(delivery: dict, row) -> dict:
+    """Inline the resident's name and address so clients need not join against /users"""
+    delivery["name"] = row.name
+    delivery["house_number"] = row.house_number
+    delivery["address"] = row.address
+    return delivery
+
+
+def iter_sources(db: Session, delivery_date: date, user_ids: Optional[Iterable[int]] = None,
+                 residents: bool = False) -> Iterator[Tuple[bool, int, dict]]:
+    """Yield (is_subscription, subscription or order id, delivery) for delivery_date
+
+    Subscriptions due on delivery_date by their frequency come first, in
+    subscription id order, then ad-hoc orders in order id order. Rows are streamed from the cursor, so memory use does not
+    grow with the number of households. Cancellations are applied from the
+    exclusion index.
+    """
+    source = attrgetter("source_id", "user_id")
+    if user_ids is not None:
+        user_ids = list(user_ids)
+    cancelled = cancellation_index.exclusions(db)
+    cancelled_vacations = cancelled.vacations_overlapping(delivery_date, delivery_date)
+
+    for (subscription_id, user_id), rows in groupby(
+        subscription_item_rows(db, delivery_date, user_ids, residents, cancelled_vacations), key=source
+    ):
+        if subscription_id in cancelled.subscriptions:
+            continue
+        rows = list(rows)
+        if not frequency.delivers_on(rows[0].frequency, rows[0].created_at, delivery_date):
+            continue
+        delivery = {
+            "user_id": user_id,
+            "date": delivery_date,
+            "items": _items(rows),
+            "is_subscription": True
+        }
+        yield True, subscription_id, add_resident(delivery, rows[0]) if residents else delivery
+
+    for (order_id, user_id), rows in groupby(adhoc_order_rows(db, delivery_date, user_ids, residents), key=source):
+        if order_id in cancelled.orders:
+            continue
+        rows = list(rows)
+        delivery = {
+            "user_id": user_id,
+            "date": delivery_date,
+            "items": _items(rows),
+            "is_subscription": False,
+            "is_adhoc": True
+        }
+        yield False, order_id, add_resident(delivery, rows[0]) if residents else delivery
+
+
+def iter_deliveries(db: Session, delivery_date: date, user_ids: Optional[Iterable[int]] = None,
+                    residents: bool = False) -> Iterator[dict]:
+    """Yield the deliveries for delivery_date: subscriptions first, then ad-hoc orders"""
+    for _, _, delivery in iter_sources(db, delivery_date, user_ids, residents):
+        yield delivery
+
+
+def build_manifest(db: Session, delivery_date: date, user_ids: Optional[Iterable[int]] = None) -> List[dict]:
+    """All deliveries for delivery_date as a list"""
+    return list(iter_deliveries(db, delivery_date, user_ids))
@@ -0,0 +1,208 @@
+"""Live manifest changes for driver dashboards.
+
+When a write changes the stops of a materialized day (manifest_store's
+refresh re-derives the affected users' entries), the stops that were added,
+removed or changed are published as events once the transaction commits;
+a rolled-back write publishes nothing. Dashboards follow a day with
+Server-Sent Events (GET /deliveries/{date}/events) instead of re-fetching
+the whole manifest.
+
+Fan-out is in-process, and an event is encoded once however many clients
+listen: it is rendered to its SSE frame, appended to a shared log of the
+last MANIFEST_EVENTS_BACKLOG events, and the listeners, parked on one
+asyncio.Event per event loop, are woken together to copy the frames of
+their day (and blocks) from the log. Nothing polls: besides publishes,
+listeners only wake on one shared tick every MANIFEST_EVENTS_PING seconds,
+so that idle streams send a comment and proxies keep them open. A client that
+reconnects with Last-Event-ID gets what it missed; one that fell further
+behind than the log, or that was connected to another process or to a
+restarted one (event ids carry a per-process token), gets a `reset` event
+and re-fetches the day, as it does after a day is rebuilt from scratch.
+
+Events only reach clients of the process that made the write, so with
+several API processes a dashboard also sees the others' changes only on its
+next full fetch.
+"""
+import asyncio
+import json
+import os
+import threading
+import uuid
+from datetime import date
+from typing import AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import routing
+
+# Events kept for listeners that are behind or reconnecting
+MANIFEST_EVENTS_BACKLOG = int(os.environ.get("MANIFEST_EVENTS_BACKLOG", "10000"))
+
+# Seconds between keep-alive comments on an idle stream
+MANIFEST_EVENTS_PING = float(os.environ.get("MANIFEST_EVENTS_PING", "15"))
+
+# Milliseconds a disconnected EventSource waits before reconnecting
+RECONNECT_MS = 3000
+
+
+class Frame(NamedTuple):
+    delivery_date: date
+    block: Optional[str]  # None for events about the whole day
+    text: str
+
+
+def stop_change(kind: str, delivery_date: date, user_id: int, resident, deliveries: List[dict]) -> dict:
+    """A stop ("added", "removed" or "changed") with its resident and its deliveries now"""
+    return {
+        "type": kind,
+        "date": delivery_date,
+        "user_id": user_id,
+        "name": resident.name if resident else None,
+        "house_number": resident.house_number if resident else None,
+        "address": resident.address if resident else None,
+        "deliveries": deliveries
+    }
+
+
+class Broadcaster:
+    """A log of rendered events that listeners follow"""
+
+    def __init__(self, backlog: int = MANIFEST_EVENTS_BACKLOG, ping: float = MANIFEST_EVENTS_PING):
+        self.backlog = backlog
+        self.ping = ping
+        self.token = uuid.uuid4().hex[:8]
+        self.listeners = 0
+        self._frames: Dict[int, Frame] = {}
+        self._first = 1
+        self._last = 0
+        self._lock = threading.Lock()
+        # Per event loop: the event its listeners wait on, their number and the keep-alive task
+        self._changed: Dict[asyncio.AbstractEventLoop, asyncio.Event] = {}
+        self._listening: Dict[asyncio.AbstractEventLoop, int] = {}
+        self._pingers: Dict[asyncio.AbstractEventLoop, asyncio.Task] = {}
+
+    def publish(self, changes: Iterable[dict]) -> None:
+        """Append stop changes and whole-day resets ({"type": "reset", "date": ...}); thread-safe"""
+        with self._lock:
+            for change in changes:
+                self._last += 1
+                name = "reset" if change["type"] == "reset" else "stop"
+                block = routing.block_of(change["house_number"]) if name == "stop" else None
+                data = json.dumps(change, default=str)
+                self._frames[self._last] = Frame(
+                    change["date"], block, f"id: {self.token}:{self._last}\nevent: {name}\ndata: {data}\n\n"
+                )
+            while self._last - self._first >= self.backlog:
+                del self._frames[self._first]
+                self._first += 1
+            loops = list(self._changed)
+        for loop in loops:
+            if loop.is_closed():
+                self._changed.pop(loop, None)
+            else:
+                loop.call_soon_threadsafe(self._wake, loop)
+
+    def _wake(self, loop: asyncio.AbstractEventLoop) -> None:
+        changed = self._changed.get(loop)
+        self._changed[loop] = asyncio.Event()
+        if changed is not None:
+            changed.set()
+
+    def cursor(self, last_event_id: Optional[str]) -> Optional[int]:
+        """The position after last_event_id, or None when it is not one of this log's"""
+        if last_event_id is None:
+            return self._last
+        token, _, number = last_event_id.partition(":")
+        if token != self.token or not number.isdigit() or int(number) > self._last:
+            return None
+        return int(number)
+
+    def _since(self, cursor: int, delivery_date: date, blocks: Optional[Set[str]]) -> Tuple[List[str], int, bool]:
+        with self._lock:
+            lost = cursor < self._first - 1
+            texts = [
+                frame.text
+                for frame in (self._frames[number] for number in range(max(cursor, self._first - 1) + 1, self._last + 1))
+                if frame.delivery_date == delivery_date and (blocks is None or frame.block is None or frame.block in blocks)
+            ]
+            return texts, self._last, lost
+
+    def _join(self, loop: asyncio.AbstractEventLoop) -> None:
+        with self._lock:
+            self.listeners += 1
+            self._listening[loop] = self._listening.get(loop, 0) + 1
+            self._changed.setdefault(loop, asyncio.Event())
+        if loop not in self._pingers:
+            self._pingers[loop] = loop.create_task(self._keep_alive(loop))
+
+    def _leave(self, loop: asyncio.AbstractEventLoop) -> None:
+        with self._lock:
+            self.listeners -= 1
+            self._listening[loop] -= 1
+
+    async def _keep_alive(self, loop: asyncio.AbstractEventLoop) -> None:
+        # One timer per loop rather than one per listener: every ping seconds
+        # all listeners wake, and those idle for a while send a comment
+        try:
+            while self._listening.get(loop):
+                await asyncio.sleep(self.ping)
+                self._wake(loop)
+        finally:
+            self._pingers.pop(loop, None)
+
+    async def listen(self, delivery_date: date, blocks: Optional[Set[str]] = None,
+                     last_event_id: Optional[str] = None) -> AsyncIterator[str]:
+        """SSE text for delivery_date's events in blocks (all when None), from after last_event_id"""
+        loop = asyncio.get_running_loop()
+        self._join(loop)
+        cursor = self.cursor(last_event_id)
+        try:
+            yield f"retry: {RECONNECT_MS}\n\n"
+            if cursor is None:
+                cursor = self._last
+                yield _reset(delivery_date)
+            sent = loop.time()
+            while True:
+                changed = self._changed[loop]
+                texts, cursor, lost = self._since(cursor, delivery_date, blocks)
+                if lost or texts:
+                    yield _reset(delivery_date) if lost else "".join(texts)
+                    sent = loop.time()
+                    continue
+                if loop.time() - sent >= self.ping:
+                    yield ": ping\n\n"
+                    sent = loop.time()
+                await changed.wait()
+        finally:
+            self._leave(loop)
+
+    def stats(self) -> dict:
+        return {"listeners": self.listeners, "published": self._last, "kept": len(self._frames)}
+
+
+def _reset(delivery_date: date) -> str:
+    return f"event: reset\ndata: {json.dumps({'type': 'reset', 'date': delivery_date.isoformat()})}\n\n"
+
+
+broadcaster = Broadcaster()
+
+
+# Publishing on commit
+
+def record(db: Session, changes: Iterable[dict]) -> None:
+    """Publish changes when db's transaction commits; they are dropped if it rolls back"""
+    db.info.setdefault("manifest_events", []).extend(changes)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish(session: Session) -> None:
+    changes = session.info.pop("manifest_events", None)
+    if changes:
+        broadcaster.publish(changes)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard(session: Session, transaction) -> None:
+    if transaction.parent is None:
+        session.info.pop("manifest_events", None)
@@ -0,0 +1,243 @@
+"""Materialized delivery manifests.
+
+Manifests for upcoming days are built ahead of time into the manifest_days and
+manifest_entries tables, so reading a day is one keyed query. The write
+endpoints keep them current by re-deriving only the affected user's entries
+on the affected dates, and publish the stops that changed to the dashboards
+following those days (see manifest_events.py). Days that were never
+materialized fall back to the live computation in manifest.py.
+"""
+import json
+import os
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from types import SimpleNamespace
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+import manifest
+import manifest_events
+import routing
+from db_models import User, ManifestDay, ManifestEntry
+
+# How many days ahead (including today) the rebuild command materializes
+MANIFEST_DAYS = int(os.environ.get("MANIFEST_DAYS", "7"))
+
+
+def _entry_row(delivery_date: date, is_subscription: bool, source_id: int, delivery: dict) -> dict:
+    return {
+        "delivery_date": delivery_date,
+        "user_id": delivery["user_id"],
+        "is_subscription": is_subscription,
+        "source_id": source_id,
+        "items": json.dumps(delivery["items"])
+    }
+
+
+def _delivery(delivery_date: date, entry) -> dict:
+    delivery = {
+        "user_id": entry.user_id,
+        "date": delivery_date,
+        "items": json.loads(entry.items),
+        "is_subscription": entry.is_subscription
+    }
+    if not entry.is_subscription:
+        delivery["is_adhoc"] = True
+    return delivery
+
+
+def load(db: Session, delivery_date: date) -> Optional[List[dict]]:
+    """The materialized manifest for delivery_date, or None if it was never built"""
+    rows = db.query(
+        ManifestDay.delivery_date,
+        ManifestEntry.user_id,
+        ManifestEntry.is_subscription,
+        ManifestEntry.items
+    ).outerjoin(
+        ManifestEntry, ManifestEntry.delivery_date == ManifestDay.delivery_date
+    ).filter(
+        ManifestDay.delivery_date == delivery_date
+    ).order_by(
+        ManifestEntry.is_subscription.desc(), ManifestEntry.source_id
+    ).all()
+
+    if not rows:
+        return None
+    return [_delivery(delivery_date, row) for row in rows if row.user_id is not None]
+
+
+def get_deliveries(db: Session, delivery_date: date) -> List[dict]:
+    """Deliveries for delivery_date, from the materialized manifest when there is one"""
+    deliveries = load(db, delivery_date)
+    if deliveries is None:
+        deliveries = manifest.build_manifest(db, delivery_date)
+    return deliveries
+
+
+def is_materialized(db: Session, delivery_date: date) -> bool:
+    return db.query(ManifestDay.delivery_date).filter(ManifestDay.delivery_date == delivery_date).first() is not None
+
+
+def iter_deliveries(db: Session, delivery_date: date, residents: bool = False) -> Iterator[dict]:
+    """Stream deliveries for delivery_date, from the materialized manifest when there is one
+
+    With residents=True each delivery also carries the resident's name,
+    house_number and address.
+    """
+    if not is_materialized(db, delivery_date):
+        yield from manifest.iter_deliveries(db, delivery_date, residents=residents)
+        return
+
+    query = db.query(ManifestEntry.user_id, ManifestEntry.is_subscription, ManifestEntry.items)
+    if residents:
+        query = query.add_columns(*manifest.RESIDENT_COLUMNS).join(User, User.id == ManifestEntry.user_id)
+    query = query.filter(
+        ManifestEntry.delivery_date == delivery_date
+    ).order_by(
+        ManifestEntry.is_subscription.desc(), ManifestEntry.source_id
+    ).yield_per(manifest.YIELD_PER)
+
+    for row in query:
+        delivery = _delivery(delivery_date, row)
+        yield manifest.add_resident(delivery, row) if residents else delivery
+
+
+def ndjson_stream(session_factory, delivery_date: date, blocks: Optional[Set[str]] = None) -> Iterator[str]:
+    """Deliveries for delivery_date in the given blocks as NDJSON lines, with residents inline
+
+    The stream opens its own session from session_factory because a streaming
+    response outlives the request's dependencies.
+    """
+    db = session_factory()
+    try:
+        for delivery in routing.in_blocks(iter_deliveries(db, delivery_date, residents=True), blocks):
+            yield json.dumps(delivery, default=str) + "\n"
+    finally:
+        db.close()
+
+
+def materialized_dates(db: Session, start: Optional[date] = None, end: Optional[date] = None) -> List[date]:
+    """Materialized days between start and end inclusive (open-ended when omitted)"""
+    query = db.query(ManifestDay.delivery_date)
+    if start is not None:
+        query = query.filter(ManifestDay.delivery_date >= start)
+    if end is not None:
+        query = query.filter(ManifestDay.delivery_date <= end)
+    return [row.delivery_date for row in query.order_by(ManifestDay.delivery_date)]
+
+
+def build_day(db: Session, delivery_date: date) -> int:
+    """Materialize delivery_date from scratch, replacing any previous build
+
+    Returns the number of deliveries stored. The caller commits.
+    """
+    db.query(ManifestEntry).filter(ManifestEntry.delivery_date == delivery_date).delete(synchronize_session=False)
+    db.query(ManifestDay).filter(ManifestDay.delivery_date == delivery_date).delete(synchronize_session=False)
+    db.add(ManifestDay(delivery_date=delivery_date))
+    db.flush()
+    manifest_events.record(db, [{"type": "reset", "date": delivery_date}])
+
+    count = 0
+    batch = []
+    for is_subscription, source_id, delivery in manifest.iter_sources(db, delivery_date):
+        batch.append(_entry_row(delivery_date, is_subscription, source_id, delivery))
+        if len(batch) >= manifest.YIELD_PER:
+            db.execute(insert(ManifestEntry), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        db.execute(insert(ManifestEntry), batch)
+        count += len(batch)
+    return count
+
+
+def rebuild(db: Session, start: Optional[date] = None, days: int = MANIFEST_DAYS) -> Dict[date, int]:
+    """Rebuild the manifests for `days` days from start (today by default) and commit"""
+    start = start or date.today()
+    built = {}
+    for offset in range(days):
+        delivery_date = start + timedelta(days=offset)
+        built[delivery_date] = build_day(db, delivery_date)
+    db.commit()
+    return built
+
+
+def _stops(delivery_date: date, entries) -> Dict[int, list]:
+    """Each user's deliveries from (user_id, is_subscription, source_id, items) entries, in manifest order"""
+    stops = defaultdict(list)
+    for entry in sorted(entries, key=lambda entry: (not entry.is_subscription, entry.source_id)):
+        stops[entry.user_id].append(_delivery(delivery_date, entry))
+    return stops
+
+
+def _changes(db: Session, delivery_date: date, before: Dict[int, list], after: Dict[int, list]) -> List[dict]:
+    changed = [user_id for user_id in sorted(set(before) | set(after)) if before.get(user_id) != after.get(user_id)]
+    if not changed:
+        return []
+    residents = {row.id: row for row in db.query(User.id, *manifest.RESIDENT_COLUMNS).filter(User.id.in_(changed))}
+    return [
+        manifest_events.stop_change(
+            "added" if user_id not in before else "removed" if user_id not in after else "changed",
+            delivery_date, user_id, residents.get(user_id), after.get(user_id, [])
+        )
+        for user_id in changed
+    ]
+
+
+def refresh_users(db: Session, user_ids: Iterable[int], start: Optional[date] = None, end: Optional[date] = None) -> List[date]:
+    """Re-derive the given users' entries on every materialized day in [start, end]
+
+    start defaults to today: past days are kept as the snapshot of what was
+    scheduled. Pending changes in the session are flushed first so they are
+    seen by the recomputation; the caller commits, which publishes the stops
+    that changed. Returns the refreshed days.
+    """
+    user_ids = list(user_ids)
+    start = max(start or date.today(), date.today())
+    if end is not None and end < start:
+        return []
+
+    db.flush()
+    dates = materialized_dates(db, start, end)
+    for delivery_date in dates:
+        stale = db.query(
+            ManifestEntry.user_id, ManifestEntry.is_subscription, ManifestEntry.source_id, ManifestEntry.items
+        ).filter(
+            ManifestEntry.delivery_date == delivery_date,
+            ManifestEntry.user_id.in_(user_ids)
+        ).all()
+        db.query(ManifestEntry).filter(
+            ManifestEntry.delivery_date == delivery_date,
+            ManifestEntry.user_id.in_(user_ids)
+        ).delete(synchronize_session=False)
+        rows = [
+            _entry_row(delivery_date, is_subscription, source_id, delivery)
+            for is_subscription, source_id, delivery in manifest.iter_sources(db, delivery_date, user_ids)
+        ]
+        if rows:
+            db.execute(insert(ManifestEntry), rows)
+        manifest_events.record(db, _changes(
+            db, delivery_date, _stops(delivery_date, stale), _stops(delivery_date, [SimpleNamespace(**row) for row in rows])
+        ))
+    return dates
+
+
+def diff_day(db: Session, delivery_date: date) -> Dict[str, list]:
+    """Compare the materialized manifest for delivery_date with the live computation
+
+    Returns the deliveries only the live computation has ("missing") and the
+    ones only the materialized manifest has ("unexpected"). Both are empty
+    when the two agree; a day that was never built reports every live
+    delivery as missing.
+    """
+    def key(delivery):
+        return json.dumps(delivery, sort_keys=True, default=str)
+
+    live = Counter(key(d) for d in manifest.iter_deliveries(db, delivery_date))
+    stored = Counter(key(d) for d in (load(db, delivery_date) or []))
+    return {
+        "missing": [json.loads(k) for k in (live - stored).elements()],
+        "unexpected": [json.loads(k) for k in (stored - live).elements()]
+    }
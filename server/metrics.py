@@ -0,0 +1,220 @@
+"""Request latency and SQL instrumentation.
+
+`install(app)` adds a middleware that times every request and a GET /metrics
+endpoint serving the results in the Prometheus text format, per method and
+route template (/users/{user_id}, not /users/42):
+
+- http_requests_total, by status code
+- http_request_duration_seconds: request start to the last body byte
+- http_request_sql_queries and http_request_sql_duration_seconds: statements
+  the request sent and the time spent in them
+
+SQL is attributed to requests through SQLAlchemy cursor events on the
+engines passed to `instrument_engine`, and a context variable set by the
+middleware; it follows the request into the threadpool and into async
+sessions. Statements run outside a request (startup, the CLI) are not counted.
+
+With SLOW_REQUEST_MS set, requests slower than that are logged at WARNING
+level on the "dailydoodh.slow_requests" logger with every statement they
+issued and its time (statements only, never parameters). An N+1 regression
+shows up there as a long run of the same SELECT.
+"""
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+
+# Log requests slower than this many milliseconds with their SQL; 0 disables
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "0"))
+
+# Statements kept per request for the slow-request log
+MAX_LOGGED_STATEMENTS = 200
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+logger = logging.getLogger("dailydoodh.slow_requests")
+
+
+class RequestStats:
+    """SQL issued while serving one request"""
+    __slots__ = ("queries", "sql_seconds", "statements")
+
+    def __init__(self, log_statements: bool):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.statements: Optional[List[Tuple[float, str]]] = [] if log_statements else None
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.series: Dict[tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, labels: tuple, value: float) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[n] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def lines(self, label_names) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.series.items()):
+            base = _labels(label_names, labels)
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{base},le="{_number(bound)}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{base}}} {_number(series[-2])}")
+            lines.append(f"{self.name}_count{{{base}}} {series[-1]}")
+        return lines
+
+
+ROUTE_LABELS = ("method", "route")
+
+_lock = threading.Lock()
+_requests: Dict[tuple, int] = {}
+_latency = Histogram("http_request_duration_seconds", "Request latency in seconds.", LATENCY_BUCKETS)
+_queries = Histogram("http_request_sql_queries", "SQL statements per request.", QUERY_BUCKETS)
+_sql_time = Histogram("http_request_sql_duration_seconds", "Time per request spent in SQL, in seconds.", LATENCY_BUCKETS)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values) -> str:
+    return ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metrics_started"].pop()
+    stats = _current.get()
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.sql_seconds += elapsed
+    if stats.statements is not None and len(stats.statements) < MAX_LOGGED_STATEMENTS:
+        stats.statements.append((elapsed, statement))
+
+
+def instrument_engine(engine) -> None:
+    """Attribute the statements of engine (sync or async) to the current request"""
+    sync_engine = getattr(engine, "sync_engine", engine)
+    if not event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _route(request: Request) -> str:
+    route = request.scope.get("route")
+    return getattr(route, "path", None) or "<unmatched>"
+
+
+def record(request: Request, status: int, seconds: float, stats: RequestStats) -> None:
+    labels = (request.method, _route(request))
+    with _lock:
+        key = labels + (status,)
+        _requests[key] = _requests.get(key, 0) + 1
+        _latency.observe(labels, seconds)
+        _queries.observe(labels, stats.queries)
+        _sql_time.observe(labels, stats.sql_seconds)
+
+    if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+        statements = "".join(f"\n  {elapsed * 1000:8.2f} ms  {' '.join(sql.split())}" for elapsed, sql in stats.statements or ())
+        if stats.queries > len(stats.statements or ()):
+            statements += f"\n  ... {stats.queries - len(stats.statements or ())} more"
+        logger.warning(
+            "Slow request %s %s -> %d: %.1f ms, %d queries in %.1f ms%s",
+            request.method, request.url.path, status, seconds * 1000, stats.queries, stats.sql_seconds * 1000, statements
+        )
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format"""
+    with _lock:
+        lines = ["# HELP http_requests_total Requests served.", "# TYPE http_requests_total counter"]
+        for key, count in sorted(_requests.items()):
+            lines.append(f"http_requests_total{{{_labels(ROUTE_LABELS + ('status',), key)}}} {count}")
+        for histogram in (_latency, _queries, _sql_time):
+            lines.extend(histogram.lines(ROUTE_LABELS))
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    with _lock:
+        _requests.clear()
+        for histogram in (_latency, _queries, _sql_time):
+            histogram.series.clear()
+
+
+def install(app: FastAPI) -> None:
+    """Add the timing middleware and the /metrics endpoint to app
+
+    Install after any other middleware so the time a request waits for
+    admission is part of its latency.
+    """
+    @app.middleware("http")
+    async def record_request_metrics(request: Request, call_next):
+        stats = RequestStats(SLOW_REQUEST_MS > 0)
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await call_next(request)
+        except Exception:
+            record(request, 500, time.perf_counter() - started, stats)
+            raise
+        finally:
+            _current.reset(token)
+
+        # Event streams stay open for as long as the client listens; they are
+        # timed to their start
+        if response.headers.get("content-type", "").startswith("text/event-stream"):
+            record(request, response.status_code, time.perf_counter() - started, stats)
+            return response
+
+        # Streamed bodies are produced after call_next returns; stop the clock
+        # (and the SQL count) when the last chunk has been sent
+        body = response.body_iterator
+
+        async def observed_body():
+            status = response.status_code
+            try:
+                async for chunk in body:
+                    yield chunk
+            except Exception:
+                status = 500
+                raise
+            finally:
+                record(request, status, time.perf_counter() - started, stats)
+
+        response.body_iterator = observed_body()
+        return response
+
+    @app.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        return PlainTextResponse(render(), media_type=CONTENT_TYPE)
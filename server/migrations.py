@@ -0,0 +1,112 @@
+"""Schema migrations.
+
+`Base.metadata.create_all` only creates missing tables; it never touches
+tables that already exist, so indexes and columns added to db_models.py do
+not reach existing databases. Each change to an existing table is
+registered here as a numbered migration and applied once, in order, by
+`migrate()` (or `python manage.py migrate`). Applied versions are recorded in
+the schema_migrations table. Migrations must be safe to run against a
+database that create_all has just built, since fresh databases already have
+everything the models declare.
+"""
+from typing import Callable, List, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from db_models import (
+    Base, User, Subscription, SubscriptionItem, Order, OrderItem, Vacation, Cancellation, SchemaMigration
+)
+
+
+def _create_indexes(connection: Connection, *tables) -> None:
+    """Create the model-declared indexes of tables that are missing in the database"""
+    for table in tables:
+        existing = {index["name"] for index in inspect(connection).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=connection)
+
+
+def _add_columns(connection: Connection, table, *names) -> None:
+    """Add model-declared columns of table that are missing in the database (nullable, no default)"""
+    existing = {column["name"] for column in inspect(connection).get_columns(table.name)}
+    for name in names:
+        if name not in existing:
+            column_type = table.c[name].type.compile(dialect=connection.dialect)
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {name} {column_type}"))
+
+
+def add_hot_path_indexes(connection: Connection) -> None:
+    """Indexes for the delivery, subscription, order and cancellation lookups"""
+    _create_indexes(
+        connection,
+        Subscription.__table__,
+        SubscriptionItem.__table__,
+        Order.__table__,
+        OrderItem.__table__,
+        Vacation.__table__,
+        Cancellation.__table__
+    )
+
+
+def add_order_history_index(connection: Connection) -> None:
+    """(user_id, date) index for paging through a user's order history"""
+    _create_indexes(connection, Order.__table__)
+
+
+def add_user_coordinates(connection: Connection) -> None:
+    """Optional latitude/longitude of each user, for the route planner"""
+    _add_columns(connection, User.__table__, "latitude", "longitude")
+
+
+def add_cancellation_reference_index(connection: Connection) -> None:
+    """(cancellation_type, reference_id) index for the cancellation anti-joins"""
+    _create_indexes(connection, Cancellation.__table__)
+
+
+def add_user_version(connection: Connection) -> None:
+    """Per-user version stamp of the resident dashboard, 0 for existing users"""
+    existing = {column["name"] for column in inspect(connection).get_columns(User.__tablename__)}
+    if "version" not in existing:
+        connection.execute(text(f"ALTER TABLE {User.__tablename__} ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+
+
+# (version, migration) in the order they must be applied; never renumber
+MIGRATIONS: List[Tuple[int, Callable[[Connection], None]]] = [
+    (1, add_hot_path_indexes),
+    (2, add_order_history_index),
+    (3, add_user_coordinates),
+    (4, add_cancellation_reference_index),
+    (5, add_user_version),
+]
+
+
+def applied_versions(connection: Connection) -> set:
+    return {row.version for row in connection.execute(SchemaMigration.__table__.select())}
+
+
+def pending(engine: Engine) -> List[str]:
+    """Missing tables and unapplied migrations, by name; empty when the schema is current (reads only)"""
+    existing = set(inspect(engine).get_table_names())
+    missing = [f"table {table.name}" for table in Base.metadata.sorted_tables if table.name not in existing]
+    if SchemaMigration.__tablename__ not in existing:
+        return missing + [migration.__name__ for _, migration in MIGRATIONS]
+    with engine.connect() as connection:
+        done = applied_versions(connection)
+    return missing + [migration.__name__ for version, migration in MIGRATIONS if version not in done]
+
+
+def migrate(engine: Engine) -> List[str]:
+    """Create missing tables and apply pending migrations; returns the names applied"""
+    Base.metadata.create_all(bind=engine)
+    applied = []
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+        for version, migration in MIGRATIONS:
+            if version in done:
+                continue
+            migration(connection)
+            connection.execute(SchemaMigration.__table__.insert().values(version=version, name=migration.__name__))
+            applied.append(migration.__name__)
+    return applied
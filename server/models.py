@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Json
+from typing import Any, List, Optional
 from datetime import date, datetime
 
 class Product(BaseModel):
@@ -18,6 +18,8 @@ class UserCreate(BaseModel):
     email: str
     house_number: str
     address: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 class User(BaseModel):
     id: Optional[int] = None
@@ -26,6 +28,8 @@ class User(BaseModel):
     house_number: str
     address: Optional[str] = None
     role: str = "resident"  # resident or delivery_person
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
     created_at: Optional[datetime] = None
     
     class Config:
@@ -118,3 +122,120 @@ class Cancellation(BaseModel):
     
     class Config:
         orm_mode = True
+
+class DriverBlocks(BaseModel):
+    blocks: List[str]
+
+class ProductTotal(BaseModel):
+    product_id: int
+    name: str
+    quantity: int
+    revenue: float
+
+class DailySummary(BaseModel):
+    date: date
+    products: List[ProductTotal]
+    total_quantity: int
+    total_revenue: float
+
+class DeliverySummary(BaseModel):
+    start_date: date
+    end_date: date
+    days: List[DailySummary]
+    products: List[ProductTotal]
+    total_quantity: int
+    total_revenue: float
+
+class ImportRowError(BaseModel):
+    row: int
+    error: str
+
+class ImportResult(BaseModel):
+    imported: int
+    errors: List[ImportRowError]
+
+class DeliveryUpdateCreate(BaseModel):
+    client_id: str
+    user_id: int
+    delivery_date: date
+    status: str
+    recorded_at: Optional[datetime] = None
+    note: Optional[str] = None
+
+class DeliverySyncResult(BaseModel):
+    applied: int
+    duplicates: List[str]
+    errors: List[ImportRowError]
+
+class DeliveryStatus(BaseModel):
+    user_id: int
+    delivery_date: date
+    status: str
+    driver_id: int
+    recorded_at: datetime
+    note: Optional[str] = None
+
+class Dashboard(BaseModel):
+    user: User
+    products: List[Product]
+    subscription: Optional[Subscription] = None
+    orders: List[Order]
+    vacations: List[Vacation]
+    cancellations: List[Cancellation]
+
+class AwayStatus(BaseModel):
+    user_id: int
+    date: date
+    away: bool
+
+class AwayUsers(BaseModel):
+    date: date
+    user_ids: List[int]
+
+class InvoiceLine(BaseModel):
+    product_id: int
+    product_name: str
+    unit_price: float
+    quantity: int
+    amount: float
+
+    class Config:
+        orm_mode = True
+
+class Invoice(BaseModel):
+    id: Optional[int] = None  # None for a month not billed yet (a preview)
+    user_id: int
+    month: date
+    total_quantity: int
+    total_amount: float
+    lines: List[InvoiceLine]
+    created_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+
+class JobCreate(BaseModel):
+    name: str
+    payload: dict = {}
+    key: Optional[str] = None  # idempotency key; an existing job with it is returned instead
+    run_after: Optional[datetime] = None
+    max_attempts: int = 3
+
+class Job(BaseModel):
+    id: int
+    name: str
+    key: Optional[str] = None
+    payload: Optional[Json[Any]] = None
+    status: str  # queued, running, succeeded or failed
+    attempts: int
+    max_attempts: int
+    run_after: datetime
+    worker: Optional[str] = None
+    result: Optional[Json[Any]] = None
+    error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
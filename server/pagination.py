@@ -0,0 +1,163 @@
+"""Keyset pagination and sparse fields for the list endpoints.
+
+List endpoints are ordered by a unique key, e.g. (date, id) for orders.
+Without `limit` or `after` they return every row, as before pagination;
+with either, at most `limit` rows (DEFAULT_LIMIT when only a cursor is
+given, at most MAX_LIMIT). The body stays a plain JSON array; when more
+rows follow, the response carries an opaque cursor in `X-Next-Cursor` and
+a `Link: <...>; rel="next"` header, and the next page is requested with
+`after=<cursor>`. The cursor holds the
+last row's key, so a page is an index range scan
+(`WHERE (date, id) > (:date, :id) ORDER BY date, id LIMIT n`) however deep
+into the history it is, unlike OFFSET.
+
+`fields=id,name` selects only those columns, both from the database and in
+the response, and skips per-row model validation (see fast_json).
+"""
+import base64
+import json
+from datetime import date, datetime
+from operator import attrgetter
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+from fastapi import HTTPException, Query, Request
+from sqlalchemy import Date, DateTime, tuple_
+from sqlalchemy.orm import Query as OrmQuery
+
+import fast_json
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class PageParams(NamedTuple):
+    limit: Optional[int]
+    after: Optional[str]
+    order: str
+    fields: Optional[List[str]]
+
+
+def page_params(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_LIMIT, description="page size; all rows when omitted"),
+    after: Optional[str] = Query(None, description="cursor from the previous page's X-Next-Cursor"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    fields: Optional[str] = Query(None, description="comma-separated columns to return")
+) -> PageParams:
+    """Dependency for the pagination query parameters"""
+    selected = [name.strip() for name in fields.split(",") if name.strip()] if fields else None
+    if limit is None and after:
+        limit = DEFAULT_LIMIT
+    return PageParams(limit, after, order, selected)
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    payload = json.dumps([value.isoformat() if isinstance(value, (date, datetime)) else value for value in values])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, columns: Sequence) -> tuple:
+    """The key values in a cursor, typed like columns; 400 when malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError("wrong key length")
+        typed = []
+        for column, value in zip(columns, values):
+            if isinstance(column.type, DateTime):
+                value = datetime.fromisoformat(value)
+            elif isinstance(column.type, Date):
+                value = date.fromisoformat(value)
+            typed.append(value)
+        return tuple(typed)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+
+
+def _page_headers(request: Optional[Request], cursor: Optional[str]) -> Dict[str, str]:
+    if cursor is None:
+        return {}
+    headers = {"X-Next-Cursor": cursor}
+    if request is not None:
+        headers["Link"] = f'<{request.url.include_query_params(after=cursor)}>; rel="next"'
+    return headers
+
+
+def _page(query: OrmQuery, model, key_columns: Sequence, params: PageParams, fields: Optional[List[str]],
+          options: Sequence) -> list:
+    """Up to params.limit + 1 rows of query after the cursor (all without a limit), in key order"""
+    if fields:
+        key_names = [column.key for column in key_columns]
+        selected = list(dict.fromkeys(fields + key_names))
+        query = query.with_entities(*[getattr(model, name) for name in selected])
+    elif options:
+        query = query.options(*options)
+
+    if params.after:
+        key = tuple_(*key_columns)
+        values = tuple_(*decode_cursor(params.after, key_columns))
+        query = query.filter(key > values if params.order == "asc" else key < values)
+    ordering = [column.asc() if params.order == "asc" else column.desc() for column in key_columns]
+    query = query.order_by(*ordering)
+    if params.limit is not None:
+        query = query.limit(params.limit + 1)
+    return query.all()
+
+
+def paginate(
+    query: OrmQuery,
+    model,
+    key_columns: Sequence,
+    params: PageParams,
+    request: Optional[Request] = None,
+    response=None,
+    sparse_fields: Optional[Sequence[str]] = None,
+    options: Sequence = (),
+    schema=None,
+    archived: Optional[OrmQuery] = None,
+    archived_options: Sequence = ()
+):
+    """One page of query (over model rows), keyset-ordered by key_columns
+
+    Returns the model objects for the response model to serialize, with the
+    next-page headers set on response; or, when params.fields is given, a
+    JSONResponse with just those columns. sparse_fields limits which columns
+    may be selected (default: all of the model's columns); loader options
+    only apply to full rows. With FAST_JSON on, a flat response model
+    (schema) is served the same way, with all of its fields selected.
+    archived, the same query over model's archive table, is paged alike and
+    merged in by key, with archived_options as its loader options.
+    """
+    allowed = list(sparse_fields or model.__table__.columns.keys())
+    fields = params.fields
+    if fields:
+        unknown = [name for name in fields if name not in allowed]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields {unknown}; choose from {allowed}")
+    elif fast_json.FAST_JSON and schema is not None:
+        schema_fields = fast_json.schema_fields(schema)
+        if set(schema_fields) <= set(model.__table__.columns.keys()):
+            fields = schema_fields
+
+    rows = _page(query, model, key_columns, params, fields, options)
+    if archived is not None:
+        # The archive's rows in the same key range, merged in (see archive.py)
+        archived_model = archived.column_descriptions[0]["entity"]
+        archived_keys = [getattr(archived_model, column.key) for column in key_columns]
+        rows += _page(archived, archived_model, archived_keys, params, fields, archived_options)
+        rows.sort(key=attrgetter(*[column.key for column in key_columns]), reverse=params.order == "desc")
+        if params.limit is not None:
+            rows = rows[:params.limit + 1]
+
+    cursor = None
+    if params.limit is not None and len(rows) > params.limit:
+        rows = rows[:params.limit]
+        last = rows[-1]
+        cursor = encode_cursor([getattr(last, column.key) for column in key_columns])
+    headers = _page_headers(request, cursor)
+
+    if fields:
+        body = [{name: getattr(row, name) for name in fields} for row in rows]
+        return fast_json.FastJSONResponse(body, headers=headers)
+    if response is not None:
+        response.headers.update(headers)
+    return rows
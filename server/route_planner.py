@@ -0,0 +1,495 @@
+"""Delivery route planning.
+
+Turns a day's deliveries into ordered stops, split across delivery persons.
+
+Stops are grouped into buildings: the address's last comma-separated part
+(the society or street) and the house number's block (see routing.block_of).
+Within a building stops go floor by floor, unit by unit, from the digits
+after the block ("A-401" is floor 4, unit 1; "B/3/12" is floor 3, unit 12).
+Buildings are visited in natural order of site and block ("A2" before "A10"),
+or, when residents have coordinates, along a tour through the buildings'
+centroids: a Hilbert-curve ordering improved by 2-opt over each building's
+nearest neighbours, which handles thousands of buildings well within a
+second (ROUTE_OPTIMIZE_SECONDS caps the improvement phase). Buildings
+without coordinates follow the tour in natural order.
+
+The tour is then cut into routes, route first and cluster second: each route
+takes buildings in tour order until it reaches an even share of the day's
+units, and is cut earlier when the next building would not fit the vehicle's
+capacity (total units, and optionally units per product). A building larger
+than a vehicle is split between floors; one household's delivery is never
+split, so a stop larger than a vehicle makes a trip of its own. When the
+routes outnumber the drivers, the extra ones become second and later trips:
+route k goes to driver k % drivers as trip k // drivers + 1.
+
+Plans are cached per date, keyed by a digest of the day's stops and the
+planning parameters, so a plan is reused until a delivery for that day
+changes, in any worker.
+"""
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+import manifest_store
+import routing
+from db_models import User
+
+# Upper bound on the time spent improving one tour with 2-opt
+ROUTE_OPTIMIZE_SECONDS = float(os.environ.get("ROUTE_OPTIMIZE_SECONDS", "0.5"))
+
+# Dates whose plans are kept in memory; the least recently used is dropped first
+ROUTE_CACHE_DATES = 14
+
+# Candidate neighbours per building tried by 2-opt
+NEIGHBOURS = 8
+
+_DIGITS = re.compile(r"\d+")
+_NATURAL = re.compile(r"(\d+)")
+
+
+def natural_key(value: str) -> tuple:
+    """Sort key comparing digit runs as numbers: "A2" < "A10" """
+    return tuple((0, int(part), "") if part.isdigit() else (1, 0, part) for part in _NATURAL.split(value) if part)
+
+
+def house_key(house_number: Optional[str]) -> Tuple[str, int, int]:
+    """(block, floor, unit) of a house number
+
+    "A-401" -> ("A", 4, 1), "B/3/12" -> ("B", 3, 12), "C1205" -> ("C", 12, 5),
+    "42" -> ("42", 0, 0). A lone number of three or more digits is read as
+    floor and two-digit unit.
+    """
+    house_number = (house_number or "").strip()
+    block = routing.block_of(house_number)
+    numbers = [int(n) for n in _DIGITS.findall(house_number[len(block):])]
+    if len(numbers) >= 2:
+        return block, numbers[0], numbers[1]
+    if numbers:
+        return block, numbers[0] // 100, numbers[0] % 100
+    return block, 0, 0
+
+
+def site_of(address: Optional[str]) -> str:
+    """The society or street of an address: its last comma-separated part"""
+    return " ".join((address or "").rsplit(",", 1)[-1].split()).lower()
+
+
+# Tour construction and improvement over planar points
+
+def project(coordinates: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    """(latitude, longitude) to metres on a local equirectangular plane"""
+    mean_latitude = math.radians(sum(lat for lat, _ in coordinates) / len(coordinates))
+    scale = 111320 * math.cos(mean_latitude)
+    return [(lon * scale, lat * 110540) for lat, lon in coordinates]
+
+
+def _hilbert_index(x: int, y: int, order: int) -> int:
+    index = 0
+    s = 1 << (order - 1)
+    while s:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        index += s * s * ((3 * rx) ^ ry)
+        if not ry:
+            if rx:
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+        s >>= 1
+    return index
+
+
+def hilbert_order(points: List[Tuple[float, float]], order: int = 16) -> List[int]:
+    """Indexes of points along a Hilbert curve over their bounding box"""
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    min_x, min_y = min(xs), min(ys)
+    span = max(max(xs) - min_x, max(ys) - min_y) or 1.0
+    cells = (1 << order) - 1
+    keys = [
+        _hilbert_index(int((x - min_x) / span * cells), int((y - min_y) / span * cells), order)
+        for x, y in points
+    ]
+    return sorted(range(len(points)), key=keys.__getitem__)
+
+
+def _neighbours(points: List[Tuple[float, float]], k: int) -> List[List[int]]:
+    """The k nearest other points of each point, nearest first"""
+    xy = np.asarray(points, dtype=float)
+    k = min(k, len(points) - 1)
+    rows_per_chunk = max(1, 2_000_000 // len(xy))
+    result = []
+    for start in range(0, len(xy), rows_per_chunk):
+        chunk = xy[start:start + rows_per_chunk]
+        distances = (chunk[:, 0, None] - xy[None, :, 0]) ** 2 + (chunk[:, 1, None] - xy[None, :, 1]) ** 2
+        distances[np.arange(len(chunk)), np.arange(start, start + len(chunk))] = np.inf
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        rows = np.arange(len(chunk))[:, None]
+        nearest = np.take_along_axis(nearest, np.argsort(distances[rows, nearest], axis=1), axis=1)
+        result.extend(nearest.tolist())
+    return result
+
+
+def two_opt(points: List[Tuple[float, float]], tour: List[int], seconds: float = ROUTE_OPTIMIZE_SECONDS) -> List[int]:
+    """Improve an open tour (a path with free ends) with neighbour-list 2-opt
+
+    Each move replaces two edges of the path by two shorter ones, reversing
+    the segment between them; only moves that join a point to one of its
+    NEIGHBOURS nearest are tried, and points whose edges did not change are
+    not looked at again. Stops at a local optimum or after `seconds`.
+    """
+    n = len(tour)
+    if n < 4:
+        return tour
+    tour = list(tour)
+    position = [0] * n
+    for i, p in enumerate(tour):
+        position[p] = i
+    near = _neighbours(points, NEIGHBOURS)
+
+    def dist(a, b):
+        if a is None or b is None:
+            return 0.0
+        (ax, ay), (bx, by) = points[a], points[b]
+        return math.hypot(ax - bx, ay - by)
+
+    def reverse(i, j):
+        tour[i:j + 1] = tour[i:j + 1][::-1]
+        for k in range(i, j + 1):
+            position[tour[k]] = k
+
+    deadline = time.perf_counter() + seconds
+    queue = list(tour)
+    queued = [True] * n
+    while queue and time.perf_counter() < deadline:
+        a = queue.pop()
+        queued[a] = False
+        improved = True
+        while improved:
+            improved = False
+            i = position[a]
+            for succ in (True, False):
+                b = tour[i + 1] if succ and i + 1 < n else (tour[i - 1] if not succ and i > 0 else None)
+                d_ab = dist(a, b)
+                for c in near[a]:
+                    d_ac = dist(a, c)
+                    if d_ac >= d_ab:
+                        break
+                    j = position[c]
+                    if succ:
+                        if abs(i - j) < 2 and j > i:
+                            continue
+                        d = tour[j + 1] if j + 1 < n else None
+                        if d == a:
+                            continue
+                        lo, hi = (i + 1, j) if i < j else (j + 1, i)
+                    else:
+                        if abs(i - j) < 2 and j < i:
+                            continue
+                        d = tour[j - 1] if j > 0 else None
+                        if d == a:
+                            continue
+                        lo, hi = (i, j - 1) if i < j else (j, i - 1)
+                    gain = d_ab + dist(c, d) - d_ac - dist(b, d)
+                    if gain > 1e-9:
+                        reverse(lo, hi)
+                        for p in (a, b, c, d):
+                            if p is not None and not queued[p]:
+                                queued[p] = True
+                                queue.append(p)
+                        improved = True
+                        break
+                if improved:
+                    break
+    return tour
+
+
+def tour_length(points: List[Tuple[float, float]], tour: List[int]) -> float:
+    return sum(math.dist(points[a], points[b]) for a, b in zip(tour, tour[1:]))
+
+
+# Stops and buildings
+
+def load_stops(db: Session, delivery_date: date, blocks: Optional[Set[str]] = None,
+               outside: Optional[Set[str]] = None) -> List[dict]:
+    """One stop per resident with deliveries on delivery_date, items merged
+
+    Only stops in blocks, when given, and in none of the blocks outside.
+    """
+    stops: Dict[int, dict] = {}
+    deliveries = manifest_store.iter_deliveries(db, delivery_date, residents=True)
+    for delivery in routing.in_blocks(deliveries, blocks, outside):
+        stop = stops.get(delivery["user_id"])
+        if stop is None:
+            block, floor, unit = house_key(delivery["house_number"])
+            stop = stops[delivery["user_id"]] = {
+                "user_id": delivery["user_id"],
+                "name": delivery["name"],
+                "house_number": delivery["house_number"],
+                "address": delivery["address"],
+                "block": block,
+                "floor": floor,
+                "unit": unit,
+                "items": {}
+            }
+        for item in delivery["items"]:
+            stop["items"][item["product_id"]] = stop["items"].get(item["product_id"], 0) + item["quantity"]
+
+    if stops:
+        located = db.query(User.id, User.latitude, User.longitude).filter(
+            User.latitude.isnot(None), User.longitude.isnot(None)
+        )
+        for user_id, latitude, longitude in located:
+            stop = stops.get(user_id)
+            if stop is not None:
+                stop["coordinates"] = (latitude, longitude)
+
+    result = []
+    for stop in stops.values():
+        stop["items"] = [{"product_id": p, "quantity": q} for p, q in sorted(stop["items"].items())]
+        result.append(stop)
+    return result
+
+
+def _stop_order(stop: dict) -> tuple:
+    return (stop["floor"], stop["unit"], natural_key(stop["house_number"]), stop["user_id"])
+
+
+def order_stops(stops: List[dict]) -> List[List[dict]]:
+    """Stops grouped into buildings, buildings in visiting order"""
+    buildings: Dict[Tuple[str, str], List[dict]] = {}
+    for stop in stops:
+        buildings.setdefault((site_of(stop["address"]), stop["block"]), []).append(stop)
+    keys = sorted(buildings, key=lambda key: (natural_key(key[0]), natural_key(key[1])))
+
+    located, unlocated, centroids = [], [], []
+    for key in keys:
+        coordinates = [stop["coordinates"] for stop in buildings[key] if "coordinates" in stop]
+        if coordinates:
+            located.append(key)
+            centroids.append((sum(c[0] for c in coordinates) / len(coordinates),
+                              sum(c[1] for c in coordinates) / len(coordinates)))
+        else:
+            unlocated.append(key)
+    if located:
+        points = project(centroids)
+        tour = two_opt(points, hilbert_order(points))
+        keys = [located[i] for i in tour] + unlocated
+
+    return [sorted(buildings[key], key=_stop_order) for key in keys]
+
+
+# Splitting into routes
+
+def _units(stop: dict) -> int:
+    return sum(item["quantity"] for item in stop["items"])
+
+
+class _Load:
+    """Units carried on one route, in total and per product"""
+
+    def __init__(self, capacity: Optional[int], product_capacity: Dict[int, int]):
+        self.capacity = capacity
+        self.product_capacity = product_capacity
+        self.total = 0
+        self.products: Dict[int, int] = {}
+
+    def fits(self, stops: Iterable[dict]) -> bool:
+        total, products = self.total, dict(self.products)
+        for stop in stops:
+            for item in stop["items"]:
+                total += item["quantity"]
+                products[item["product_id"]] = products.get(item["product_id"], 0) + item["quantity"]
+        if self.capacity is not None and total > self.capacity:
+            return False
+        return all(products.get(p, 0) <= limit for p, limit in self.product_capacity.items())
+
+    def add(self, stops: Iterable[dict]) -> None:
+        for stop in stops:
+            for item in stop["items"]:
+                self.total += item["quantity"]
+                self.products[item["product_id"]] = self.products.get(item["product_id"], 0) + item["quantity"]
+
+
+def _route_count(stops: List[dict], drivers: int, capacity: Optional[int], product_capacity: Dict[int, int]) -> int:
+    """Routes needed for drivers, or more when the vehicles cannot carry a share each"""
+    count = drivers
+    if capacity:
+        count = max(count, math.ceil(sum(_units(stop) for stop in stops) / capacity))
+    for product_id, limit in product_capacity.items():
+        if limit > 0:
+            needed = sum(item["quantity"] for stop in stops for item in stop["items"] if item["product_id"] == product_id)
+            count = max(count, math.ceil(needed / limit))
+    return max(count, 1)
+
+
+def split_routes(buildings: List[List[dict]], drivers: int, capacity: Optional[int] = None,
+                 product_capacity: Optional[Dict[int, int]] = None) -> List[List[dict]]:
+    """Cut the ordered buildings into routes of even load within capacity"""
+    product_capacity = product_capacity or {}
+    stops = [stop for building in buildings for stop in building]
+    planned = _route_count(stops, drivers, capacity, product_capacity)
+    target = sum(_units(stop) for stop in stops) / planned
+
+    routes: List[List[dict]] = []
+    route: List[dict] = []
+    load = _Load(capacity, product_capacity)
+
+    def close():
+        nonlocal route, load
+        if route:
+            routes.append(route)
+        route, load = [], _Load(capacity, product_capacity)
+
+    for building in buildings:
+        units = sum(_units(stop) for stop in building)
+        last = len(routes) >= planned - 1
+        # Cut at the building boundary nearest to the even share
+        if route and not last and load.total + units / 2 > target:
+            close()
+        if load.fits(building):
+            route.extend(building)
+            load.add(building)
+            continue
+        # The building does not fit what is left: start a fresh vehicle, and
+        # split it floor by floor if it does not fit an empty one either
+        close()
+        for stop in building:
+            if route and not load.fits([stop]):
+                close()
+            route.append(stop)
+            load.add([stop])
+    close()
+    return routes
+
+
+def _route(number: int, drivers: List[Optional[int]], stops: List[dict]) -> dict:
+    load: Dict[int, int] = {}
+    for stop in stops:
+        for item in stop["items"]:
+            load[item["product_id"]] = load.get(item["product_id"], 0) + item["quantity"]
+    return {
+        "route": number + 1,
+        "driver_id": drivers[number % len(drivers)],
+        "trip": number // len(drivers) + 1,
+        "stops": [
+            {"sequence": sequence, **{k: v for k, v in stop.items() if k != "coordinates"}}
+            for sequence, stop in enumerate(stops, 1)
+        ],
+        "load": [{"product_id": p, "quantity": q} for p, q in sorted(load.items())],
+        "total_quantity": sum(load.values())
+    }
+
+
+def plan(stops: List[dict], drivers: List[Optional[int]], capacity: Optional[int] = None,
+         product_capacity: Optional[Dict[int, int]] = None) -> List[dict]:
+    """Routes over stops for the given driver slots (driver ids, or None for unnamed slots)"""
+    routes = split_routes(order_stops(stops), len(drivers), capacity, product_capacity)
+    return [_route(number, drivers, route) for number, route in enumerate(routes)]
+
+
+# Per-date cache
+
+_plans: "OrderedDict[date, Dict[tuple, Tuple[str, List[dict]]]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _digest(stops: List[dict]) -> str:
+    digest = hashlib.sha1()
+    for stop in stops:
+        digest.update(repr((
+            stop["user_id"], stop["house_number"], stop["address"], stop.get("coordinates"),
+            [(item["product_id"], item["quantity"]) for item in stop["items"]]
+        )).encode())
+    return digest.hexdigest()
+
+
+def plan_day(db: Session, delivery_date: date, drivers: List[Optional[int]], capacity: Optional[int] = None,
+             product_capacity: Optional[Dict[int, int]] = None, blocks: Optional[Set[str]] = None,
+             outside: Optional[Set[str]] = None) -> List[dict]:
+    """Routes for delivery_date, from the cache while the day's stops are unchanged"""
+    stops = load_stops(db, delivery_date, blocks, outside)
+    key = (tuple(drivers), capacity, tuple(sorted((product_capacity or {}).items())),
+           tuple(sorted(blocks)) if blocks is not None else None, tuple(sorted(outside or ())))
+    digest = _digest(stops)
+    with _lock:
+        cached = _plans.get(delivery_date, {}).get(key)
+        if cached is not None and cached[0] == digest:
+            _plans.move_to_end(delivery_date)
+            return cached[1]
+
+    routes = plan(stops, drivers, capacity, product_capacity)
+    with _lock:
+        _plans.setdefault(delivery_date, {})[key] = (digest, routes)
+        _plans.move_to_end(delivery_date)
+        while len(_plans) > ROUTE_CACHE_DATES:
+            _plans.popitem(last=False)
+    return routes
+
+
+def delivery_persons(db: Session) -> List[int]:
+    return [row.id for row in db.query(User.id).filter(User.role == "delivery_person").order_by(User.id)]
+
+
+def day_plan(db: Session, delivery_date: date, drivers: Optional[int] = None, capacity: Optional[int] = None,
+             product_capacity: Optional[Dict[int, int]] = None) -> dict:
+    """Every stop of delivery_date split into routes
+
+    With drivers, that many unnamed routes (before extra trips); otherwise
+    one per delivery person, in id order.
+    """
+    slots = [None] * drivers if drivers else (delivery_persons(db) or [None])
+    return {"date": delivery_date, "routes": plan_day(db, delivery_date, slots, capacity, product_capacity)}
+
+
+def driver_route(db: Session, delivery_date: date, driver_id: int, capacity: Optional[int] = None,
+                 product_capacity: Optional[Dict[int, int]] = None) -> Optional[dict]:
+    """A delivery person's trips for delivery_date; None if driver_id is not a delivery person
+
+    A delivery person with assigned blocks gets every stop in them; the
+    others share the stops outside every assigned block between them, as
+    day_plan shares a day with no assignments.
+    """
+    persons = delivery_persons(db)
+    if driver_id not in persons:
+        return None
+    assignments = {person: blocks for person, blocks in routing.block_assignments(db).items() if person in persons}
+    if driver_id in assignments:
+        routes = plan_day(db, delivery_date, [driver_id], capacity, product_capacity, assignments[driver_id])
+    else:
+        unassigned = [person for person in persons if person not in assignments]
+        taken = set().union(*assignments.values())
+        routes = [
+            route for route in plan_day(db, delivery_date, unassigned, capacity, product_capacity, outside=taken)
+            if route["driver_id"] == driver_id
+        ]
+    return {"date": delivery_date, "routes": routes}
+
+
+def invalidate(delivery_date: Optional[date] = None) -> None:
+    """Drop the cached plans for delivery_date, or for every date"""
+    with _lock:
+        if delivery_date is None:
+            _plans.clear()
+        else:
+            _plans.pop(delivery_date, None)
+
+
+def parse_product_capacity(values: Optional[List[str]]) -> Dict[int, int]:
+    """{product_id: units} from "product_id:units" query values; 400 when malformed"""
+    limits = {}
+    for value in values or ():
+        product_id, _, units = value.partition(":")
+        if not (product_id.strip().isdigit() and units.strip().isdigit() and int(units) > 0):
+            raise HTTPException(status_code=400, detail="product_capacity must be product_id:units")
+        limits[int(product_id)] = int(units)
+    return limits
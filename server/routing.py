@@ -0,0 +1,58 @@
+"""Route partitioning helpers.
+
+Stops are grouped into blocks by the leading part of the resident's house
+number ("A-101" and "A/204" are both in block "A"). Delivery persons can be
+assigned one or more blocks so that they only receive their own stops.
+"""
+import re
+from typing import Dict, Iterable, Iterator, Optional, Set
+
+from sqlalchemy.orm import Session
+
+from db_models import DriverBlock
+
+_BLOCK_SEPARATOR = re.compile(r"[-/\s]")
+_LEADING_LETTERS = re.compile(r"^[A-Za-z]+")
+
+
+def block_of(house_number: Optional[str]) -> str:
+    """The block a house number belongs to, upper-cased
+
+    "A-101" -> "A", "B2/14" -> "B2", "C305" -> "C", "42" -> "42"
+    """
+    house_number = (house_number or "").strip()
+    parts = _BLOCK_SEPARATOR.split(house_number, maxsplit=1)
+    if len(parts) > 1 and parts[0]:
+        return parts[0].upper()
+    letters = _LEADING_LETTERS.match(house_number)
+    return (letters.group(0) if letters else house_number).upper()
+
+
+def driver_blocks(db: Session, driver_id: int) -> Set[str]:
+    """Blocks assigned to a delivery person (empty when unassigned)"""
+    return {row.block for row in db.query(DriverBlock.block).filter(DriverBlock.driver_id == driver_id)}
+
+
+def block_assignments(db: Session) -> Dict[int, Set[str]]:
+    """Blocks of every delivery person that has some"""
+    assignments: Dict[int, Set[str]] = {}
+    for driver_id, block in db.query(DriverBlock.driver_id, DriverBlock.block):
+        assignments.setdefault(driver_id, set()).add(block)
+    return assignments
+
+
+def set_driver_blocks(db: Session, driver_id: int, blocks: Iterable[str]) -> Set[str]:
+    """Replace a delivery person's block assignment; the caller commits"""
+    blocks = {block.strip().upper() for block in blocks if block.strip()}
+    db.query(DriverBlock).filter(DriverBlock.driver_id == driver_id).delete(synchronize_session=False)
+    db.add_all([DriverBlock(driver_id=driver_id, block=block) for block in sorted(blocks)])
+    return blocks
+
+
+def in_blocks(deliveries: Iterable[dict], blocks: Optional[Set[str]],
+              outside: Optional[Set[str]] = None) -> Iterator[dict]:
+    """Deliveries (carrying house_number) that fall in one of blocks (any when None) and in none of outside"""
+    for delivery in deliveries:
+        block = block_of(delivery["house_number"])
+        if (blocks is None or block in blocks) and not (outside and block in outside):
+            yield delivery
@@ -0,0 +1,301 @@
+"""Multi-day delivery schedule.
+
+Expands every active subscription over a date range in one pass instead
+of building the manifest day by day. Active subscriptions and their items
+are read once; whether each subscription is delivered on each day is then a
+boolean matrix (subscriptions x days) computed with NumPy:
+
+- the frequency mask, from each subscription's rule and anchor day
+  (see frequency.py),
+- minus the days its user is away, from the vacations overlapping the
+  range, marked with a difference array per user,
+- with cancelled subscriptions, orders and vacations left out (from the
+  exclusion index, see cancellation_index.py).
+
+Ad-hoc orders for the range are read in one more query. Per-product totals
+come straight from the matrix; delivery dicts are only built for the days
+asked for, in the same shape and order as the single-day manifest.
+
+By default the schedule is a forecast: the subscriptions active now, on
+every day they are due. With history=True it is what was delivered instead,
+for billing past days: every subscription counts from the day it was created
+until the day before its replacement was, a cancelled subscription until the
+day before it was cancelled, and orders with status "cancelled" are left out.
+A range that starts before the archive horizon also reads the archived
+orders and vacations (see archive.py).
+"""
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Container, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+import archive
+import cancellation_index
+import frequency
+from db_models import Subscription, SubscriptionItem, Order, OrderItem, Vacation, Cancellation, \
+    ArchivedOrder, ArchivedOrderItem, ArchivedVacation
+
+# Longest range one schedule request may cover
+MAX_SCHEDULE_DAYS = 31
+
+
+def _day(value) -> Optional[int]:
+    if value is None:
+        return None
+    return (value.date() if isinstance(value, datetime) else value).toordinal()
+
+
+def _for_users(query, user_id_column, user_ids: Optional[List[int]], user_range: Optional[Tuple[int, int]]):
+    if user_ids is not None:
+        query = query.filter(user_id_column.in_(user_ids))
+    if user_range is not None:
+        query = query.filter(user_id_column >= user_range[0], user_id_column < user_range[1])
+    return query
+
+
+def subscription_periods(db: Session, user_ids: Optional[List[int]] = None,
+                         user_range: Optional[Tuple[int, int]] = None) -> Dict[int, Tuple[int, int]]:
+    """subscription id -> (first, last) day ordinal it was in force
+
+    A subscription is in force from its creation day until the day before
+    the user's next subscription was created (or, if it is still active,
+    indefinitely), and never from the day it was cancelled. An inactive
+    subscription without a successor has no recorded end and is left out.
+    """
+    cancelled_on = {
+        reference_id: _day(cancelled_at) for reference_id, cancelled_at in db.query(
+            Cancellation.reference_id, Cancellation.cancelled_at
+        ).filter(Cancellation.cancellation_type == "subscription")
+    }
+    query = _for_users(
+        db.query(Subscription.id, Subscription.user_id, Subscription.created_at, Subscription.is_active),
+        Subscription.user_id, user_ids, user_range
+    ).order_by(Subscription.user_id, Subscription.created_at, Subscription.id)
+
+    periods = {}
+    previous = None
+    for subscription_id, user_id, created_at, is_active in query:
+        first = _day(created_at) or date.min.toordinal()
+        if previous is not None and previous[1] == user_id:
+            periods[previous[0]] = (periods[previous[0]][0], first - 1)
+        periods[subscription_id] = (first, date.max.toordinal() if is_active else first - 1)
+        previous = (subscription_id, user_id)
+    for subscription_id, day in cancelled_on.items():
+        if subscription_id in periods and day is not None:
+            first, last = periods[subscription_id]
+            periods[subscription_id] = (first, min(last, day - 1))
+    return periods
+
+
+class Schedule:
+    """Deliveries for every day in [start, end]"""
+
+    def __init__(self, db: Session, start: date, end: date, user_ids: Optional[Iterable[int]] = None,
+                 user_range: Optional[Tuple[int, int]] = None, history: bool = False):
+        """user_ids or user_range ([low, high) user ids) restrict the schedule to those users"""
+        self.start = start
+        self.days = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+        user_ids = None if user_ids is None else list(user_ids)
+        cancelled = cancellation_index.exclusions(db)
+        in_force = subscription_periods(db, user_ids, user_range) if history else None
+
+        # Active (or, for history, all) subscriptions with their items, in manifest order
+        query = db.query(
+            Subscription.id, Subscription.user_id, Subscription.frequency, Subscription.created_at,
+            SubscriptionItem.product_id, SubscriptionItem.quantity
+        ).join(
+            SubscriptionItem, SubscriptionItem.subscription_id == Subscription.id
+        )
+        if not history:
+            query = query.filter(Subscription.is_active == True)
+        query = _for_users(query, Subscription.user_id, user_ids, user_range)
+
+        self.subscription_ids: List[int] = []
+        self.subscription_users: List[int] = []
+        self.subscription_items: List[List[dict]] = []
+        periods, weekdays, anchors = [], [], []
+        item_rows, item_products, item_quantities = [], [], []
+        for subscription_id, user_id, rule_name, created_at, product_id, quantity in query.order_by(
+            Subscription.id, SubscriptionItem.id
+        ):
+            if in_force is None:
+                if subscription_id in cancelled.subscriptions:
+                    continue
+            else:
+                first, last = in_force.get(subscription_id, (0, -1))
+                if last < start.toordinal() or first > end.toordinal():
+                    continue
+            if not self.subscription_ids or self.subscription_ids[-1] != subscription_id:
+                rule = frequency.parse(rule_name)
+                self.subscription_ids.append(subscription_id)
+                self.subscription_users.append(user_id)
+                self.subscription_items.append([])
+                periods.append(rule.period)
+                weekdays.append(rule.weekdays)
+                anchors.append(frequency.anchor(created_at))
+            self.subscription_items[-1].append({"product_id": product_id, "quantity": quantity})
+            item_rows.append(len(self.subscription_ids) - 1)
+            item_products.append(product_id)
+            item_quantities.append(quantity)
+
+        ordinals = np.array([day.toordinal() for day in self.days], dtype=np.int64)
+        self.mask = self._frequency_mask(
+            np.array(periods, dtype=np.int64), np.array(weekdays, dtype=np.int64),
+            np.array(anchors, dtype=np.int64), ordinals
+        )
+        if in_force is not None and self.subscription_ids:
+            first, last = np.array([in_force[subscription_id] for subscription_id in self.subscription_ids], dtype=np.int64).T
+            self.mask &= (ordinals[None, :] >= first[:, None]) & (ordinals[None, :] <= last[:, None])
+        self._remove_vacations(db, ordinals, cancelled.vacations, user_range)
+        self._item_rows = np.array(item_rows, dtype=np.int64)
+        self._item_products = np.array(item_products, dtype=np.int64)
+        self._item_quantities = np.array(item_quantities, dtype=np.int64)
+
+        # Ad-hoc orders, per day, in order id order
+        self.adhoc: Dict[date, List[dict]] = defaultdict(list)
+        query = self._order_rows(db, Order, OrderItem, start, end, user_ids, user_range, history)
+        if archive.reaches(start):
+            archived = self._order_rows(db, ArchivedOrder, ArchivedOrderItem, start, end, user_ids, user_range, history)
+            query = query.union_all(archived.filter(ArchivedOrder.cancelled == False))
+        last_order = None
+        for order_id, user_id, day, product_id, quantity, _ in query.order_by(Order.id, OrderItem.id):
+            if order_id in cancelled.orders:
+                continue
+            if order_id != last_order:
+                last_order = order_id
+                self.adhoc[day].append({
+                    "user_id": user_id, "date": day, "items": [], "is_subscription": False, "is_adhoc": True
+                })
+            if product_id is not None:
+                self.adhoc[day][-1]["items"].append({"product_id": product_id, "quantity": quantity})
+
+    @staticmethod
+    def _order_rows(db: Session, order, item, start: date, end: date, user_ids: Optional[List[int]],
+                    user_range: Optional[Tuple[int, int]], history: bool):
+        query = db.query(
+            order.id, order.user_id, order.date, item.product_id, item.quantity, item.id.label("item_id")
+        ).outerjoin(
+            item, item.order_id == order.id
+        ).filter(order.date >= start, order.date <= end, order.is_adhoc == True)
+        if history:
+            query = query.filter(order.status != "cancelled")
+        return _for_users(query, order.user_id, user_ids, user_range)
+
+    @staticmethod
+    def _frequency_mask(periods, weekdays, anchors, ordinals) -> np.ndarray:
+        """subscriptions x days: due by frequency"""
+        # date.weekday() of each ordinal (ordinal 1 is a Monday)
+        day_of_week = (ordinals - 1) % 7
+        by_weekday = (weekdays[:, None] >> day_of_week[None, :]) & 1 == 1
+        by_interval = (ordinals[None, :] - anchors[:, None]) % periods[:, None] == 0
+        return np.where(weekdays[:, None] != 0, by_weekday, by_interval)
+
+    def _remove_vacations(self, db: Session, ordinals, cancelled_vacations: Container[int],
+                          user_range: Optional[Tuple[int, int]] = None) -> None:
+        if not self.subscription_ids:
+            return
+        users, user_index = np.unique(np.array(self.subscription_users, dtype=np.int64), return_inverse=True)
+        first, last = self.days[0], self.days[-1]
+        query = _for_users(db.query(
+            Vacation.id, Vacation.user_id, Vacation.start_date, Vacation.end_date
+        ).filter(
+            Vacation.start_date <= last, Vacation.end_date >= first
+        ), Vacation.user_id, None, user_range)
+        if archive.reaches(first):
+            query = query.union_all(_for_users(archive.vacation_rows(db, first, last), ArchivedVacation.user_id, None, user_range))
+        rows = [
+            (user_id, start, end) for vacation_id, user_id, start, end in query
+            if vacation_id not in cancelled_vacations
+        ]
+        if not rows:
+            return
+        vacation_users = np.array([user_id for user_id, _, _ in rows], dtype=np.int64)
+        positions = np.searchsorted(users, vacation_users)
+        known = (positions < len(users)) & (users[np.minimum(positions, len(users) - 1)] == vacation_users)
+        base = ordinals[0]
+        starts = np.array([start.toordinal() for _, start, _ in rows], dtype=np.int64) - base
+        ends = np.array([end.toordinal() for _, _, end in rows], dtype=np.int64) - base
+        starts = np.clip(starts, 0, len(ordinals))
+        ends = np.clip(ends + 1, 0, len(ordinals))
+        valid = known & (ends > starts)
+
+        # +1 where a vacation starts, -1 the day after it ends; a running sum
+        # over the days is positive while any vacation covers the day
+        away = np.zeros((len(users), len(ordinals) + 1), dtype=np.int32)
+        np.add.at(away, (positions[valid], starts[valid]), 1)
+        np.add.at(away, (positions[valid], ends[valid]), -1)
+        away = np.cumsum(away[:, :-1], axis=1) > 0
+        self.mask &= ~away[user_index]
+
+    def _day_index(self, day: date) -> int:
+        return (day - self.start).days
+
+    def deliveries(self, day: date) -> List[dict]:
+        """The manifest for one day of the schedule"""
+        column = self.mask[:, self._day_index(day)]
+        deliveries = [{
+            "user_id": self.subscription_users[row],
+            "date": day,
+            "items": self.subscription_items[row],
+            "is_subscription": True
+        } for row in np.flatnonzero(column).tolist()]
+        return deliveries + self.adhoc.get(day, [])
+
+    def manifest(self) -> List[Tuple[date, List[dict]]]:
+        """(date, deliveries) for every day in the range"""
+        return [(day, self.deliveries(day)) for day in self.days]
+
+    def as_dict(self) -> dict:
+        """The schedule as the /deliveries/{date}/schedule response"""
+        return {
+            "start_date": self.days[0],
+            "end_date": self.days[-1],
+            "days": [{"date": day, "deliveries": deliveries} for day, deliveries in self.manifest()]
+        }
+
+    def subscription_counts(self) -> List[int]:
+        """Subscriptions delivered on each day"""
+        return self.mask.sum(axis=0).tolist()
+
+    def product_totals(self) -> Dict[Tuple[date, int], int]:
+        """Quantity per (date, product_id) for every day, like inventory.product_totals"""
+        totals = defaultdict(int)
+        if len(self._item_rows):
+            # items x days quantities, summed per product
+            quantities = self.mask[self._item_rows] * self._item_quantities[:, None]
+            products, product_rows = np.unique(self._item_products, return_inverse=True)
+            per_product = np.zeros((len(products), len(self.days)), dtype=np.int64)
+            np.add.at(per_product, product_rows, quantities)
+            for p, product_id in enumerate(products.tolist()):
+                for d, quantity in enumerate(per_product[p].tolist()):
+                    if quantity:
+                        totals[(self.days[d], product_id)] += quantity
+        for day, orders in self.adhoc.items():
+            for order in orders:
+                for item in order["items"]:
+                    totals[(day, item["product_id"])] += item["quantity"]
+        return totals
+
+    def user_product_totals(self) -> Dict[Tuple[int, int], int]:
+        """Quantity per (user_id, product_id) over the whole range"""
+        totals = defaultdict(int)
+        if len(self._item_rows):
+            deliveries = self.mask.sum(axis=1)[self._item_rows]
+            users = np.array(self.subscription_users, dtype=np.int64)[self._item_rows]
+            for user_id, product_id, quantity in zip(
+                users.tolist(), self._item_products.tolist(), (deliveries * self._item_quantities).tolist()
+            ):
+                if quantity:
+                    totals[(user_id, product_id)] += quantity
+        for orders in self.adhoc.values():
+            for order in orders:
+                for item in order["items"]:
+                    totals[(order["user_id"], item["product_id"])] += item["quantity"]
+        return totals
+
+
+def expand(db: Session, start: date, end: date, user_ids: Optional[Iterable[int]] = None,
+           user_range: Optional[Tuple[int, int]] = None, history: bool = False) -> Schedule:
+    return Schedule(db, start, end, user_ids, user_range, history)
@@ -0,0 +1,240 @@
+"""In-process index of vacation coverage.
+
+Answers "who is away on day D" and "is user U away on D" from memory
+instead of a range scan over years of vacation history. Each user's
+vacations are merged into disjoint intervals (so a point lookup is one
+bisect). For day lookups the intervals are also filed by length class
+(1 day, 2, 3-4, 5-8, ... up to LONG_VACATION_DAYS), each class a list sorted
+by start day: an interval of class c covering day D started within the
+last 2**c days, so each class is scanned over that window only. The few
+longer absences are kept apart and checked one by one.
+
+Like the product catalog, the index is per process: `refresh_users()` after
+a vacation write (or a vacation cancellation) keeps this worker current,
+and VACATION_INDEX_TTL bounds how long another worker's writes go unseen.
+A rebuild reads every vacation (seconds with years of history), so one
+request builds at a time while the others keep using the old index.
+Coverage follows the same rule as the delivery manifest (manifest.on_vacation):
+cancelled vacations do not count. Archived vacations are loaded too (see
+archive.py), so old days are answered like recent ones.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from itertools import chain
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+import cancellation_index
+from database import database_key
+from db_models import Vacation, ArchivedVacation
+
+# Seconds a loaded index is used before it is rebuilt from the table
+VACATION_INDEX_TTL = float(os.environ.get("VACATION_INDEX_TTL", "600"))
+
+# Intervals longer than this many days are scanned separately, so that one
+# long absence does not widen every day's lookup window (a power of two)
+LONG_VACATION_DAYS = 32
+_CLASSES = LONG_VACATION_DAYS.bit_length()
+
+Interval = Tuple[int, int]  # (first day, last day) as date ordinals
+
+
+def _merge(intervals: Iterable[Interval]) -> List[Interval]:
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class VacationIndex:
+    """Vacation coverage for a set of (user_id, start_date, end_date) rows"""
+
+    def __init__(self, rows: Iterable[Tuple[int, date, date]] = (), database: Optional[str] = None):
+        intervals = defaultdict(list)
+        for user_id, start, end in rows:
+            if end >= start:
+                intervals[user_id].append((start.toordinal(), end.toordinal()))
+        self._by_user: Dict[int, List[Interval]] = {}
+        # Per length class, (start, end, user_id) sorted
+        self._short: List[List[Tuple[int, int, int]]] = [[] for _ in range(_CLASSES)]
+        self._long: Set[Tuple[int, int, int]] = set()
+        for user_id, user_intervals in intervals.items():
+            self._add(user_id, _merge(user_intervals))
+        for entries in self._short:
+            entries.sort()
+        self.loaded_at = time.monotonic()
+        self.database = database
+        self.stale = False  # set by invalidate()
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._short) + len(self._long)
+
+    def _add(self, user_id: int, intervals: List[Interval], keep_sorted: bool = False) -> None:
+        if not intervals:
+            return
+        self._by_user[user_id] = intervals
+        for start, end in intervals:
+            entry = (start, end, user_id)
+            length = end - start + 1
+            if length > LONG_VACATION_DAYS:
+                self._long.add(entry)
+            elif keep_sorted:
+                insort(self._short[(length - 1).bit_length()], entry)
+            else:
+                self._short[(length - 1).bit_length()].append(entry)
+
+    def _remove(self, user_id: int) -> None:
+        for start, end in self._by_user.pop(user_id, ()):
+            entry = (start, end, user_id)
+            if entry in self._long:
+                self._long.discard(entry)
+            else:
+                entries = self._short[(end - start).bit_length()]
+                del entries[bisect_left(entries, entry)]
+
+    def replace_user(self, user_id: int, rows: Iterable[Tuple[date, date]]) -> None:
+        """Swap in a user's current vacations"""
+        self._remove(user_id)
+        self._add(
+            user_id,
+            _merge((start.toordinal(), end.toordinal()) for start, end in rows if end >= start),
+            keep_sorted=True
+        )
+
+    def is_away(self, user_id: int, day: date) -> bool:
+        intervals = self._by_user.get(user_id)
+        if not intervals:
+            return False
+        day = day.toordinal()
+        position = bisect_right(intervals, (day, float("inf"))) - 1
+        return position >= 0 and intervals[position][1] >= day
+
+    def away_on(self, day: date) -> Set[int]:
+        """Ids of the users on vacation on day"""
+        day = day.toordinal()
+        away = set()
+        for length_class, entries in enumerate(self._short):
+            low = bisect_left(entries, (day - (1 << length_class) + 1,))
+            high = bisect_right(entries, (day, float("inf")))
+            away.update([user_id for _, end, user_id in entries[low:high] if end >= day])
+        away.update(user_id for start, end, user_id in self._long if start <= day <= end)
+        return away
+
+
+_index: Optional[VacationIndex] = None
+_lock = threading.Lock()
+_building = threading.Lock()  # held by the one request building the index
+_stats = {"hits": 0, "misses": 0, "refreshes": 0}
+_generation = 0  # bumped by every refresh and invalidation
+
+
+def _rows(db: Session, user_ids: Optional[Iterable[int]] = None):
+    """(user_id, start_date, end_date) of the vacations that were not cancelled"""
+    cancelled = cancellation_index.exclusions(db).vacations
+    query = db.query(Vacation.id, Vacation.user_id, Vacation.start_date, Vacation.end_date)
+    archived = db.query(ArchivedVacation.user_id, ArchivedVacation.start_date, ArchivedVacation.end_date).filter(
+        ArchivedVacation.cancelled == False
+    )
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        query = query.filter(Vacation.user_id.in_(user_ids))
+        archived = archived.filter(ArchivedVacation.user_id.in_(user_ids))
+    rows = ((user_id, start, end) for vacation_id, user_id, start, end in query if vacation_id not in cancelled)
+    return chain(rows, archived)
+
+
+def _fresh(index: Optional[VacationIndex], db: Session) -> bool:
+    return (index is not None and not index.stale and index.database == database_key(db)
+            and time.monotonic() - index.loaded_at < VACATION_INDEX_TTL)
+
+
+def index(db: Session) -> VacationIndex:
+    """The vacation index, built from the table on first use (or for another database) and after the TTL"""
+    global _index
+    current = _index
+    if _fresh(current, db):
+        _stats["hits"] += 1
+        return current
+    # Built without the lock, which is only taken to publish it: _rows queries
+    # the database, and with DATABASE_ASYNC a thread waiting for the lock
+    # across that would block the event loop. One build at a time: the
+    # others use the old index meanwhile, or with none wait for the build,
+    # except on the event loop, where waiting could block the builder itself
+    usable = current is not None and current.database == database_key(db)
+    if not _building.acquire(blocking=not usable and not db.get_bind().dialect.is_async):
+        if usable:
+            _stats["hits"] += 1
+            return current
+        _stats["misses"] += 1
+        return VacationIndex(_rows(db), database_key(db))
+    try:
+        if _fresh(_index, db):
+            _stats["hits"] += 1
+            return _index
+        with _lock:
+            generation = _generation
+            _stats["misses"] += 1
+        built = VacationIndex(_rows(db), database_key(db))
+        with _lock:
+            # Unless a refresh or invalidation came in while it was built
+            if _generation == generation:
+                _index = built
+        return built
+    finally:
+        _building.release()
+
+
+def is_away(db: Session, user_id: int, day: date) -> bool:
+    current = index(db)
+    with _lock:
+        return current.is_away(user_id, day)
+
+
+def away_on(db: Session, day: date) -> Set[int]:
+    current = index(db)
+    with _lock:
+        return current.away_on(day)
+
+
+def refresh_users(db: Session, user_ids: Iterable[int]) -> None:
+    """Reload the given users' vacations into a loaded index; call after committing"""
+    global _generation
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    with _lock:
+        # An index being built may have read the users' rows before the commit
+        _generation += 1
+    if _index is None:
+        return
+    rows = defaultdict(list)
+    for user_id, start, end in _rows(db, user_ids):
+        rows[user_id].append((start, end))
+    with _lock:
+        if _index is not None:
+            for user_id in user_ids:
+                _index.replace_user(user_id, rows.get(user_id, ()))
+            _stats["refreshes"] += 1
+
+
+def invalidate() -> None:
+    """Rebuild the index on next use; until that build is done, concurrent users keep the old one"""
+    global _generation
+    with _lock:
+        if _index is not None:
+            _index.stale = True
+        _generation += 1
+
+
+def stats() -> dict:
+    current = _index
+    return {**_stats, "intervals": len(current) if current else 0}
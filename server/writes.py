@@ -0,0 +1,138 @@
+"""Subscription, ad-hoc order and cancellation writes.
+
+Each write is one transaction: the parent row and its items are flushed
+together (the parent's id and created_at come back from the INSERT, and the
+items go in as one batch), the materialized manifest is refreshed in the
+same transaction, and the caller commits once. The response is built from
+the objects already in memory, with products from the catalog cache, so
+nothing is read back after the commit. A failure anywhere rolls the whole
+write back; there is no window in which a subscription exists without its
+items or a resident has no active subscription.
+"""
+from typing import Iterable, List
+
+from fastapi import HTTPException
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+import catalog
+import dashboard
+import frequency
+import manifest_store
+from db_models import Subscription as DBSubscription, SubscriptionItem as DBSubscriptionItem, \
+    Order as DBOrder, OrderItem as DBOrderItem, Vacation as DBVacation, Cancellation as DBCancellation
+from models import Subscription, SubscriptionCreate, SubscriptionItem, Order, OrderCreate, OrderItem, \
+    CancellationCreate
+
+# What each cancellation_type refers to
+CANCELLABLE = {"subscription": DBSubscription, "order": DBOrder, "vacation": DBVacation}
+
+
+def _check_products(db: Session, items: Iterable) -> dict:
+    """The catalog's product map; 400 if an item names an unknown product"""
+    products = catalog.product_map(db)
+    unknown = sorted({item.product_id for item in items} - products.keys())
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown product ids: {unknown}")
+    return products
+
+
+def _items(schema, items, products: dict) -> List:
+    return [
+        schema(id=item.id, product_id=item.product_id, quantity=item.quantity, product=products[item.product_id])
+        for item in items
+    ]
+
+
+def create_subscription(db: Session, user_id: int, subscription_data: SubscriptionCreate) -> Subscription:
+    """Replace user_id's active subscription; the caller commits"""
+    if not frequency.is_valid(subscription_data.frequency):
+        raise HTTPException(status_code=400, detail="Unknown subscription frequency")
+    products = _check_products(db, subscription_data.items)
+
+    # Deactivating first takes the write lock, so concurrent replacements
+    # for the same resident queue up instead of both staying active
+    db.execute(
+        update(DBSubscription).where(
+            DBSubscription.user_id == user_id,
+            DBSubscription.is_active == True
+        ).values(is_active=False)
+    )
+    db_subscription = DBSubscription(
+        user_id=user_id,
+        frequency=subscription_data.frequency,
+        is_active=True,
+        items=[
+            DBSubscriptionItem(product_id=item_data.product_id, quantity=item_data.quantity)
+            for item_data in subscription_data.items
+        ]
+    )
+    db.add(db_subscription)
+    db.flush()
+    manifest_store.refresh_users(db, [user_id])
+    dashboard.touch(db, [user_id])
+
+    return Subscription(
+        id=db_subscription.id,
+        user_id=user_id,
+        frequency=db_subscription.frequency,
+        is_active=True,
+        items=_items(SubscriptionItem, db_subscription.items, products),
+        created_at=db_subscription.created_at
+    )
+
+
+def create_order(db: Session, user_id: int, order_data: OrderCreate) -> Order:
+    """Create an order for user_id; the caller commits"""
+    products = _check_products(db, order_data.items)
+
+    db_order = DBOrder(
+        user_id=user_id,
+        date=order_data.date,
+        is_adhoc=order_data.is_adhoc,
+        status="pending",
+        items=[
+            DBOrderItem(product_id=item_data.product_id, quantity=item_data.quantity)
+            for item_data in order_data.items
+        ]
+    )
+    db.add(db_order)
+    db.flush()
+    manifest_store.refresh_users(db, [user_id], order_data.date, order_data.date)
+    dashboard.touch(db, [user_id])
+
+    return Order(
+        id=db_order.id,
+        user_id=user_id,
+        date=db_order.date,
+        is_adhoc=db_order.is_adhoc,
+        status=db_order.status,
+        items=_items(OrderItem, db_order.items, products),
+        created_at=db_order.created_at
+    )
+
+
+def create_cancellation(db: Session, user_id: int, cancellation_data: CancellationCreate) -> DBCancellation:
+    """Cancel one of user_id's subscriptions, orders or vacations; the caller commits
+
+    400 for an unknown cancellation_type, 404 unless the referenced row
+    exists and belongs to user_id.
+    """
+    model = CANCELLABLE.get(cancellation_data.cancellation_type)
+    if model is None:
+        raise HTTPException(status_code=400, detail=f"cancellation_type must be one of {sorted(CANCELLABLE)}")
+    owner = db.query(model.user_id).filter(model.id == cancellation_data.reference_id).scalar()
+    if owner != user_id:
+        raise HTTPException(status_code=404, detail=f"{cancellation_data.cancellation_type.capitalize()} not found")
+
+    db_cancellation = DBCancellation(
+        user_id=user_id,
+        cancellation_type=cancellation_data.cancellation_type,
+        reference_id=cancellation_data.reference_id,
+        reason=cancellation_data.reason
+    )
+    db.add(db_cancellation)
+    db.flush()
+    manifest_store.refresh_users(db, [user_id])
+    dashboard.touch(db, [user_id])
+    return db_cancellation
@@ -0,0 +1,1290 @@
+#!/usr/bin/env python3
+"""
+In-process tests for the delivery manifest engine
+Run with: python -m pytest -q test_deliveries.py
+"""
+
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import List
+
+import pytest
+from fastapi import Depends, FastAPI, HTTPException, Response
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server"))
+
+import archive  # noqa: E402
+import billing  # noqa: E402
+import bulk_import  # noqa: E402
+import cancellation_index  # noqa: E402
+import catalog  # noqa: E402
+import delivery_status  # noqa: E402
+import fast_json  # noqa: E402
+import frequency  # noqa: E402
+import inventory  # noqa: E402
+import jobs  # noqa: E402
+import manage  # noqa: E402
+import manifest  # noqa: E402
+import manifest_events  # noqa: E402
+import manifest_store  # noqa: E402
+import metrics  # noqa: E402
+import migrations  # noqa: E402
+import pagination  # noqa: E402
+import route_planner  # noqa: E402
+import routing  # noqa: E402
+import schedule  # noqa: E402
+import vacation_index  # noqa: E402
+import writes  # noqa: E402
+from db_models import (  # noqa: E402
+    Base, User, Product, Subscription, SubscriptionItem, Order, OrderItem, Vacation, Cancellation
+)
+from database import create_db_engine  # noqa: E402
+from models import OrderCreate, SubscriptionCreate, User as UserSchema  # noqa: E402
+
+DAY = date(2024, 3, 15)
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(engine):
+    # The catalog, vacation and cancellation caches are per process; each test has a new database
+    catalog.invalidate()
+    vacation_index.invalidate()
+    cancellation_index.invalidate()
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+
+
+@contextmanager
+def count_queries(engine):
+    """Collect every SQL statement sent to the engine"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def seed(db, households):
+    """Households with a mix of subscriptions, vacations and ad-hoc orders"""
+    milk = Product(name="Milk", price=25.0)
+    curd = Product(name="Curd", price=15.0)
+    db.add_all([milk, curd])
+    db.flush()
+
+    for n in range(households):
+        user = User(name=f"Resident {n}", email=f"r{n}@example.com", house_number=f"A-{n}")
+        db.add(user)
+        db.flush()
+
+        # An old, replaced subscription must never be delivered
+        old = Subscription(user_id=user.id, is_active=False)
+        db.add(old)
+        db.flush()
+        db.add(SubscriptionItem(subscription_id=old.id, product_id=curd.id, quantity=9))
+
+        subscription = Subscription(user_id=user.id)
+        db.add(subscription)
+        db.flush()
+        if n % 5 != 4:  # every fifth household has an empty subscription
+            db.add(SubscriptionItem(subscription_id=subscription.id, product_id=milk.id, quantity=n % 3 + 1))
+            if n % 2:
+                db.add(SubscriptionItem(subscription_id=subscription.id, product_id=curd.id, quantity=1))
+
+        if n % 4 == 0:
+            db.add(Vacation(user_id=user.id, start_date=date(2024, 3, 10), end_date=date(2024, 3, 20)))
+        if n % 4 == 1:
+            db.add(Vacation(user_id=user.id, start_date=date(2024, 3, 16), end_date=date(2024, 3, 20)))
+
+        if n % 3 == 0:
+            order = Order(user_id=user.id, date=DAY, is_adhoc=True)
+            db.add(order)
+            db.flush()
+            if n % 2 == 0:
+                db.add(OrderItem(order_id=order.id, product_id=curd.id, quantity=2))
+        if n % 3 == 1:
+            db.add(Order(user_id=user.id, date=DAY, is_adhoc=False))
+
+    db.commit()
+
+
+def reference_deliveries(db, delivery_date):
+    """The original per-subscription loop, kept as the behavioural reference"""
+    deliveries = []
+    for subscription in db.query(Subscription).filter(Subscription.is_active == True).all():
+        vacation = db.query(Vacation).filter(
+            Vacation.user_id == subscription.user_id,
+            Vacation.start_date <= delivery_date,
+            Vacation.end_date >= delivery_date
+        ).first()
+        if not vacation:
+            items = db.query(SubscriptionItem).filter(
+                SubscriptionItem.subscription_id == subscription.id
+            ).all()
+            if items:
+                deliveries.append({
+                    "user_id": subscription.user_id,
+                    "date": delivery_date,
+                    "items": [{"product_id": i.product_id, "quantity": i.quantity} for i in items],
+                    "is_subscription": True
+                })
+    for order in db.query(Order).filter(Order.date == delivery_date, Order.is_adhoc == True).all():
+        items = db.query(OrderItem).filter(OrderItem.order_id == order.id).all()
+        deliveries.append({
+            "user_id": order.user_id,
+            "date": delivery_date,
+            "items": [{"product_id": i.product_id, "quantity": i.quantity} for i in items],
+            "is_subscription": False,
+            "is_adhoc": True
+        })
+    return deliveries
+
+
+def test_manifest_matches_reference(db):
+    seed(db, 40)
+    assert manifest.build_manifest(db, DAY) == reference_deliveries(db, DAY)
+    assert manifest.build_manifest(db, date(2024, 3, 16)) == reference_deliveries(db, date(2024, 3, 16))
+
+
+def test_manifest_user_filter(db):
+    seed(db, 12)
+    expected = [d for d in reference_deliveries(db, DAY) if d["user_id"] in (2, 3)]
+    assert manifest.build_manifest(db, DAY, user_ids=[2, 3]) == expected
+
+
+@pytest.mark.parametrize("households", [5, 200])
+def test_manifest_query_count_is_constant(engine, db, households):
+    seed(db, households)
+    with count_queries(engine) as statements:
+        deliveries = manifest.build_manifest(db, DAY)
+    assert deliveries
+    # Cancellations, subscriptions, orders
+    assert len(statements) == 3
+
+
+def test_materialized_manifest_follows_writes(engine, db):
+    seed(db, 10)
+    today = date.today()
+    days = [today + timedelta(days=n) for n in range(3)]
+    manifest_store.rebuild(db, today, 3)
+    assert manifest_store.load(db, today + timedelta(days=3)) is None
+
+    # Replace user 1's subscription
+    db.query(Subscription).filter(Subscription.user_id == 1).update({"is_active": False})
+    subscription = Subscription(user_id=1)
+    db.add(subscription)
+    db.flush()
+    db.add(SubscriptionItem(subscription_id=subscription.id, product_id=2, quantity=7))
+    manifest_store.refresh_users(db, [1])
+    # User 2 goes away tomorrow, user 3 orders for the day after
+    db.add(Vacation(user_id=2, start_date=days[1], end_date=days[1]))
+    manifest_store.refresh_users(db, [2], days[1], days[1])
+    order = Order(user_id=3, date=days[2], is_adhoc=True)
+    db.add(order)
+    db.flush()
+    db.add(OrderItem(order_id=order.id, product_id=1, quantity=4))
+    manifest_store.refresh_users(db, [3], days[2], days[2])
+    db.commit()
+
+    for day in days:
+        assert manifest_store.diff_day(db, day) == {"missing": [], "unexpected": []}
+        with count_queries(engine) as statements:
+            stored = manifest_store.get_deliveries(db, day)
+        assert len(statements) == 1
+        assert stored == manifest.build_manifest(db, day)
+
+
+def test_concurrent_subscription_writes_leave_no_orphans(tmp_path, monkeypatch):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'writes.db'}")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    catalog.invalidate()
+    with session_factory() as db:
+        seed(db, 4)
+        manifest_store.rebuild(db, date.today(), 2)
+
+    # Every fifth write fails after its rows were flushed
+    refresh_users, calls = manifest_store.refresh_users, []
+
+    def failing_refresh(db, user_ids, *args):
+        calls.append(1)
+        if len(calls) % 5 == 0:
+            raise RuntimeError("simulated failure")
+        return refresh_users(db, user_ids, *args)
+
+    monkeypatch.setattr(manifest_store, "refresh_users", failing_refresh)
+    commits = []
+    event.listen(engine, "commit", lambda conn: commits.append(1))
+
+    def replace(n):
+        with session_factory() as db:
+            try:
+                writes.create_subscription(db, n % 4 + 1, SubscriptionCreate(
+                    items=[{"product_id": 1, "quantity": n % 3 + 1}, {"product_id": 2, "quantity": 1}]
+                ))
+                db.commit()
+                return True
+            except RuntimeError:
+                db.rollback()
+                return False
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        succeeded = sum(pool.map(replace, range(60)))
+    assert succeeded == 48 and len(commits) == succeeded
+
+    with session_factory() as db:
+        created = db.query(Subscription).filter(Subscription.id > 8).all()
+        assert len(created) == succeeded
+        assert all(len(subscription.items) == 2 for subscription in created)
+        for user_id in range(1, 5):
+            assert db.query(Subscription).filter(Subscription.user_id == user_id, Subscription.is_active == True).count() == 1
+        for day in (date.today(), date.today() + timedelta(days=1)):
+            assert manifest_store.diff_day(db, day) == {"missing": [], "unexpected": []}
+
+        with pytest.raises(HTTPException):
+            writes.create_order(db, 1, OrderCreate(date=DAY, items=[{"product_id": 99, "quantity": 1}]))
+        db.rollback()
+        assert db.query(Order).filter(Order.user_id == 1, Order.date == DAY).count() == 1
+    engine.dispose()
+
+
+def test_consistency_check_reports_drift(db):
+    seed(db, 6)
+    today = date.today()
+    manifest_store.rebuild(db, today, 1)
+
+    # A write that bypasses refresh_users leaves the manifest stale
+    db.add(Vacation(user_id=2, start_date=today, end_date=today))
+    db.commit()
+
+    diff = manifest_store.diff_day(db, today)
+    assert diff["missing"] == []
+    assert [d["user_id"] for d in diff["unexpected"]] == [2]
+
+
+def test_bulk_import_users_reports_rows_and_batches(engine, db, monkeypatch):
+    monkeypatch.setattr(bulk_import, "BATCH_SIZE", 4)
+    db.add(User(name="Existing", email="taken@example.com", house_number="A-0"))
+    db.commit()
+    body = "\n".join([
+        *(f'{{"name": "R{n}", "email": "r{n}@example.com", "house_number": "B-{n}"}}' for n in range(9)),
+        '{"name": "Again", "email": "r3@example.com", "house_number": "B-3"}',
+        '{"name": "Taken", "email": "taken@example.com", "house_number": "B-9"}',
+        '{"email": "incomplete@example.com"}',
+        "not json"
+    ]).encode()
+    rows, errors = bulk_import.parse_rows(body, "application/x-ndjson")
+
+    with count_queries(engine) as statements:
+        result = bulk_import.import_users(db, rows, errors=errors)
+    assert result["imported"] == 9
+    assert [(e["row"], e["error"].split(":")[0]) for e in result["errors"]] == [
+        (10, "Duplicate email in import"), (11, "Email already registered"),
+        (12, "name"), (13, "Invalid JSON")
+    ]
+    # One existence check and one insert per batch, not per row
+    assert len([s for s in statements if s.lstrip().upper().startswith("INSERT")]) <= 4
+    assert db.query(User).count() == 10
+
+
+def test_bulk_import_subscriptions_and_vacations_refresh_manifest(db, monkeypatch):
+    seed(db, 4)
+    today = date.today()
+    manifest_store.rebuild(db, today, 2)
+    csv_body = (
+        "email,frequency,product_id,quantity\n"
+        "r0@example.com,daily,1,3\n"
+        "r0@example.com,,2,1\n"
+        "nobody@example.com,daily,1,1\n"
+        "r1@example.com,daily,99,1\n"
+    ).encode()
+    result = bulk_import.import_subscriptions(db, *bulk_import.parse_rows(csv_body, "text/csv"))
+    assert result == {"imported": 1, "errors": [
+        {"row": 3, "error": "User not found"}, {"row": 4, "error": "Unknown product ids: [99]"}
+    ]}
+    active = db.query(Subscription).filter(Subscription.user_id == 1, Subscription.is_active == True).all()
+    assert len(active) == 1
+    assert sorted((i.product_id, i.quantity) for i in active[0].items) == [(1, 3), (2, 1)]
+
+    vacations = [{"email": "r2@example.com", "start_date": today.isoformat(), "end_date": today.isoformat()},
+                 {"user_id": 3, "start_date": today.isoformat(), "end_date": (today - timedelta(days=1)).isoformat()}]
+    result = bulk_import.import_vacations(db, *bulk_import.parse_rows(json.dumps(vacations).encode(), "application/json"))
+    assert result == {"imported": 1, "errors": [{"row": 2, "error": "end_date is before start_date"}]}
+
+    for day in (today, today + timedelta(days=1)):
+        assert manifest_store.diff_day(db, day) == {"missing": [], "unexpected": []}
+
+    # A database error anywhere in a batch's writes fails its rows, not the request
+    def failing_refresh(db, *args):
+        raise OperationalError("UPDATE manifest_entries", {}, Exception("database is locked"))
+
+    monkeypatch.setattr(manifest_store, "refresh_users", failing_refresh)
+    result = bulk_import.import_vacations(db, [(1, {"user_id": 4, "start_date": today, "end_date": today})])
+    assert result == {"imported": 0, "errors": [{"row": 1, "error": "Batch not imported: OperationalError"}]}
+    assert db.query(Vacation).filter(Vacation.user_id == 4, Vacation.start_date == today).count() == 0
+    monkeypatch.undo()
+    result = bulk_import.import_subscriptions(db, [(1, {"user_id": 2, "product_id": 1, "quantity": 1})])
+    assert result == {"imported": 1, "errors": []}
+
+
+def test_streamed_deliveries_carry_residents_and_filter_by_block(db):
+    seed(db, 8)
+    today = date.today()
+    resident_keys = ("name", "house_number", "address")
+
+    live = list(manifest.iter_deliveries(db, today, residents=True))
+    assert [{k: v for k, v in d.items() if k not in resident_keys} for d in live] == manifest.build_manifest(db, today)
+    assert all(d["name"] == f"Resident {d['user_id'] - 1}" for d in live)
+
+    manifest_store.rebuild(db, today, 1)
+    assert list(manifest_store.iter_deliveries(db, today, residents=True)) == live
+
+    db.query(User).filter(User.id == 2).update({"house_number": "B-7"})
+    db.commit()
+    assert [d["user_id"] for d in routing.in_blocks(manifest_store.iter_deliveries(db, today, residents=True), {"B"})] == [2]
+
+
+def test_manifest_changes_are_pushed_to_listeners_after_commit(db):
+    seed(db, 6)
+    today = date.today()
+    manifest_store.rebuild(db, today, 2)
+    broadcaster = manifest_events.broadcaster
+
+    def events(text):
+        return [(frame.split("event: ")[1].split("\n")[0], json.loads(frame.split("data: ")[1]))
+                for frame in text.split("\n\n") if "data: " in frame]
+
+    async def follow():
+        everything = broadcaster.listen(today)
+        block_b = broadcaster.listen(today, {"B"})
+        assert await everything.__anext__() == "retry: 3000\n\n"
+        assert await block_b.__anext__() == "retry: 3000\n\n"
+        resume_from = broadcaster._last
+
+        # An ad-hoc order changes user 2's stop; a rolled-back vacation publishes nothing
+        writes.create_order(db, 2, OrderCreate(date=today, is_adhoc=True, items=[{"product_id": 1, "quantity": 3}]))
+        db.commit()
+        db.add(Vacation(user_id=3, start_date=today, end_date=today))
+        manifest_store.refresh_users(db, [3], today, today)
+        db.rollback()
+        # A new resident's first subscription adds a stop in block B
+        db.add(User(name="New", email="new@example.com", house_number="B-1"))
+        db.flush()
+        writes.create_subscription(db, 7, SubscriptionCreate(items=[{"product_id": 2, "quantity": 1}]))
+        db.commit()
+        # User 1 goes away today, and tomorrow's stops do not concern today's listeners
+        db.add(Vacation(user_id=1, start_date=today, end_date=today + timedelta(days=1)))
+        manifest_store.refresh_users(db, [1], today, today + timedelta(days=1))
+        db.commit()
+
+        received = events(await everything.__anext__())
+        assert [(name, change["type"], change["user_id"]) for name, change in received] == [
+            ("stop", "changed", 2), ("stop", "added", 7), ("stop", "removed", 1)
+        ]
+        assert received[0][1]["deliveries"] == [
+            json.loads(json.dumps(d, default=str)) for d in manifest_store.get_deliveries(db, today) if d["user_id"] == 2
+        ]
+        assert received[1][1]["house_number"] == "B-1"
+        assert [change["user_id"] for _, change in events(await block_b.__anext__())] == [7]
+
+        # Resuming from an event id replays what followed it; a foreign id or a rebuilt day means reset
+        resumed = broadcaster.listen(today, last_event_id=f"{broadcaster.token}:{resume_from}")
+        await resumed.__anext__()
+        assert [change["user_id"] for _, change in events(await resumed.__anext__())] == [2, 7, 1]
+        stale = broadcaster.listen(today, last_event_id="elsewhere:12")
+        await stale.__anext__()
+        assert events(await stale.__anext__()) == [("reset", {"type": "reset", "date": today.isoformat()})]
+        manifest_store.rebuild(db, today, 1)
+        assert events(await everything.__anext__()) == [("reset", {"type": "reset", "date": today.isoformat()})]
+        for listener in (everything, block_b, resumed, stale):
+            await listener.aclose()
+
+    asyncio.run(follow())
+    assert broadcaster.listeners == 0
+
+    # A listener that fell further behind than the backlog is told to reset
+    small = manifest_events.Broadcaster(backlog=2, ping=0.01)
+
+    async def lag():
+        listener = small.listen(today)
+        await listener.__anext__()
+        small.publish([{"type": "reset", "date": today} for _ in range(3)])
+        assert events(await listener.__anext__())[0][0] == "reset"
+        small.publish([{"type": "reset", "date": today}])
+        assert len(events(await listener.__anext__())) == 1
+        # An idle stream sends keep-alive comments
+        assert await listener.__anext__() == ": ping\n\n"
+        await listener.aclose()
+
+    asyncio.run(lag())
+
+
+def test_delivery_updates_sync_in_batches_idempotently(engine, db):
+    seed(db, 6)
+    driver = User(name="Driver", email="driver@example.com", house_number="D-1", role="delivery_person")
+    db.add(driver)
+    db.commit()
+    order = db.query(Order).filter(Order.user_id == 4, Order.date == DAY, Order.is_adhoc == True).one()
+    at = lambda hour: f"2024-03-15T{hour:02d}:00:00"  # noqa: E731
+    batch = list(enumerate([
+        {"client_id": "a", "user_id": 1, "delivery_date": "2024-03-15", "status": "delivered", "recorded_at": at(6)},
+        {"client_id": "b", "user_id": 4, "delivery_date": "2024-03-15", "status": "delivered", "recorded_at": at(6)},
+        {"client_id": "a", "user_id": 1, "delivery_date": "2024-03-15", "status": "delivered", "recorded_at": at(6)},
+        {"client_id": "c", "user_id": 2, "delivery_date": "2024-03-15", "status": "lost"},
+        {"client_id": "d", "user_id": 999, "delivery_date": "2024-03-15", "status": "missed"},
+        {"user_id": 3, "delivery_date": "2024-03-15", "status": "missed"},
+    ], start=1))
+
+    # One transaction with a fixed number of statements for the whole batch
+    with count_queries(engine) as statements:
+        result = delivery_status.apply_updates(db, driver.id, batch)
+    assert len(statements) == 7
+    assert (result["applied"], result["duplicates"]) == (2, ["a"])
+    assert [error["row"] for error in result["errors"]] == [4, 5, 6]
+    db.refresh(order)
+    assert order.status == "delivered"
+
+    # A phone that never saw the response sends the batch again
+    again = delivery_status.apply_updates(db, driver.id, batch[:3])
+    assert (again["applied"], again["duplicates"]) == (0, ["a", "b", "a"])
+
+    # The latest report by the phone's clock stands, whatever the arrival order
+    delivery_status.apply_updates(db, driver.id, [
+        (1, {"client_id": "e", "user_id": 4, "delivery_date": "2024-03-15", "status": "missed", "recorded_at": at(8)}),
+        (2, {"client_id": "f", "user_id": 4, "delivery_date": "2024-03-15", "status": "delivered", "recorded_at": at(7)}),
+    ])
+    db.refresh(order)
+    assert order.status == "pending"
+    assert [(s["user_id"], s["status"]) for s in delivery_status.day_status(db, DAY)] == [(1, "delivered"), (4, "missed")]
+    assert delivery_status.day_status(db, DAY, driver_id=1) == []
+    with pytest.raises(HTTPException):
+        delivery_status.apply_updates(db, 1, batch)
+
+
+@pytest.mark.parametrize("house_number, block", [
+    ("A-101", "A"), ("a/204", "A"), ("B2 14", "B2"), ("C305", "C"), ("42", "42"), ("", "")
+])
+def test_block_of(house_number, block):
+    assert routing.block_of(house_number) == block
+
+
+@pytest.mark.parametrize("house_number, key", [
+    ("A-401", ("A", 4, 1)), ("B/3/12", ("B", 3, 12)), ("C1205", ("C", 12, 5)), ("T2 11 4", ("T2", 11, 4)), ("42", ("42", 0, 0))
+])
+def test_house_key(house_number, key):
+    assert route_planner.house_key(house_number) == key
+
+
+def test_route_plan_orders_splits_and_caches(db):
+    route_planner.invalidate()
+    milk = Product(name="Milk", price=25.0)
+    db.add(milk)
+    db.flush()
+    # Inserted out of order: block B first, floors descending
+    for house_number in ["B-201", "B-101", "A10-101", "A2-302", "A2-101", "A2-201"]:
+        user = User(name=house_number, email=f"{house_number}@example.com", house_number=house_number,
+                    address="Tower, Green Meadows")
+        db.add(user)
+        db.flush()
+        db.add(Subscription(user_id=user.id, items=[SubscriptionItem(product_id=milk.id, quantity=2)]))
+    db.commit()
+    today = date.today()
+
+    (route,) = route_planner.plan_day(db, today, [None])
+    assert [stop["house_number"] for stop in route["stops"]] == ["A2-101", "A2-201", "A2-302", "A10-101", "B-101", "B-201"]
+    assert [stop["sequence"] for stop in route["stops"]] == [1, 2, 3, 4, 5, 6]
+    assert route["load"] == [{"product_id": milk.id, "quantity": 12}] and route["total_quantity"] == 12
+
+    # Two drivers: cut at the block boundary nearest to half the load; a
+    # 4-unit vehicle then takes three full trips, the third one driver 7's second
+    routes = route_planner.plan_day(db, today, [7, 8])
+    assert [[stop["block"] for stop in r["stops"]] for r in routes] == [["A2", "A2", "A2"], ["A10", "B", "B"]]
+    routes = route_planner.plan_day(db, today, [7, 8], capacity=4)
+    assert [(r["driver_id"], r["trip"], r["total_quantity"]) for r in routes] == [(7, 1, 4), (8, 1, 4), (7, 2, 4)]
+    assert [stop["house_number"] for r in routes for stop in r["stops"]] == [
+        "A2-101", "A2-201", "A2-302", "A10-101", "B-101", "B-201"
+    ]
+
+    # Cached until the day's stops change
+    assert route_planner.plan_day(db, today, [7, 8]) is route_planner.plan_day(db, today, [7, 8])
+    cached = route_planner.plan_day(db, today, [None])
+    db.add(Order(user_id=1, date=today, is_adhoc=True, items=[OrderItem(product_id=milk.id, quantity=1)]))
+    db.commit()
+    assert route_planner.plan_day(db, today, [None]) is not cached
+    assert route_planner.plan_day(db, today, [None])[0]["total_quantity"] == 13
+
+    # With coordinates, buildings follow a short tour: here a line walked end to end
+    for user_id, longitude in [(1, 0.004), (2, 0.003), (3, 0.0), (4, 0.001), (5, 0.002), (6, 0.002)]:
+        db.query(User).filter(User.id == user_id).update({"latitude": 12.9, "longitude": 77.6 + longitude})
+    db.commit()
+    (route,) = route_planner.plan_day(db, today, [None])
+    assert [stop["block"] for stop in route["stops"]] in (
+        ["A10", "A2", "A2", "A2", "B", "B"], ["B", "B", "A2", "A2", "A2", "A10"]
+    )
+
+
+def test_driver_routes_cover_every_stop_once_with_some_blocks_assigned(db):
+    route_planner.invalidate()
+    milk = Product(name="Milk", price=25.0)
+    db.add(milk)
+    db.flush()
+    for house_number in ["A-101", "A-201", "A-301", "B-101", "B-201", "C-101", "C-201"]:
+        user = User(name=house_number, email=f"{house_number}@example.com", house_number=house_number)
+        db.add(user)
+        db.flush()
+        db.add(Subscription(user_id=user.id, items=[SubscriptionItem(product_id=milk.id, quantity=1)]))
+    drivers = []
+    for name in ("X", "Y", "Z"):
+        driver = User(name=name, email=f"{name}@example.com", house_number="-", role="delivery_person")
+        db.add(driver)
+        db.flush()
+        drivers.append(driver.id)
+    x, y, z = drivers
+    routing.set_driver_blocks(db, x, ["C"])
+    db.commit()
+    today = date.today()
+
+    def houses(driver_id):
+        return [stop["house_number"] for route in route_planner.driver_route(db, today, driver_id)["routes"]
+                for stop in route["stops"]]
+
+    # X has block C; Y and Z share A and B, which nobody is assigned
+    assert houses(x) == ["C-101", "C-201"]
+    assert houses(y) == ["A-101", "A-201", "A-301"] and houses(z) == ["B-101", "B-201"]
+
+    # Z away: Y takes every unassigned stop
+    db.query(User).filter(User.id == z).update({"role": "resident"})
+    db.commit()
+    assert houses(y) == ["A-101", "A-201", "A-301", "B-101", "B-201"]
+    assert houses(x) == ["C-101", "C-201"]
+
+
+def test_two_opt_untangles_a_shuffled_line():
+    points = [(float(x), 0.0) for x in range(40)]
+    tour = list(range(0, 40, 2)) + list(range(39, 0, -2))
+    improved = route_planner.two_opt(points, tour)
+    assert sorted(improved) == list(range(40))
+    assert route_planner.tour_length(points, improved) < route_planner.tour_length(points, tour)
+
+
+def test_summary_matches_manifest_totals(engine, db):
+    seed(db, 30)
+    start, end = date(2024, 3, 14), date(2024, 3, 17)
+    with count_queries(engine) as statements:
+        summary = inventory.summarize(db, start, end)
+    assert len(statements) == 3
+
+    prices = {p.id: p.price for p in db.query(Product)}
+    for offset, day_summary in enumerate(summary["days"]):
+        day = start + timedelta(days=offset)
+        expected = {}
+        for delivery in manifest.build_manifest(db, day):
+            for item in delivery["items"]:
+                expected[item["product_id"]] = expected.get(item["product_id"], 0) + item["quantity"]
+        assert day_summary["date"] == day
+        assert {line["product_id"]: line["quantity"] for line in day_summary["products"]} == expected
+        assert day_summary["total_revenue"] == sum(q * prices[p] for p, q in expected.items())
+
+    assert summary["total_quantity"] == sum(d["total_quantity"] for d in summary["days"])
+
+
+@pytest.mark.parametrize("value, created, delivered", [
+    ("daily", None, [15, 16, 17, 18, 19, 20, 21]),
+    ("", None, [15, 16, 17, 18, 19, 20, 21]),
+    ("alternate", date(2024, 3, 1), [15, 17, 19, 21]),
+    ("every_3_days", date(2024, 3, 1), [16, 19]),
+    ("weekly", date(2024, 3, 5), [19]),
+    ("weekdays", None, [15, 18, 19, 20, 21]),
+    ("weekends", None, [16, 17]),
+    ("days:mon,thu", None, [18, 21]),
+    ("fortnightly", None, [15, 16, 17, 18, 19, 20, 21]),
+])
+def test_frequency_rules(value, created, delivered):
+    week = [date(2024, 3, day) for day in range(15, 22)]
+    assert [day.day for day in week if frequency.delivers_on(value, created, day)] == delivered
+    assert frequency.is_valid(value) == (value != "fortnightly")
+
+
+def test_schedule_matches_daily_manifests(engine, db):
+    seed(db, 40)
+    rules = ["daily", "alternate", "weekly", "weekdays", "days:mon,thu", "every_3_days"]
+    for n, subscription in enumerate(db.query(Subscription).filter(Subscription.is_active == True)):
+        subscription.frequency = rules[n % len(rules)]
+        subscription.created_at = datetime(2024, 3, n % 7 + 1)
+    db.commit()
+
+    start, end = date(2024, 3, 9), date(2024, 3, 24)
+    with count_queries(engine) as statements:
+        forecast = schedule.expand(db, start, end)
+    assert len(statements) == 4
+    for day, deliveries in forecast.manifest():
+        assert deliveries == manifest.build_manifest(db, day)
+    assert forecast.product_totals() == inventory.product_totals(db, start, end)
+
+    # Cancelled ad-hoc orders drop out of the schedule
+    order = db.query(Order).filter(Order.date == DAY, Order.is_adhoc == True).first()
+    db.add(Cancellation(user_id=order.user_id, cancellation_type="order", reference_id=order.id))
+    db.commit()
+    assert len(schedule.expand(db, DAY, DAY).deliveries(DAY)) == len(forecast.deliveries(DAY)) - 1
+
+
+def test_cancellations_apply_to_every_delivery_computation(engine, db):
+    seed(db, 12)
+    before = manifest.build_manifest(db, DAY)
+    assert vacation_index.is_away(db, 1, DAY)
+    subscription = db.query(Subscription).filter(Subscription.user_id == 3, Subscription.is_active == True).one()
+    order = db.query(Order).filter(Order.user_id == 4, Order.date == DAY, Order.is_adhoc == True).one()
+    vacation = db.query(Vacation).filter(Vacation.user_id == 1).one()
+    db.add_all([
+        Cancellation(user_id=3, cancellation_type="subscription", reference_id=subscription.id),
+        Cancellation(user_id=4, cancellation_type="order", reference_id=order.id),
+        Cancellation(user_id=1, cancellation_type="vacation", reference_id=vacation.id),
+    ])
+    db.commit()
+    vacation_index.refresh_users(db, [1])
+
+    # The index catches up in one query, then no lookup per delivery
+    with count_queries(engine) as statements:
+        after = manifest.build_manifest(db, DAY)
+    assert len(statements) == 3
+    kinds = lambda deliveries, user_id: [d["is_subscription"] for d in deliveries if d["user_id"] == user_id]  # noqa: E731
+    assert (kinds(before, 3), kinds(after, 3)) == ([True], [])
+    assert (kinds(before, 4), kinds(after, 4)) == ([True, False], [True])
+    assert (kinds(before, 1), kinds(after, 1)) == ([False], [True, False])
+    assert len(after) == len(before) - 1
+    assert not vacation_index.is_away(db, 1, DAY)
+
+    forecast = schedule.expand(db, DAY, DAY)
+    assert forecast.deliveries(DAY) == after
+    assert forecast.product_totals() == inventory.product_totals(db, DAY, DAY)
+
+    index = cancellation_index.exclusions(db)
+    assert (subscription.id in index.subscriptions, subscription.id in index.orders) == (True, False)
+    assert index.vacations_overlapping(date(2024, 3, 1), date(2024, 3, 9)) == []
+    assert index.vacations_overlapping(date(2024, 3, 20), date(2024, 4, 1)) == [vacation.id]
+
+
+def test_cancellations_only_reach_the_residents_own_rows(db):
+    import main
+    from database import get_db
+    seed(db, 4)
+    today = date.today()
+    manifest_store.rebuild(db, today, 1)
+    own = db.query(Subscription.id).filter(Subscription.user_id == 1, Subscription.is_active == True).scalar()
+    other = db.query(Subscription.id).filter(Subscription.user_id == 2, Subscription.is_active == True).scalar()
+    main.app.dependency_overrides[get_db] = lambda: db
+    try:
+        client = TestClient(main.app)
+        cancel = lambda kind, reference_id: client.post(  # noqa: E731
+            "/users/1/cancellations", json={"cancellation_type": kind, "reference_id": reference_id}
+        )
+        assert cancel("subscription", other).status_code == 404
+        assert cancel("order", 999).status_code == 404
+        assert cancel("holiday", own).status_code == 400
+        assert db.query(Cancellation).count() == 0
+
+        assert cancel("subscription", own).status_code == 200
+        assert 1 not in {d["user_id"] for d in manifest.build_manifest(db, today)}
+        assert manifest_store.diff_day(db, today) == {"missing": [], "unexpected": []}
+    finally:
+        main.app.dependency_overrides.clear()
+
+
+def test_cancellation_index_only_shares_committed_cancellations(db):
+    seed(db, 6)
+    first, second = db.query(Order).filter(Order.date == DAY, Order.is_adhoc == True).limit(2).all()
+    assert first.id not in cancellation_index.exclusions(db).orders
+
+    # The session's own uncommitted cancellation applies to it alone, and a rollback leaves nothing behind
+    db.add(Cancellation(user_id=first.user_id, cancellation_type="order", reference_id=first.id))
+    db.flush()
+    assert first.id in cancellation_index.exclusions(db).orders
+    assert first.id not in cancellation_index._index.orders
+    db.rollback()
+    assert first.id not in cancellation_index.exclusions(db).orders
+
+    # SQLite hands the rolled-back id out again
+    db.add(Cancellation(user_id=second.user_id, cancellation_type="order", reference_id=second.id))
+    db.commit()
+    index = cancellation_index.exclusions(db)
+    assert (first.id in index.orders, second.id in index.orders) == (False, True)
+
+    # An id committed below the highest one already loaded, as out-of-order sequences do
+    top = index.last_id
+    db.add(Cancellation(id=top + 5, user_id=1, cancellation_type="subscription", reference_id=1001))
+    db.commit()
+    assert 1001 in cancellation_index.exclusions(db).subscriptions
+    db.add(Cancellation(id=top + 2, user_id=1, cancellation_type="subscription", reference_id=1002))
+    db.commit()
+    assert 1002 in cancellation_index.exclusions(db).subscriptions
+
+
+def test_cancellation_index_loads_once_for_concurrent_callers(tmp_path, monkeypatch):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'cancellations.db'}")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with session_factory() as db:
+        seed(db, 6)
+        order = db.query(Order).filter(Order.is_adhoc == True).first()
+        db.add(Cancellation(user_id=order.user_id, cancellation_type="order", reference_id=order.id))
+        db.commit()
+        order_id = order.id
+
+    load = cancellation_index._load
+
+    def slow_load(db, pending):
+        time.sleep(0.2)
+        return load(db, pending)
+
+    monkeypatch.setattr(cancellation_index, "_load", slow_load)
+
+    def cancelled(_):
+        with session_factory() as db:
+            return order_id in cancellation_index.exclusions(db).orders
+
+    # Cold, the others wait for the one load; invalidated, they use the old index meanwhile
+    for _ in range(2):
+        cancellation_index.invalidate()
+        loads = cancellation_index.stats()["loads"]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            assert all(pool.map(cancelled, range(8)))
+        assert cancellation_index.stats()["loads"] == loads + 1
+    engine.dispose()
+
+
+def test_monthly_invoices_follow_history_and_are_kept(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'billing.db'}")
+    Base.metadata.create_all(bind=engine)
+    march = date(2024, 3, 1)
+    with sessionmaker(bind=engine)() as db:
+        milk, curd = Product(name="Milk", price=25.0), Product(name="Curd", price=15.0)
+        db.add_all([milk, curd] + [
+            User(name=f"Resident {n}", email=f"r{n}@example.com", house_number=f"A-{n}") for n in range(3)
+        ])
+        db.flush()
+        # Resident 1: daily milk until the 10th, then daily curd (away 20-22),
+        # plus one ad-hoc order; a cancelled order and a "cancelled" one are not billed
+        db.add_all([
+            Subscription(user_id=1, is_active=False, created_at=datetime(2024, 2, 1),
+                         items=[SubscriptionItem(product_id=milk.id, quantity=1)]),
+            Subscription(user_id=1, created_at=datetime(2024, 3, 11, 10),
+                         items=[SubscriptionItem(product_id=curd.id, quantity=2)]),
+            Vacation(user_id=1, start_date=date(2024, 3, 20), end_date=date(2024, 3, 22)),
+            Order(user_id=1, date=date(2024, 3, 5), is_adhoc=True, items=[OrderItem(product_id=milk.id, quantity=3)]),
+            Order(user_id=1, date=date(2024, 3, 6), is_adhoc=True, items=[OrderItem(product_id=milk.id, quantity=5)]),
+            Order(user_id=1, date=date(2024, 3, 7), is_adhoc=True, status="cancelled",
+                  items=[OrderItem(product_id=milk.id, quantity=7)]),
+            # Resident 2: weekly from Monday the 4th, cancelled on the 19th
+            Subscription(user_id=2, frequency="weekly", created_at=datetime(2024, 3, 4),
+                         items=[SubscriptionItem(product_id=milk.id, quantity=2)]),
+        ])
+        db.flush()
+        db.add_all([
+            Cancellation(user_id=1, cancellation_type="order", reference_id=2),
+            Cancellation(user_id=2, cancellation_type="subscription", reference_id=3, cancelled_at=datetime(2024, 3, 19, 8)),
+        ])
+        db.commit()
+
+        expected = {
+            1: ([("Milk", 13, 325.0), ("Curd", 36, 540.0)], 865.0),
+            2: ([("Milk", 6, 150.0)], 150.0),
+        }
+        assert billing.run(db, march, workers=2) == 2
+        assert billing.run(db, march, workers=2) == 0
+        for user_id, (lines, total) in expected.items():
+            invoice = billing.get_invoice(db, user_id, march)
+            assert invoice.id is not None and invoice.total_amount == total
+            assert [(line.product_name, line.quantity, line.amount) for line in invoice.lines] == lines
+        assert billing.get_invoice(db, 3, march).lines == []
+
+        # Stored bills keep the price they were billed at until recomputed
+        milk.price = 30.0
+        db.commit()
+        assert billing.get_invoice(db, 2, march).total_amount == 150.0
+        assert billing.get_invoice(db, 2, date(2024, 4, 1)).id is None
+        assert billing.run(db, march, replace=True) == 2
+        assert billing.get_invoice(db, 2, march).total_amount == 180.0
+    engine.dispose()
+
+
+def test_jobs_are_queued_once_retried_and_recorded(engine, monkeypatch):
+    Session = sessionmaker(bind=engine)
+    calls = []
+
+    def flaky(db, payload):
+        calls.append(payload)
+        if payload.get("fail"):
+            raise RuntimeError("boom")
+        return {"doubled": payload["n"] * 2}
+
+    monkeypatch.setitem(jobs.HANDLERS, "flaky", flaky)
+    monkeypatch.setattr(jobs, "JOB_RETRY_SECONDS", 0)
+    with Session() as db:
+        with pytest.raises(ValueError):
+            jobs.enqueue(db, "nope")
+        ok = jobs.enqueue(db, "flaky", {"n": 21}, key="ok")
+        assert jobs.enqueue(db, "flaky", {"n": 0}, key="ok").id == ok.id
+        bad = jobs.enqueue(db, "flaky", {"fail": True}, max_attempts=2)
+        ok_id, bad_id = ok.id, bad.id
+
+    # Both run; the failure is retried once (no backoff here) and then given up
+    monkeypatch.setattr(jobs, "SCHEDULE", [])
+    assert jobs.work(Session, "test") == 3
+    assert jobs.work(Session, "test") == 0
+    with Session() as db:
+        ok, bad = db.get(jobs.Job, ok_id), db.get(jobs.Job, bad_id)
+        assert (ok.status, ok.attempts, json.loads(ok.result)) == ("succeeded", 1, {"doubled": 42})
+        assert (bad.status, bad.attempts, bad.error) == ("failed", 2, "RuntimeError: boom")
+        assert bad.worker == "test" and bad.finished_at is not None
+    assert len(calls) == 3
+
+    # Periodic jobs are queued once per period, from their time of day
+    monkeypatch.setattr(jobs, "SCHEDULE", [jobs.Periodic("flaky", jobs.clock(1), "monthly")])
+    with Session() as db:
+        assert jobs.enqueue_due(db, datetime(2024, 3, 1, 0, 30)) == []
+        first = jobs.enqueue_due(db, datetime(2024, 3, 1, 1, 0))
+        again = jobs.enqueue_due(db, datetime(2024, 3, 20, 9, 0))
+        assert [job.id for job in first] == [job.id for job in again]
+        assert first[0].key == "flaky:2024-03-01" and json.loads(first[0].payload) == {"period_start": "2024-03-01"}
+
+        # A job whose worker went away is put back in the queue
+        job = jobs.claim(db, "gone")
+        assert job.id == first[0].id and job.status == "running"
+        assert jobs.requeue_stale(db, timeout=3600) == 0
+        assert jobs.requeue_stale(db, timeout=-1) == 1
+        db.refresh(job)
+        assert job.status == "queued" and "gone" in job.error
+
+
+def test_app_import_and_startup_run_no_sql(engine, monkeypatch):
+    import database
+    statements = []
+
+    def record(connection, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", record)
+    try:
+        import main
+        monkeypatch.setattr(main, "DATABASE_SETUP", False)
+        with TestClient(main.app):
+            pass
+    finally:
+        event.remove(database.engine, "before_cursor_execute", record)
+    assert statements == []
+
+    # The one-time setup seeds an empty catalog only
+    with sessionmaker(bind=engine)() as db:
+        assert catalog.add_sample_products(db) == 4
+        assert catalog.add_sample_products(db) == 0
+        assert [product.name for product in db.query(Product).order_by(Product.id)] == ["Milk", "Curd", "Butter", "Cheese"]
+
+
+def test_resident_dashboard_is_one_request_and_revalidates(engine, db):
+    import main
+    from database import get_db
+    seed(db, 6)
+    catalog.snapshot(db)
+    main.app.dependency_overrides[get_db] = lambda: db
+    try:
+        client = TestClient(main.app)
+        with count_queries(engine) as statements:
+            first = client.get("/users/1/dashboard")
+        # User, subscription and items, orders and items, vacations, cancellations
+        assert first.status_code == 200 and len(statements) == 7
+        body = first.json()
+        assert body["user"]["id"] == 1 and [p["name"] for p in body["products"]] == ["Milk", "Curd"]
+        assert [(i["product_id"], i["quantity"], i["product"]["name"]) for i in body["subscription"]["items"]] == [(1, 1, "Milk")]
+        assert [order["date"] for order in body["orders"]] == ["2024-03-15"]
+        assert [v["start_date"] for v in body["vacations"]] == ["2024-03-10"] and body["cancellations"] == []
+
+        # Unchanged: 304 after one query
+        etag = first.headers["etag"]
+        with count_queries(engine) as statements:
+            again = client.get("/users/1/dashboard", headers={"If-None-Match": etag})
+        assert (again.status_code, again.headers["etag"], len(statements)) == (304, etag, 1)
+
+        # Another resident's write leaves it alone; the resident's own writes and catalog changes do not
+        writes.create_order(db, 2, OrderCreate(date=DAY, is_adhoc=True, items=[{"product_id": 2, "quantity": 1}]))
+        db.commit()
+        assert client.get("/users/1/dashboard", headers={"If-None-Match": etag}).status_code == 304
+        assert client.post("/users/1/vacations", json={"start_date": "2024-04-01", "end_date": "2024-04-02"}).status_code == 200
+        changed = client.get("/users/1/dashboard", headers={"If-None-Match": etag})
+        assert changed.status_code == 200 and changed.headers["etag"] != etag
+        assert [v["start_date"] for v in changed.json()["vacations"]] == ["2024-04-01", "2024-03-10"]
+        etag = changed.headers["etag"]
+        client.post("/products", json={"name": "Ghee", "price": 60.0})
+        assert client.get("/users/1/dashboard", headers={"If-None-Match": etag}).status_code == 200
+        assert client.get("/users/999/dashboard").status_code == 404
+    finally:
+        main.app.dependency_overrides.clear()
+
+
+def test_archived_history_reads_like_the_hot_tables(engine, db, monkeypatch):
+    import main
+    from database import get_db
+    seed(db, 40)
+    later = Order(user_id=1, date=date(2024, 6, 1), is_adhoc=True)
+    db.add(later)
+    db.add_all([
+        Cancellation(user_id=4, cancellation_type="order", reference_id=db.query(Order.id).filter(
+            Order.user_id == 4, Order.is_adhoc == True).scalar()),
+        Cancellation(user_id=1, cancellation_type="vacation", reference_id=db.query(Vacation.id).filter(
+            Vacation.user_id == 1).scalar()),
+        Cancellation(user_id=2, cancellation_type="subscription", reference_id=db.query(Subscription.id).filter(
+            Subscription.user_id == 2, Subscription.is_active == True).scalar()),
+    ])
+    db.commit()
+    cancellation_index.invalidate()
+    vacation_index.invalidate()
+    main.app.dependency_overrides[get_db] = lambda: db
+
+    def reads():
+        client = TestClient(main.app)
+        orders, cursor = [], None
+        while True:
+            page = client.get("/users/1/orders", params={"limit": 1, **({"after": cursor} if cursor else {})})
+            orders += page.json()
+            cursor = page.headers.get("x-next-cursor")
+            if not cursor:
+                break
+        return (
+            [manifest.build_manifest(db, day) for day in (date(2024, 3, 14), DAY, date(2024, 3, 16), date(2024, 3, 21))],
+            inventory.summarize(db, date(2024, 3, 14), date(2024, 3, 17)),
+            schedule.expand(db, date(2024, 3, 14), date(2024, 3, 17), history=True).as_dict(),
+            sorted(vacation_index.away_on(db, DAY)),
+            orders,
+            client.get("/users/1/vacations").json(),
+            client.get("/users/4/cancellations").json(),
+        )
+
+    try:
+        before = reads()
+        assert [order["date"] for order in before[4]] == ["2024-03-15", "2024-06-01"] and len(before[6]) == 1
+        version = db.get(User, 4).version
+        result = archive.run(db, today=date(2025, 6, 1))
+        # The highest order, order item and vacation ids stay hot (SQLite would reuse them)
+        assert result["horizon"] == date(2024, 5, 1)
+        assert result["archived"] == {"2024-03": {"orders": 26, "vacations": 19, "cancellations": 2}}
+        assert db.query(Order).count() == 2 and db.query(Vacation).count() == 1 and db.query(Cancellation).count() == 1
+        assert db.get(User, 4).version == version + 1
+        assert reads() == before
+        assert archive.run(db, today=date(2025, 6, 1))["archived"] == {}
+
+        # With archival turned off, the next run moves everything back
+        monkeypatch.setattr(archive, "ARCHIVE_AFTER_MONTHS", 0)
+        assert archive.run(db)["restored"] == {"2024-03": {"orders": 26, "vacations": 19, "cancellations": 2}}
+        assert db.query(Order).count() == 28 and db.query(Cancellation).count() == 3
+        assert reads() == before
+    finally:
+        main.app.dependency_overrides.clear()
+
+
+def test_product_catalog_is_cached_until_invalidated(engine, db):
+    seed(db, 1)
+    with count_queries(engine) as statements:
+        first = catalog.snapshot(db)
+        assert catalog.snapshot(db) is first
+        assert catalog.product_map(db)[2].name == "Curd"
+    assert len(statements) == 1
+    assert catalog.etag_matches(f"W/{first.etag}, \"other\"", first.etag)
+
+    db.add(Product(name="Butter", price=45.0))
+    db.commit()
+    assert catalog.snapshot(db) is first
+    catalog.invalidate()
+    second = catalog.snapshot(db)
+    assert [p.name for p in second.products] == ["Milk", "Curd", "Butter"]
+    assert second.etag != first.etag
+    assert catalog.stats()["misses"] >= 2
+
+
+def test_async_endpoints_serve_concurrent_requests_from_cold_caches(tmp_path):
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+    import httpx
+    import async_api
+    from database import async_database_url, get_async_db, get_db
+
+    url = f"sqlite:///{tmp_path / 'async.db'}"
+    engine = create_db_engine(url)
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as db:
+        seed(db, 12)
+        expected = {
+            "/products": [{"id": 1, "name": "Milk", "price": 25.0}, {"id": 2, "name": "Curd", "price": 15.0}],
+            f"/deliveries/{DAY}": manifest_store.get_deliveries(db, DAY),
+            f"/vacations/{DAY}": {"date": DAY.isoformat(), "user_ids": sorted(vacation_index.away_on(db, DAY))},
+        }
+
+    app = FastAPI()
+    app.include_router(async_api.router)
+    async_engine = create_async_engine(async_database_url(url))
+    session_factory = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+    async def override():
+        async with session_factory() as db:
+            yield db
+
+    def override_sync():
+        with sessionmaker(bind=engine)() as db:
+            yield db
+
+    app.dependency_overrides[get_async_db] = override
+    # The CPU-bound endpoints run in the threadpool on a sync session
+    app.dependency_overrides[get_db] = override_sync
+    paths = list(expected) * 10
+    responses = []
+
+    async def requests():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            responses.extend(await asyncio.gather(*(http.get(path) for path in paths)))
+        await async_engine.dispose()
+        engine.dispose()
+
+    # Every cache starts cold, so the first requests load them concurrently on the event loop,
+    # which a lock held across a query would block for good
+    catalog.invalidate()
+    vacation_index.invalidate()
+    cancellation_index.invalidate()
+    loop = threading.Thread(target=asyncio.run, args=(requests(),), daemon=True)
+    loop.start()
+    loop.join(60)
+    assert not loop.is_alive(), "async requests did not finish"
+    assert [response.status_code for response in responses] == [200] * len(paths)
+    assert [response.json() for response in responses] == [json.loads(json.dumps(expected[path], default=str)) for path in paths]
+
+
+def test_vacation_index_matches_range_queries(db):
+    seed(db, 12)
+    # Overlapping, adjacent and long vacations on top of the seeded ones
+    db.add_all([
+        Vacation(user_id=3, start_date=date(2024, 3, 1), end_date=date(2024, 3, 12)),
+        Vacation(user_id=3, start_date=date(2024, 3, 13), end_date=date(2024, 3, 14)),
+        Vacation(user_id=7, start_date=date(2023, 12, 1), end_date=date(2024, 6, 30)),
+        Vacation(user_id=8, start_date=date(2024, 3, 18), end_date=date(2024, 3, 16)),
+    ])
+    db.commit()
+
+    def away_by_query(day):
+        return {user_id for (user_id,) in db.query(Vacation.user_id).filter(
+            Vacation.start_date <= day, Vacation.end_date >= day)}
+
+    days = [date(2024, 2, 28) + timedelta(days=n) for n in range(30)]
+    for day in days:
+        expected = away_by_query(day)
+        assert vacation_index.away_on(db, day) == expected
+        assert {u for u in range(1, 13) if vacation_index.is_away(db, u, day)} == expected
+
+    db.add(Vacation(user_id=5, start_date=date(2024, 3, 22), end_date=date(2024, 3, 23)))
+    db.commit()
+    assert not vacation_index.is_away(db, 5, date(2024, 3, 22))
+    vacation_index.refresh_users(db, [5])
+    for day in days:
+        assert vacation_index.away_on(db, day) == away_by_query(day)
+
+
+def test_vacation_index_is_built_once_for_concurrent_callers(tmp_path, monkeypatch):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'vacations.db'}")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with session_factory() as db:
+        seed(db, 8)
+    rows = vacation_index._rows
+
+    def slow_rows(db, *args):
+        time.sleep(0.2)
+        return rows(db, *args)
+
+    monkeypatch.setattr(vacation_index, "_rows", slow_rows)
+
+    def away(_):
+        with session_factory() as db:
+            return vacation_index.away_on(db, DAY)
+
+    # Cold, the others wait for the one build; invalidated, they use the old index meanwhile
+    for _ in range(2):
+        vacation_index.invalidate()
+        misses = vacation_index.stats()["misses"]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            assert all(result == {1, 5} for result in pool.map(away, range(8)))
+        assert vacation_index.stats()["misses"] == misses + 1
+    engine.dispose()
+
+
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_keyset_pages_cover_every_row_once(db, order):
+    seed(db, 1)
+    for n in range(23):
+        db.add(Order(user_id=1, date=DAY + timedelta(days=n % 5), is_adhoc=True))
+    db.commit()
+    expected = db.query(Order.id).filter(Order.user_id == 1).order_by(
+        *((Order.date, Order.id) if order == "asc" else (Order.date.desc(), Order.id.desc()))
+    ).all()
+
+    seen, cursor = [], None
+    while True:
+        page = pagination.PageParams(limit=4, after=cursor, order=order, fields=None)
+        response = Response()
+        rows = pagination.paginate(
+            db.query(Order).filter(Order.user_id == 1), Order, [Order.date, Order.id], page, response=response
+        )
+        seen += [row.id for row in rows]
+        cursor = response.headers.get("x-next-cursor")
+        if cursor is None:
+            break
+        assert len(rows) == 4
+    assert seen == [row.id for row in expected]
+
+    sparse = pagination.paginate(
+        db.query(Order).filter(Order.user_id == 1), Order, [Order.date, Order.id],
+        pagination.PageParams(limit=2, after=None, order=order, fields=["id"])
+    )
+    assert json.loads(sparse.body) == [{"id": row.id} for row in expected[:2]]
+
+
+def test_list_endpoints_are_unpaginated_without_limit_or_cursor(db):
+    seed(db, 150)
+    app = FastAPI()
+
+    @app.get("/users")
+    def users(response: Response, page: pagination.PageParams = Depends(pagination.page_params)):
+        rows = pagination.paginate(db.query(User), User, [User.id], page, response=response)
+        return [row.id for row in rows]
+
+    client = TestClient(app)
+    everyone = client.get("/users")
+    assert len(everyone.json()) == db.query(User).count() > pagination.DEFAULT_LIMIT
+    assert "x-next-cursor" not in everyone.headers
+
+    first = client.get("/users?limit=100")
+    assert first.json() == everyone.json()[:100]
+    rest = client.get("/users", params={"after": first.headers["x-next-cursor"]})
+    assert first.json() + rest.json() == everyone.json()
+
+
+def test_fast_json_output_matches_response_models(db, monkeypatch):
+    seed(db, 30)
+    db.add(User(name="Zoë \"Ω\"", email="z@example.com", house_number="B-1", address=None))
+    db.commit()
+    app = FastAPI()
+
+    @app.get("/users", response_model=List[UserSchema])
+    def users(response: Response, page: pagination.PageParams = Depends(pagination.page_params)):
+        return pagination.paginate(db.query(User), User, [User.id], page, response=response, schema=UserSchema)
+
+    @app.get("/deliveries")
+    def deliveries():
+        result = manifest.build_manifest(db, DAY)
+        return fast_json.FastJSONResponse(result) if fast_json.FAST_JSON else result
+
+    client = TestClient(app)
+    for url in ("/users?limit=20", "/users?limit=20&order=desc", "/deliveries"):
+        monkeypatch.setattr(fast_json, "FAST_JSON", False)
+        expected = client.get(url)
+        monkeypatch.setattr(fast_json, "FAST_JSON", True)
+        fast = client.get(url)
+        assert fast.content == expected.content
+        assert fast.headers.get("x-next-cursor") == expected.headers.get("x-next-cursor")
+
+
+def test_metrics_count_queries_per_route(engine, db, monkeypatch, caplog):
+    seed(db, 5)
+    metrics.reset()
+    metrics.instrument_engine(engine)
+    monkeypatch.setattr(metrics, "SLOW_REQUEST_MS", 0.001)
+    app = FastAPI()
+    metrics.install(app)
+
+    @app.get("/residents/{user_id}")
+    def resident(user_id: int):
+        # One query for the user and one per subscription: an N+1 on purpose
+        subscriptions = db.query(Subscription).filter(Subscription.user_id == user_id).all()
+        return {"items": sum(len(subscription.items) for subscription in subscriptions)}
+
+    client = TestClient(app)
+    with caplog.at_level("WARNING", logger="dailydoodh.slow_requests"):
+        for user_id in (1, 2, 3):
+            assert client.get(f"/residents/{user_id}").status_code == 200
+    assert client.get("/missing").status_code == 404
+    text = client.get("/metrics").text
+
+    labels = 'method="GET",route="/residents/{user_id}"'
+    assert f'http_requests_total{{{labels},status="200"}} 3' in text
+    assert f"http_request_duration_seconds_count{{{labels}}} 3" in text
+    assert f"http_request_sql_queries_sum{{{labels}}} 9" in text
+    assert f'http_request_sql_queries_bucket{{{labels},le="3"}} 3' in text
+    assert 'http_requests_total{method="GET",route="<unmatched>",status="404"} 1' in text
+    slow = [r.getMessage() for r in caplog.records if "/residents/1 " in r.getMessage()]
+    assert len(slow) == 1 and "3 queries" in slow[0] and slow[0].count("FROM subscription_items") == 2
+    metrics.reset()
+
+
+def test_migrate_adds_indexes_to_existing_tables(engine):
+    # Simulate a database created before the indexes were declared
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+        connection.execute(text("ALTER TABLE users DROP COLUMN latitude"))
+        connection.execute(text("ALTER TABLE users DROP COLUMN longitude"))
+        connection.execute(text("ALTER TABLE users DROP COLUMN version"))
+        connection.execute(text("INSERT INTO users (name, email, house_number) VALUES ('Old', 'old@example.com', 'A-1')"))
+
+    assert migrations.migrate(engine) == [
+        "add_hot_path_indexes", "add_order_history_index", "add_user_coordinates", "add_cancellation_reference_index",
+        "add_user_version"
+    ]
+    assert migrations.migrate(engine) == []
+
+    indexes = {index["name"] for index in inspect(engine).get_indexes("vacations")}
+    assert "ix_vacations_user_dates" in indexes
+    indexes = {index["name"] for index in inspect(engine).get_indexes("orders")}
+    assert {"ix_orders_date_adhoc", "ix_orders_user_id", "ix_orders_user_date"} <= indexes
+    assert {"latitude", "longitude"} <= {column["name"] for column in inspect(engine).get_columns("users")}
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT version FROM users")).scalar() == 0
+    indexes = {index["name"] for index in inspect(engine).get_indexes("cancellations")}
+    assert "ix_cancellations_type_reference" in indexes
+
+
+def test_only_migrate_writes_the_schema(engine, monkeypatch, capsys):
+    monkeypatch.setattr(manage, "engine", engine)
+    monkeypatch.setattr(manage, "SessionLocal", sessionmaker(bind=engine))
+    names = [migration.__name__ for _, migration in migrations.MIGRATIONS]
+    assert migrations.pending(engine) == names
+
+    assert manage.main(["jobs"]) == 1
+    assert "run `python manage.py migrate` first" in capsys.readouterr().err
+    assert migrations.pending(engine) == names
+
+    assert manage.main(["migrate"]) == 0
+    assert migrations.pending(engine) == []
+    assert manage.main(["jobs"]) == 0